@@ -5,10 +5,8 @@ import os
 
 import aiomisc
 import aiosqlite
-import docx
 import requests
 import telegram
-from PyPDF2 import PdfFileReader
 from aiomisc import get_context
 from pyee import AsyncIOEventEmitter
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
@@ -20,6 +18,7 @@ from bot import bot_texts
 from common.db import safe_db_execute
 from common.logging import cls_name
 from common.post import prepare_post
+from common.startup import startup
 from db.sqlite import SQLLite3Service
 
 log = logging.getLogger(__name__)
@@ -82,6 +81,7 @@ class TelegramBot(aiomisc.Service):
         await self.application.initialize()
         await self.application.start()
         await self.application.updater.start_polling()
+        startup.ready(self)
 
         await asyncio.gather(
             self.poll_db(),
@@ -451,8 +451,10 @@ class TelegramBot(aiomisc.Service):
     async def parse_document(self, file_path: str) -> str:
         content = ""
 
+        # Document readers are imported on the first resume, not on startup
         if file_path.endswith('.docx'):
             try:
+                import docx
                 doc = docx.Document(file_path)
                 for paragraph in doc.paragraphs:
                     content += paragraph.text + '\n'
@@ -461,6 +463,7 @@ class TelegramBot(aiomisc.Service):
                 content = "Error parsing .docx file: " + str(e)
         elif file_path.endswith('.pdf'):
             try:
+                from PyPDF2 import PdfFileReader
                 with open(file_path, 'rb') as file:
                     reader = PdfFileReader(file)
                     for page_num in range(reader.numPages):
@@ -0,0 +1,84 @@
+"""
+Local cache of the assets the app needs at runtime: nltk data, geckodriver
+binary, user agents. Nothing is resolved at import time, every asset is
+looked up on first use, and the network is touched only when the cache
+doesn't have it yet, or never with ASSETS_OFFLINE=1.
+"""
+import logging
+import os
+import shutil
+from functools import lru_cache
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+GECKO_DRIVER_VERSION = "v0.33.0"
+
+
+class AssetMissing(Exception):
+    pass
+
+
+def is_offline():
+    return os.getenv("ASSETS_OFFLINE", "0") == "1"
+
+
+def assets_dir(*parts):
+    path = os.path.join(os.getenv("ASSETS_DIR", os.path.join(os.getcwd(), "assets")), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@lru_cache(maxsize=None)
+def get_nltk():
+    """
+    Returns nltk with punkt tokenizer resolved from the cache
+    """
+    import nltk
+
+    path = assets_dir("nltk")
+    if path not in nltk.data.path:
+        nltk.data.path.insert(0, path)
+
+    try:
+        nltk.data.find("tokenizers/punkt")
+    except LookupError:
+        if is_offline():
+            raise AssetMissing(f"nltk punkt isn't in the cache, path:{path}")
+
+        log.info(f"Downloading nltk punkt into the cache, path:{path}")
+        nltk.download("punkt", download_dir=path, quiet=True)
+
+    return nltk
+
+
+@lru_cache(maxsize=None)
+def get_gecko_driver_path():
+    """
+    GECKO_DRIVER_PATH, geckodriver on PATH, or the one installed into the cache
+    """
+    path = os.getenv("GECKO_DRIVER_PATH") or shutil.which("geckodriver")
+    if path:
+        return path
+
+    from webdriver_manager.core.driver_cache import DriverCacheManager
+    from webdriver_manager.firefox import GeckoDriverManager
+
+    if is_offline():
+        raise AssetMissing("geckodriver isn't found, set GECKO_DRIVER_PATH")
+
+    # The version is pinned, so once installed the driver is served from the
+    # cache without asking GitHub for the latest release
+    cache_manager = DriverCacheManager(root_dir=assets_dir("drivers"))
+    return GeckoDriverManager(GECKO_DRIVER_VERSION, cache_manager=cache_manager).install()
+
+
+@lru_cache(maxsize=None)
+def get_user_agents():
+    """
+    UserAgent reads the browsers list bundled with the package, it's built
+    once instead of per driver
+    """
+    from fake_useragent import UserAgent
+
+    return UserAgent()
@@ -1,9 +1,13 @@
-from chromadb.api.models import Collection
+from typing import TYPE_CHECKING
+
 import numpy as np
 
+if TYPE_CHECKING:
+    from chromadb.api.models.Collection import Collection
+
 
 
-def calculate_percentile(collection: Collection, embedding):
+def calculate_percentile(collection: "Collection", embedding):
     # Get the embeddings for the support documents from the collection
     support_embeddings = collection.get(include=['embeddings'])['embeddings']
 
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class SingleFlight:
+    """
+    Registry of in-progress calls by key. A caller, who comes while the call
+    with the same key is in progress, waits for it and gets its result,
+    instead of making the call once again.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.started = 0
+        self.shared = 0
+
+    def get(self, key) -> asyncio.Future:
+        return self._flights.get(key)
+
+    def begin(self, key) -> asyncio.Future:
+        """
+        Registers the call made by the caller itself, it has to end() it
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._flights[key] = future
+        self.started += 1
+        return future
+
+    def end(self, key, result=None):
+        future = self._flights.pop(key, None)
+        if future and not future.done():
+            future.set_result(result)
+
+    async def wait(self, key):
+        """
+        Waits for the call in progress, returns its result
+        """
+        future = self._flights[key]
+        self.shared += 1
+        # Cancelled waiter doesn't cancel the call
+        return await asyncio.shield(future)
+
+    async def run(self, key, func, *args, **kwargs):
+        future = self._flights.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(func(*args, **kwargs))
+        self._flights[key] = future
+        self.started += 1
+
+        def forget(_):
+            if self._flights.get(key) is future:
+                del self._flights[key]
+
+        future.add_done_callback(forget)
+        return await asyncio.shield(future)
+
+    def __len__(self):
+        return len(self._flights)
@@ -0,0 +1,70 @@
+import logging
+import time
+
+from common.logging import cls_name
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class StartupReport:
+    """
+    Time-to-ready of the process: how long the startup phases took, e.g.
+    imports, and when every service became ready, counted from the moment
+    this module was imported. Once all the tracked services are ready, the
+    report is logged.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.phases = {}
+        self.services = {}
+        self.expected = set()
+        self._marked_at = self.started_at
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def mark(self, phase):
+        """
+        Ends the phase, which started with the previous mark
+        """
+        now = time.monotonic()
+        self.phases[phase] = now - self._marked_at
+        self._marked_at = now
+
+    def track(self, *services):
+        self.expected.update(cls_name(service) for service in services)
+
+    def ready(self, service):
+        name = cls_name(service)
+        self.services[name] = self.elapsed()
+        log.info(
+            f"{name}: "
+            f"Ready "
+            f"after:{self.services[name]:.2f}s"
+        )
+
+        if self.expected and self.expected.issubset(self.services):
+            self.log_report()
+            self.expected = set()
+
+    def report(self):
+        return {
+            "elapsed": round(self.elapsed(), 2),
+            "phases": {name: round(duration, 2) for name, duration in self.phases.items()},
+            "services": {name: round(elapsed, 2) for name, elapsed in self.services.items()},
+        }
+
+    def log_report(self):
+        report = self.report()
+        log.info(
+            f"{cls_name(self)}: "
+            f"Startup "
+            f"elapsed:{report['elapsed']}s "
+            f"phases:{report['phases']} "
+            f"services:{report['services']}"
+        )
+
+
+startup = StartupReport()
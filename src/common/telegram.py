@@ -7,7 +7,6 @@ import time
 from typing import Optional, List, Sequence, Coroutine, Union
 from urllib.parse import urlparse
 
-import nltk
 import phonenumbers
 import validators
 from telegram._utils.defaultvalue import DEFAULT_NONE, DefaultValue
@@ -23,6 +22,7 @@ from telethon.tl.functions.channels import GetFullChannelRequest, DeleteMessages
 from telethon.tl.functions.messages import GetDialogFiltersRequest
 from telethon.tl.types import InputChannel
 
+from common.assets import get_nltk
 from common.markdown import MarkdownPost, fix_brain_cancer
 from common.utils import remove_emojis
 
@@ -125,10 +125,6 @@ class WaitOnFloodTelegramClient(TelegramClient):
         raise ValueError('Request was unsuccessful {} time(s)'.format(attempt))
 
 
-# By default load nltk
-nltk.download('punkt')
-
-
 class TelegramTextTools:
     PREFERRED_LEN = 3000
     MAX_LEN = 4096
@@ -202,7 +198,7 @@ class TelegramTextTools:
         language = TelegramTextTools._proper_language(language)
 
         changed_text = TelegramTextTools._replace_newlines(original_text)
-        temp_sentences = nltk.tokenize.sent_tokenize(changed_text, language=language)
+        temp_sentences = get_nltk().tokenize.sent_tokenize(changed_text, language=language)
         temp_sentences = [sentence for sentence in temp_sentences if sentence.strip() != "."]
 
         reverted_sentences = [
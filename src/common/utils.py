@@ -1,10 +1,13 @@
 # -*- coding: UTF-8 -*-
 import asyncio
+import hashlib
 import os
 import re
 from collections import defaultdict
 from difflib import SequenceMatcher
+from functools import lru_cache
 
+import tiktoken
 from pyee import AsyncIOEventEmitter
 from pytz import utc
 from telethon.helpers import add_surrogate, del_surrogate
@@ -14,9 +17,56 @@ def str_utc_time(date):
     return date.astimezone(utc).strftime("%Y-%m-%d %H:%M:%S")
 
 
+@lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text):
+    return len(get_encoding().encode(text))
+
+
+class Prompt:
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self._num_tokens = None
+
+    @property
+    def num_tokens(self):
+        # Encoded once, on the first request
+        if self._num_tokens is None:
+            self._num_tokens = count_tokens(self.text)
+        return self._num_tokens
+
+
+# Prompts are read from disk once per process, restart to pick up the changes
+_prompts = {}
+
+
+def load_prompt(name) -> Prompt:
+    prompt = _prompts.get(name)
+    if prompt is None:
+        with open(os.path.join(os.getcwd(), "src", "gpt", "prompts", name), "r") as f:
+            prompt = _prompts[name] = Prompt(name, f.read())
+    return prompt
+
+
 def get_prompt(name):
-    with open(os.path.join(os.getcwd(), "src", "gpt", "prompts", name), "r") as f:
-        return f.read()
+    return load_prompt(name).text
+
+
+def get_prompt_tokens(name):
+    return load_prompt(name).num_tokens
+
+
+@lru_cache(maxsize=None)
+def get_prompt_version(*names):
+    # Cached GPT answers are invalidated by any change of the prompts
+    digest = hashlib.sha256()
+    for name in names:
+        digest.update(get_prompt(name).encode("utf-8"))
+    return digest.hexdigest()[:16]
 
 
 def print_event(**kwargs):
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+from common.logging import cls_name
+from common.utils import count_tokens
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def estimate_tokens(text):
+    return count_tokens(text)
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding calls, which arrive within a short window,
+    into one request, so that request-based rate limit is charged once per
+    batch instead of once per text. Each caller receives only its own vectors.
+    """
+
+    def __init__(self, request_embedding, window=0.005, max_batch_tokens=50_000, max_batch_size=512):
+        self._request_embedding = request_embedding
+        self.window = window
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+
+        self._pending = []
+        self._pending_tokens = 0
+        self._pending_size = 0
+        self._timer = None
+        self._tasks = set()
+
+        self.requests = 0
+        self.calls = 0
+
+    async def embed(self, contents: list) -> (int, list):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        num_tokens = sum(estimate_tokens(text) for text in contents)
+
+        # Do not let a single caller push the batch over the budget
+        if self._pending and (
+                self._pending_tokens + num_tokens > self.max_batch_tokens or
+                self._pending_size + len(contents) > self.max_batch_size
+        ):
+            self._flush()
+
+        self._pending.append((contents, num_tokens, future))
+        self._pending_tokens += num_tokens
+        self._pending_size += len(contents)
+        self.calls += 1
+
+        if self._pending_tokens >= self.max_batch_tokens or self._pending_size >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._pending:
+            return
+
+        batch = self._pending
+        self._pending = []
+        self._pending_tokens = 0
+        self._pending_size = 0
+
+        task = asyncio.ensure_future(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        contents = [text for (texts, _, _) in batch for text in texts]
+        self.requests += 1
+
+        try:
+            tokens_used, embeddings = await self._request_embedding(contents)
+        except BaseException as e:
+            for (_, _, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+
+        if len(embeddings) != len(contents):
+            e = ValueError(f"expected {len(contents)} embeddings, received {len(embeddings)}")
+            for (_, _, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if len(batch) > 1:
+            log.debug(
+                f"{cls_name(self)}: "
+                f"Coalesced embedding calls "
+                f"calls:{len(batch)} "
+                f"texts:{len(contents)} "
+                f"tokens_used:{tokens_used}"
+            )
+
+        # Split reported usage between callers proportionally to their estimate
+        total_estimate = sum(num_tokens for (_, num_tokens, _) in batch) or 1
+
+        offset = 0
+        for (texts, num_tokens, future) in batch:
+            own_embeddings = embeddings[offset:offset + len(texts)]
+            offset += len(texts)
+
+            if not future.done():
+                future.set_result((round(tokens_used * num_tokens / total_estimate), own_embeddings))
+
+    async def close(self):
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "requests": self.requests,
+        }
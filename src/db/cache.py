@@ -0,0 +1,507 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+import aiosqlite
+import numpy as np
+
+from common.db import safe_db_execute
+from common.logging import cls_name
+from common.utils import group_list
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+CREATE_EMBEDDINGS_CACHE_TABLE = """
+    CREATE TABLE IF NOT EXISTS embeddings_cache(
+        key TEXT PRIMARY KEY,
+        model TEXT,
+        dimension INTEGER,
+        vector BLOB,
+        tokens INTEGER,
+        created_at REAL,
+        used_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS embeddings_cache_used_at ON embeddings_cache(used_at);
+"""
+
+GET_CACHED_EMBEDDINGS = """
+    SELECT key, dimension, vector, tokens
+    FROM embeddings_cache
+    WHERE key IN ({params}) AND created_at > ?
+"""
+
+TOUCH_CACHED_EMBEDDINGS = """
+    UPDATE embeddings_cache
+    SET used_at = ?
+    WHERE key IN ({params})
+"""
+
+INSERT_CACHED_EMBEDDING = """
+    INSERT OR REPLACE
+    INTO embeddings_cache(key, model, dimension, vector, tokens, created_at, used_at)
+    VALUES(?,?,?,?,?,?,?)
+"""
+
+EVICT_EXPIRED_EMBEDDINGS = """
+    DELETE
+    FROM embeddings_cache
+    WHERE created_at <= ?
+"""
+
+EVICT_LRU_EMBEDDINGS = """
+    DELETE
+    FROM embeddings_cache
+    WHERE key IN (
+        SELECT key
+        FROM embeddings_cache
+        ORDER BY used_at
+        LIMIT max(0, (SELECT COUNT(*) FROM embeddings_cache) - ?)
+    )
+"""
+
+CREATE_GPT_CACHE_TABLE = """
+    CREATE TABLE IF NOT EXISTS gpt_cache(
+        key TEXT PRIMARY KEY,
+        kind TEXT,
+        model TEXT,
+        score REAL,
+        reason TEXT,
+        response TEXT,
+        tokens INTEGER,
+        created_at REAL,
+        used_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS gpt_cache_used_at ON gpt_cache(used_at);
+"""
+
+GET_CACHED_GPT_RESPONSE = """
+    SELECT score, reason, response, tokens
+    FROM gpt_cache
+    WHERE key = ? AND created_at > ?
+"""
+
+TOUCH_CACHED_GPT_RESPONSE = """
+    UPDATE gpt_cache
+    SET used_at = ?
+    WHERE key = ?
+"""
+
+INSERT_CACHED_GPT_RESPONSE = """
+    INSERT OR REPLACE
+    INTO gpt_cache(key, kind, model, score, reason, response, tokens, created_at, used_at)
+    VALUES(?,?,?,?,?,?,?,?,?)
+"""
+
+EVICT_EXPIRED_GPT_RESPONSES = """
+    DELETE
+    FROM gpt_cache
+    WHERE created_at <= ?
+"""
+
+EVICT_LRU_GPT_RESPONSES = """
+    DELETE
+    FROM gpt_cache
+    WHERE key IN (
+        SELECT key
+        FROM gpt_cache
+        ORDER BY used_at
+        LIMIT max(0, (SELECT COUNT(*) FROM gpt_cache) - ?)
+    )
+"""
+
+CREATE_PAGE_CACHE_TABLE = """
+    CREATE TABLE IF NOT EXISTS page_cache(
+        key TEXT PRIMARY KEY,
+        url TEXT, /* canonical url of the requested page */
+        outcome TEXT, /* parsed, archived, not_found, login_required */
+        parser TEXT,
+        final_url TEXT,
+        language TEXT,
+        text TEXT,
+        entities TEXT,
+        created_at REAL,
+        expires_at REAL, /* negative entries live shorter */
+        used_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS page_cache_used_at ON page_cache(used_at);
+"""
+
+GET_CACHED_PAGE = """
+    SELECT outcome, parser, final_url, language, text, entities
+    FROM page_cache
+    WHERE key = ? AND expires_at > ?
+"""
+
+TOUCH_CACHED_PAGE = """
+    UPDATE page_cache
+    SET used_at = ?
+    WHERE key = ?
+"""
+
+INSERT_CACHED_PAGE = """
+    INSERT OR REPLACE
+    INTO page_cache(key, url, outcome, parser, final_url, language, text, entities, created_at, expires_at, used_at)
+    VALUES(?,?,?,?,?,?,?,?,?,?,?)
+"""
+
+EVICT_EXPIRED_PAGES = """
+    DELETE
+    FROM page_cache
+    WHERE expires_at <= ?
+"""
+
+EVICT_LRU_PAGES = """
+    DELETE
+    FROM page_cache
+    WHERE key IN (
+        SELECT key
+        FROM page_cache
+        ORDER BY used_at
+        LIMIT max(0, (SELECT COUNT(*) FROM page_cache) - ?)
+    )
+"""
+
+
+def cache_db_path(environment):
+    # Caches live in their own file, so that they never compete for the write
+    # lock with the long-running transactions on the main database
+    if environment == "DEV":
+        return os.path.join(os.getcwd(), "dev_cache.sqlite")
+    elif environment == "TEST":
+        return os.path.join(os.getcwd(), "test_cache.sqlite")
+    else:
+        return os.path.join(os.getcwd(), "cache.sqlite")
+
+
+def normalize_text(text):
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SqliteCache:
+    """
+    Base of the caches in the cache database: one connection per cache object,
+    entries expire after `ttl` seconds and the least recently used ones are
+    evicted once the cache grows over `max_size`.
+    """
+    CREATE_TABLE = None
+    EVICT_EXPIRED = None
+    EVICT_LRU = None
+
+    def __init__(self, path, ttl, max_size, evict_every=500):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.evict_every = evict_every
+
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+
+        self._db = None
+        self._inserts_since_evict = 0
+
+    async def open(self):
+        self._db = await aiosqlite.connect(self.path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.executescript(self.CREATE_TABLE)
+        await self._db.commit()
+        await self.evict()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def inserted(self, num):
+        self._inserts_since_evict += num
+        if self._inserts_since_evict >= self.evict_every:
+            await self.evict()
+
+    def expired_before(self):
+        return time.time() - self.ttl
+
+    async def evict(self):
+        self._inserts_since_evict = 0
+        await safe_db_execute(self._db, self.EVICT_EXPIRED, [self.expired_before()])
+        await safe_db_execute(self._db, self.EVICT_LRU, [self.max_size])
+        await self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+class EmbeddingCache(SqliteCache):
+    """
+    Content-addressed on-disk cache of embeddings, keyed by the hash of the
+    normalized text and the model name. Vectors are stored as float32 blobs.
+    """
+    CREATE_TABLE = CREATE_EMBEDDINGS_CACHE_TABLE
+    EVICT_EXPIRED = EVICT_EXPIRED_EMBEDDINGS
+    EVICT_LRU = EVICT_LRU_EMBEDDINGS
+
+    # Max variables in one sqlite query is 999
+    lookup_size = 500
+
+    def __init__(self, path, ttl=60 * 60 * 24 * 30, max_size=200_000, evict_every=500):
+        super().__init__(path, ttl=ttl, max_size=max_size, evict_every=evict_every)
+
+    @staticmethod
+    def key(text, model):
+        return content_hash(model, normalize_text(text))
+
+    async def get_many(self, texts, model) -> list:
+        """
+        Returns list of the same length as texts, with cached embedding or None
+        """
+        if self._db is None:
+            return [None] * len(texts)
+
+        keys = [EmbeddingCache.key(text, model) for text in texts]
+
+        found = {}
+        for chunk in group_list(list(set(keys)), self.lookup_size):
+            params = ",".join(["?" for _ in chunk])
+            cursor = await safe_db_execute(
+                self._db,
+                GET_CACHED_EMBEDDINGS.format(params=params),
+                [*chunk, time.time() - self.ttl]
+            )
+            async for (key, dimension, vector, tokens) in cursor:
+                embedding = np.frombuffer(vector, dtype=np.float32)
+                if len(embedding) != dimension:
+                    log.warning(
+                        f"{cls_name(self)}: "
+                        f"Corrupted cache entry, skipping "
+                        f"key:{key}"
+                    )
+                    continue
+                found[key] = (embedding.tolist(), tokens or 0)
+
+        if found:
+            for chunk in group_list(list(found.keys()), self.lookup_size):
+                await safe_db_execute(
+                    self._db,
+                    TOUCH_CACHED_EMBEDDINGS.format(params=",".join(["?" for _ in chunk])),
+                    [time.time(), *chunk]
+                )
+            await self._db.commit()
+
+        results = []
+        for key in keys:
+            if key in found:
+                embedding, tokens = found[key]
+                self.hits += 1
+                self.tokens_saved += tokens
+                results.append(embedding)
+            else:
+                self.misses += 1
+                results.append(None)
+
+        return results
+
+    async def put_many(self, texts, embeddings, model, tokens_used=0):
+        if self._db is None or not texts:
+            return
+
+        # The API reports tokens per request, split them between the texts
+        # proportionally to the text length, good enough for the savings stats
+        total_len = sum(len(text) for text in texts) or 1
+
+        now = time.time()
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32)
+            await safe_db_execute(
+                self._db, INSERT_CACHED_EMBEDDING, [
+                    EmbeddingCache.key(text, model),
+                    model,
+                    len(vector),
+                    vector.tobytes(),
+                    round(tokens_used * len(text) / total_len),
+                    now,
+                    now,
+                ]
+            )
+        await self._db.commit()
+        await self.inserted(len(texts))
+
+
+class GptResponseCache(SqliteCache):
+    """
+    Cache of GPT answers, keyed by the hash of the request kind, the model,
+    the version of the system prompt and the normalized inputs. Filter
+    verdicts keep score and reason, other answers are stored as JSON.
+    """
+    CREATE_TABLE = CREATE_GPT_CACHE_TABLE
+    EVICT_EXPIRED = EVICT_EXPIRED_GPT_RESPONSES
+    EVICT_LRU = EVICT_LRU_GPT_RESPONSES
+
+    def __init__(self, path, ttl=60 * 60 * 24 * 14, max_size=100_000, evict_every=200):
+        super().__init__(path, ttl=ttl, max_size=max_size, evict_every=evict_every)
+
+    @staticmethod
+    def key(kind, model, prompt_version, *inputs):
+        return content_hash(kind, model, prompt_version, *[normalize_text(text) for text in inputs])
+
+    async def get(self, key):
+        """
+        Returns dict with score, reason, response and tokens, or None
+        """
+        if self._db is None:
+            return None
+
+        cursor = await safe_db_execute(self._db, GET_CACHED_GPT_RESPONSE, [key, time.time() - self.ttl])
+        row = await cursor.fetchone()
+        if not row:
+            self.misses += 1
+            return None
+
+        (score, reason, response, tokens) = row
+        try:
+            response = json.loads(response) if response else None
+        except json.decoder.JSONDecodeError:
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Corrupted cache entry, skipping "
+                f"key:{key}"
+            )
+            self.misses += 1
+            return None
+
+        await safe_db_execute(self._db, TOUCH_CACHED_GPT_RESPONSE, [time.time(), key])
+        await self._db.commit()
+
+        self.hits += 1
+        self.tokens_saved += tokens or 0
+        return {
+            "score": score,
+            "reason": reason,
+            "response": response,
+            "tokens": tokens or 0,
+        }
+
+    async def put(self, key, kind, model, tokens, score=None, reason=None, response=None):
+        if self._db is None:
+            return
+
+        now = time.time()
+        await safe_db_execute(
+            self._db, INSERT_CACHED_GPT_RESPONSE, [
+                key,
+                kind,
+                model,
+                score,
+                reason,
+                json.dumps(response, ensure_ascii=False) if response is not None else None,
+                tokens,
+                now,
+                now,
+            ]
+        )
+        await self._db.commit()
+        await self.inserted(1)
+
+
+class ParsedPageCache(SqliteCache):
+    """
+    Cache of the parsed job pages, keyed by the canonical url. Keeps the
+    content with the parser name, the url after redirects and the language.
+    Archived, not found and login-walled pages are kept as negative entries,
+    with their own shorter ttl, so that reposts of them aren't loaded again.
+    """
+    CREATE_TABLE = CREATE_PAGE_CACHE_TABLE
+    EVICT_EXPIRED = EVICT_EXPIRED_PAGES
+    EVICT_LRU = EVICT_LRU_PAGES
+
+    PARSED = "parsed"
+    NEGATIVE_OUTCOMES = ["archived", "not_found", "login_required"]
+
+    def __init__(self, path, ttl=60 * 60 * 24 * 3, negative_ttl=60 * 60 * 12, max_size=50_000, evict_every=200):
+        super().__init__(path, ttl=ttl, max_size=max_size, evict_every=evict_every)
+        self.negative_ttl = negative_ttl
+        self.negative_hits = 0
+
+    def expired_before(self):
+        # Every entry keeps its own expiration time
+        return time.time()
+
+    @staticmethod
+    def key(url, add_info_link):
+        return content_hash(url, add_info_link)
+
+    async def get(self, key):
+        """
+        Returns dict with outcome, parser, final_url, language, text and
+        entities, or None
+        """
+        if self._db is None:
+            return None
+
+        cursor = await safe_db_execute(self._db, GET_CACHED_PAGE, [key, time.time()])
+        row = await cursor.fetchone()
+        if not row:
+            self.misses += 1
+            return None
+
+        await safe_db_execute(self._db, TOUCH_CACHED_PAGE, [time.time(), key])
+        await self._db.commit()
+
+        (outcome, parser, final_url, language, text, entities) = row
+        self.hits += 1
+        if outcome != self.PARSED:
+            self.negative_hits += 1
+
+        return {
+            "outcome": outcome,
+            "parser": parser,
+            "final_url": final_url,
+            "language": language,
+            "text": text,
+            "entities": entities,
+        }
+
+    async def put(self, key, url, outcome, parser=None, final_url=None, language=None, text=None, entities=None):
+        if self._db is None:
+            return
+
+        now = time.time()
+        ttl = self.ttl if outcome == self.PARSED else self.negative_ttl
+        await safe_db_execute(
+            self._db, INSERT_CACHED_PAGE, [
+                key,
+                url,
+                outcome,
+                parser,
+                final_url,
+                language,
+                text,
+                entities,
+                now,
+                now + ttl,
+                now,
+            ]
+        )
+        await self._db.commit()
+        await self.inserted(1)
+
+    def stats(self):
+        stats = super().stats()
+        stats["negative_hits"] = self.negative_hits
+        return stats
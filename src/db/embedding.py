@@ -1,18 +1,28 @@
+import asyncio
 import logging
 import os
+import sys
+from typing import TYPE_CHECKING
 
 import aiomisc
-import chromadb
 import openai
-from aiolimiter import AsyncLimiter
-from chromadb import API
-from chromadb.api.models.Collection import Collection
-from chromadb.api.types import ID
-from chromadb.errors import IDAlreadyExistsError
+from aiomisc import get_context
 
 from common.logging import cls_name, shorten_text
+from common.startup import startup
 from common.utils import get_match_percentage
+from db.batching import EmbeddingBatcher
+from db.cache import EmbeddingCache, cache_db_path
+from db.embedding_backends import EmbeddingBackend, HashingEmbeddingBackend, OpenAIEmbeddingBackend, \
+    get_embedding_backend
 from db.sqlite import GET_POST_BY_POST_ID
+from db.vector_store import IDAlreadyExists, NumpyClient
+
+if TYPE_CHECKING:
+    # chromadb takes seconds to import, it's imported only for the Chroma store
+    from chromadb import API
+    from chromadb.api.models.Collection import Collection
+    from chromadb.api.types import ID
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
@@ -20,10 +30,28 @@ log.setLevel(logging.INFO)
 
 class EmbeddingDB(aiomisc.Service):
     environment = "PROD"
-    client: API = None
+    client: "API" = None
+
+    # Either "chroma" or "numpy", falls back to VECTOR_STORE env variable and than to chroma
+    vector_store: str = None
     recreate_prompts = False
     recreate_posts = False
-    embedding_rate_limit = AsyncLimiter(max_rate=60, time_period=60)
+
+    # Selectable per environment, see EMBEDDING_BACKENDS,
+    # falls back to EMBEDDING_BACKEND env variable and than to openai
+    backend_name: str = None
+    backend: EmbeddingBackend = None
+    local_backend: HashingEmbeddingBackend = None
+
+    use_cache = True
+    cache: EmbeddingCache = None
+
+    # Concurrent calls within the window are sent as one request
+    use_batching = True
+    batch_window = 0.005
+    batch_max_tokens = 50_000
+    batch_max_size = 512
+    batcher: EmbeddingBatcher = None
 
     def prepare_text_for_index(self, text):
         # TODO: Clear text for index
@@ -36,42 +64,76 @@ class EmbeddingDB(aiomisc.Service):
         # TODO: Possible store cleared text in the index?
         pass
 
-    @aiomisc.asyncbackoff(
-        attempt_timeout=30,
-        deadline=60,
-        pause=2,
-        max_tries=20,
-        exceptions=(
-                openai.error.APIConnectionError,
-                openai.error.ServiceUnavailableError,
-        )
-    )
+    async def request_embedding(self, contents: list) -> (int, list):
+        return await self.backend.embed(contents)
+
+    async def send_embedding(self, contents: list) -> (int, list):
+        if self.batcher:
+            return await self.batcher.embed(contents)
+        return await self.request_embedding(contents)
+
     async def create_embedding(self, contents: list) -> (int, list):
         if type(contents) is not list:
             raise ValueError("input should be list")
 
-        async with self.embedding_rate_limit:
-            response = await openai.Embedding.acreate(
-                model="text-embedding-ada-002",
-                input=contents
+        if not self.cache:
+            return await self.send_embedding(contents)
+
+        embeddings = await self.cache.get_many(contents, self.backend.get_model())
+        missed = [n for n, embedding in enumerate(embeddings) if embedding is None]
+        if not missed:
+            log.debug(
+                f"{cls_name(self)}: "
+                f"Embedding served from cache "
+                f"num:{len(contents)} "
+                f"text:'{shorten_text(contents[0])}'"
+            )
+            return 0, embeddings
+
+        # Only misses go to the API, results are merged back in the input order
+        missed_contents = [contents[n] for n in missed]
+        tokens_used, missed_embeddings = await self.send_embedding(missed_contents)
+        for n, embedding in zip(missed, missed_embeddings):
+            embeddings[n] = embedding
+
+        await self.cache.put_many(missed_contents, missed_embeddings, self.backend.get_model(), tokens_used)
+
+        if len(missed) != len(contents):
+            stats = self.cache.stats()
+            log.info(
+                f"{cls_name(self)}: "
+                f"Embedding partially served from cache "
+                f"hits:{len(contents) - len(missed)} "
+                f"misses:{len(missed)} "
+                f"total_hit_rate:{stats['hit_rate']:.2f} "
+                f"total_tokens_saved:{stats['tokens_saved']}"
             )
 
-        tokens_used = response['usage']['total_tokens']
+        return tokens_used, embeddings
 
-        # enc = tiktoken.get_encoding("cl100k_base")
-        # num_tokens = len(enc.encode(get_prompt("preprocess.txt") + content))
+    def cache_stats(self):
+        if not self.cache:
+            return None
+        return self.cache.stats()
 
-        log.debug(
-            f"{cls_name(self)}: "
-            f"Created embedding  "
-            f"tokens_used:{tokens_used} "
-            f"text:'{shorten_text(contents[0])}'"
-        )
+    async def create_local_embedding(self, contents: list) -> (int, list):
+        # Cheap offline embedding, e.g. for pre-filtering before paying for the main backend
+        if type(contents) is not list:
+            raise ValueError("input should be list")
 
-        if len(response["data"]) > 1:
-            return tokens_used, [elem["embedding"] for elem in response["data"]]
-        else:
-            return tokens_used, [response["data"][0]["embedding"]]
+        return await self.local_backend.embed(contents)
+
+    def collection_name(self, name):
+        # Collections of different backends can't be mixed, because of the
+        # different dimensions, keep the original names for OpenAI
+        if isinstance(self.backend, OpenAIEmbeddingBackend):
+            return name
+        return f"{name}_{self.backend.get_name()}_{self.backend.get_dimension()}"
+
+    def collection_kwargs(self):
+        if self.vector_store == "numpy":
+            return {"dimension": self.backend.get_dimension()}
+        return {}
 
     def is_test(self):
         return self.environment == "TEST"
@@ -83,32 +145,80 @@ class EmbeddingDB(aiomisc.Service):
         # Change class field according to instance field
         EmbeddingDB.environment = self.environment or "PROD"
 
+        self.vector_store = self.vector_store or os.getenv("VECTOR_STORE", "chroma")
+        if self.vector_store not in ["chroma", "numpy"]:
+            raise NotImplementedError(f"Unknown vector store: {self.vector_store}")
+
+        db_dir = "chroma" if self.vector_store == "chroma" else "vectors"
         if self.is_dev():
-            db_path = os.path.join(os.getcwd(), "dev_chroma")
+            db_path = os.path.join(os.getcwd(), f"dev_{db_dir}")
         elif self.is_test():
-            db_path = os.path.join(os.getcwd(), "test_chroma")
+            db_path = os.path.join(os.getcwd(), f"test_{db_dir}")
             try:
                 from send2trash import send2trash
                 send2trash(db_path)
             except OSError:
                 pass
         else:
-            db_path = os.path.join(os.getcwd(), "chroma")
+            db_path = os.path.join(os.getcwd(), db_dir)
 
-        self.client = chromadb.PersistentClient(path=db_path)
+        if self.vector_store == "chroma":
+            import chromadb
+            self.client = chromadb.PersistentClient(path=db_path)
+        else:
+            self.client = NumpyClient(path=db_path)
 
-        assert (os.getenv("OPENAI_API_KEY") is not None)
-        openai.api_key = os.getenv("OPENAI_API_KEY")
+        if not self.backend:
+            self.backend = get_embedding_backend(self.backend_name or os.getenv("EMBEDDING_BACKEND", "openai"))
+        self.local_backend = HashingEmbeddingBackend()
+
+        log.info(
+            f"{cls_name(self)}: "
+            f"Using embedding backend "
+            f"name:{self.backend.get_name()} "
+            f"model:{self.backend.get_model()} "
+            f"dimension:{self.backend.get_dimension()}"
+        )
+
+        if self.use_cache:
+            log.info(
+                f"{cls_name(self)}: "
+                f"Opening embedding cache"
+            )
+            self.cache = EmbeddingCache(cache_db_path(self.environment))
+            await self.cache.open()
+
+        if self.use_batching and self.backend.batchable:
+            self.batcher = EmbeddingBatcher(
+                request_embedding=self.request_embedding,
+                window=self.batch_window,
+                max_batch_tokens=self.batch_max_tokens,
+                max_batch_size=self.batch_max_size,
+            )
+
+        if isinstance(self.backend, OpenAIEmbeddingBackend):
+            assert (os.getenv("OPENAI_API_KEY") is not None)
+            openai.api_key = os.getenv("OPENAI_API_KEY")
+
+            if not self.backend.scheduler:
+                log.info(f"{cls_name(self)}: Waiting for OpenAI scheduler")
+                try:
+                    self.backend.scheduler = await asyncio.wait_for(get_context()['openai_scheduler'], 3)
+                except asyncio.exceptions.TimeoutError:
+                    log.warning(
+                        f"{cls_name(self)}: "
+                        f"Haven't received OpenAI scheduler, using own rate limiter"
+                    )
 
         if self.recreate_posts:
             try:
-                self.client.delete_collection(name="posts")
+                self.client.delete_collection(name=self.collection_name("posts"))
             except ValueError:  # in case there is no collection
                 pass
 
         if self.recreate_prompts:
             try:
-                self.client.delete_collection(name="prompts")
+                self.client.delete_collection(name=self.collection_name("prompts"))
             except ValueError:  # in case there is no collection
                 pass
 
@@ -117,7 +227,8 @@ class EmbeddingDB(aiomisc.Service):
             f"Getting the post collection"
         )
         index_posts = self.client.get_or_create_collection(
-            name="posts",
+            name=self.collection_name("posts"),
+            **self.collection_kwargs(),
             metadata={
                 "hnsw:space": "cosine",
                 "hnsw:M": 16,
@@ -130,7 +241,8 @@ class EmbeddingDB(aiomisc.Service):
             f"Getting the search_requests collection"
         )
         index_prompts = self.client.get_or_create_collection(
-            name="prompts",
+            name=self.collection_name("prompts"),
+            **self.collection_kwargs(),
             metadata={
                 "hnsw:space": "cosine",
                 "hnsw:M": 16,
@@ -141,6 +253,8 @@ class EmbeddingDB(aiomisc.Service):
         self.context['index_prompts'] = index_prompts
         self.context['index_posts'] = index_posts
         self.context['create_embedding'] = self.create_embedding
+        self.context['create_local_embedding'] = self.create_local_embedding
+        startup.ready(self)
 
     async def stop(self, *args, **kwargs):
         log.info(
@@ -149,18 +263,40 @@ class EmbeddingDB(aiomisc.Service):
         )
         self.client.stop()
 
+        if self.batcher:
+            await self.batcher.close()
+
+        if self.cache:
+            log.info(
+                f"{cls_name(self)}: "
+                f"Closing embedding cache, "
+                f"stats:{self.cache.stats()}"
+            )
+            await self.cache.close()
+
+
+def id_exists_errors() -> tuple:
+    # Chroma errors can be raised only if chromadb is imported already
+    chromadb_errors = sys.modules.get("chromadb.errors")
+    if chromadb_errors is None:
+        return IDAlreadyExists,
+    return chromadb_errors.IDAlreadyExistsError, IDAlreadyExists
+
 
 class PostsCollection:
-    _collection: Collection
+    _collection: "Collection"
 
-    def __init__(self, collection: Collection, create_embedding):
+    def __init__(self, collection: "Collection", create_embedding):
         self._collection = collection
         self._create_embedding = create_embedding
 
     def peek(self, *args, **kwargs):
         return self._collection.peek(*args, **kwargs)
 
-    async def find_same_post(self, db, post_text: str):
+    def count(self) -> int:
+        return self._collection.count()
+
+    async def find_same_post(self, db, post_text: str, embedding=None):
         if len(post_text.strip()) == 0:
             log.warning(
                 f"{cls_name(self)} "
@@ -168,7 +304,11 @@ class PostsCollection:
             )
             return 0, []
 
-        _, embeddings = await self._create_embedding([post_text])
+        if embedding is not None:
+            embeddings = [embedding]
+        else:
+            _, embeddings = await self._create_embedding([post_text])
+
         try:
             results = self.query_post(
                 query_embeddings=embeddings,
@@ -218,7 +358,7 @@ class PostsCollection:
 
     # @with_lock(locks["chromadb.get"])
     # @aiomisc.threaded  # for some reason it fails with segmentation fault if added
-    async def insert_post(self, post_id: ID, source, text=None, embedding=None):
+    async def insert_post(self, post_id: "ID", source, text=None, embedding=None):
         tokens_used = 0
         if not text and not embedding:
             raise NotImplementedError
@@ -234,7 +374,7 @@ class PostsCollection:
                 metadatas=[{"source": source, "post_id": post_id}]  # for search
             )
             return True, tokens_used
-        except IDAlreadyExistsError:
+        except id_exists_errors():
             log.warning(f"{cls_name(self)}: "
                         f"IDAlreadyExistsError: "
                         f"source:'{source}' "
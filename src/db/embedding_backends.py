@@ -0,0 +1,172 @@
+import logging
+import re
+import zlib
+from abc import ABC, abstractmethod
+
+import aiomisc
+import numpy as np
+import openai
+from aiolimiter import AsyncLimiter
+
+from common.logging import cls_name, shorten_text
+from db.batching import estimate_tokens
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class EmbeddingBackend(ABC):
+    # Remote backends benefit from coalescing calls into one request
+    batchable = False
+
+    @abstractmethod
+    async def embed(self, contents: list) -> (int, list):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_model(self):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_dimension(self):
+        raise NotImplementedError()
+
+    @staticmethod
+    @abstractmethod
+    def get_name():
+        raise NotImplementedError()
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    batchable = True
+    # Shared budget with the other OpenAI requests, see gpt.scheduler,
+    # the limiter is only used when the backend runs without the scheduler
+    scheduler = None
+    embedding_rate_limit = AsyncLimiter(max_rate=60, time_period=60)
+
+    def __init__(self, model="text-embedding-ada-002", dimension=1536):
+        self.model = model
+        self.dimension = dimension
+
+    def get_model(self):
+        return self.model
+
+    def get_dimension(self):
+        return self.dimension
+
+    @staticmethod
+    def get_name():
+        return "openai"
+
+    @aiomisc.asyncbackoff(
+        attempt_timeout=30,
+        deadline=60,
+        pause=2,
+        max_tries=20,
+        exceptions=(
+                openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError,
+        )
+    )
+    async def request(self, contents: list):
+        if not self.scheduler:
+            async with self.embedding_rate_limit:
+                return await openai.Embedding.acreate(model=self.model, input=contents)
+
+        num_tokens = sum(estimate_tokens(text) for text in contents)
+        async with self.scheduler.slot(self.model, num_tokens) as reservation:
+            response = await openai.Embedding.acreate(model=self.model, input=contents)
+            reservation.used(response['usage']['total_tokens'])
+            return response
+
+    async def embed(self, contents: list) -> (int, list):
+        response = await self.request(contents)
+
+        tokens_used = response['usage']['total_tokens']
+
+        log.debug(
+            f"{cls_name(self)}: "
+            f"Created embedding  "
+            f"tokens_used:{tokens_used} "
+            f"text:'{shorten_text(contents[0])}'"
+        )
+
+        # Response items carry their own index, don't rely on the order
+        data = sorted(response["data"], key=lambda elem: elem["index"])
+        return tokens_used, [elem["embedding"] for elem in data]
+
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """
+    CPU-only embedding, which works offline and costs nothing. Word unigrams
+    and character n-grams are hashed into a fixed number of signed buckets,
+    counts are log-scaled and the vector is L2 normalized, so cosine distance
+    behaves like on the OpenAI vectors, although with worse quality.
+    """
+
+    WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self, dimension=512, ngram_range=(3, 5)):
+        self.dimension = dimension
+        self.ngram_range = ngram_range
+
+    def get_model(self):
+        return f"hashing-{self.dimension}-{self.ngram_range[0]}-{self.ngram_range[1]}"
+
+    def get_dimension(self):
+        return self.dimension
+
+    @staticmethod
+    def get_name():
+        return "local"
+
+    def _features(self, text):
+        words = self.WORD_RE.findall(text.lower())
+        features = list(words)
+
+        min_n, max_n = self.ngram_range
+        for word in words:
+            padded = f" {word} "
+            for n in range(min_n, max_n + 1):
+                features.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+        return features
+
+    def embed_one(self, text) -> np.ndarray:
+        features = self._features(text)
+        if not features:
+            return np.zeros(self.dimension, dtype=np.float32)
+
+        # crc32 is stable between processes, unlike built-in hash()
+        hashes = np.fromiter(
+            (zlib.crc32(feature.encode("utf-8")) for feature in features),
+            dtype=np.uint32,
+            count=len(features)
+        )
+        buckets = (hashes % self.dimension).astype(np.int64)
+        signs = np.where((hashes >> 31) & 1, -1.0, 1.0)
+
+        vector = np.bincount(buckets, weights=signs, minlength=self.dimension)
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+
+        return vector.astype(np.float32)
+
+    async def embed(self, contents: list) -> (int, list):
+        return 0, [self.embed_one(text).tolist() for text in contents]
+
+
+EMBEDDING_BACKENDS = {
+    OpenAIEmbeddingBackend.get_name(): OpenAIEmbeddingBackend,
+    HashingEmbeddingBackend.get_name(): HashingEmbeddingBackend,
+}
+
+
+def get_embedding_backend(name) -> EmbeddingBackend:
+    backend = EMBEDDING_BACKENDS.get(name)
+    if not backend:
+        raise NotImplementedError(f"Unknown embedding backend: {name}")
+    return backend()
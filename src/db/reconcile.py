@@ -0,0 +1,221 @@
+import asyncio
+import logging
+
+from common.db import safe_db_execute
+from common.logging import cls_name
+from common.utils import group_list
+from db.sqlite import GET_RECONCILE_CHECKPOINT, SET_RECONCILE_CHECKPOINT, DELETE_RECONCILE_CHECKPOINT, \
+    COUNT_ACCEPTED_POSTS, GET_MAX_POST_ID, GET_ACCEPTED_POST_IDS_PAGE, GET_ACCEPTED_POSTS_BY_IDS, \
+    COUNT_APPROVED_PROMPTS, GET_MAX_PROMPT_ID, GET_APPROVED_PROMPT_IDS_PAGE, GET_APPROVED_PROMPTS_BY_IDS
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class IndexReconciler:
+    """
+    Brings the index in line with the db page by page, without loading
+    either of them whole. Goes in two phases:
+
+    missing - db ids are paged in order, the ones absent in the index are
+        embedded and added;
+    zombies - index is paged, the ids absent in the db are removed.
+
+    Position is checkpointed in the db after every page, so the pass resumes
+    where it stopped after restart. Ids created after the pass has started
+    are left alone, they are indexed by the ingestion itself.
+    """
+
+    name = None
+    count_sql = None
+    max_id_sql = None
+    ids_page_sql = None
+    by_ids_sql = None
+
+    page_size = 500
+    embedding_batch = 100
+    # Between pages, to leave the db and OpenAI to the live traffic
+    pause = 1
+
+    def __init__(self, index, create_embedding):
+        self.index = index
+        self.create_embedding = create_embedding
+        self.added = 0
+        self.removed = 0
+
+    def index_count(self) -> int:
+        return self.index.count()
+
+    def index_get(self, ids=None, limit=None, offset=None) -> list:
+        return self.index.get(ids=ids, limit=limit, offset=offset, include=[])["ids"]
+
+    async def index_add(self, rows, embeddings):
+        raise NotImplementedError
+
+    def index_delete(self, ids):
+        raise NotImplementedError
+
+    async def load_checkpoint(self, db):
+        cursor = await safe_db_execute(db, GET_RECONCILE_CHECKPOINT, [self.name])
+        return await cursor.fetchone()
+
+    async def save_checkpoint(self, db, phase, position, max_id):
+        await safe_db_execute(db, SET_RECONCILE_CHECKPOINT, [self.name, phase, position, max_id])
+        await db.commit()
+
+    async def is_synced(self, db) -> bool:
+        cursor = await safe_db_execute(db, self.count_sql)
+        (db_count,) = await cursor.fetchone()
+        index_count = self.index_count()
+        if db_count == index_count:
+            return True
+
+        log.warning(
+            f"{cls_name(self)}: "
+            f"Seems like mismatch between index and db "
+            f"name:{self.name} "
+            f"db_count:{db_count} "
+            f"index_count:{index_count}"
+        )
+        return False
+
+    async def run(self, db):
+        checkpoint = await self.load_checkpoint(db)
+        if checkpoint:
+            (phase, position, max_id) = checkpoint
+            log.info(
+                f"{cls_name(self)}: "
+                f"Resuming reconciliation "
+                f"name:{self.name} "
+                f"phase:{phase} "
+                f"position:{position}"
+            )
+        else:
+            if await self.is_synced(db):
+                return
+
+            cursor = await safe_db_execute(db, self.max_id_sql)
+            (max_id,) = await cursor.fetchone()
+            (phase, position) = ("missing", 0)
+            await self.save_checkpoint(db, phase, position, max_id or 0)
+
+        max_id = max_id or 0
+        if phase == "missing":
+            await self.add_missing(db, position, max_id)
+            await self.save_checkpoint(db, "zombies", 0, max_id)
+
+        await self.remove_zombies(db)
+        await safe_db_execute(db, DELETE_RECONCILE_CHECKPOINT, [self.name])
+        await db.commit()
+
+        log.info(
+            f"{cls_name(self)}: "
+            f"Reconciliation finished "
+            f"name:{self.name} "
+            f"added:{self.added} "
+            f"removed:{self.removed}"
+        )
+
+    async def add_missing(self, db, position, max_id):
+        while True:
+            cursor = await safe_db_execute(db, self.ids_page_sql, [position, max_id, self.page_size])
+            ids = [_id for (_id,) in await cursor.fetchall()]
+            if not ids:
+                return
+
+            indexed_ids = set(self.index_get(ids=[str(_id) for _id in ids]))
+            missing_ids = [_id for _id in ids if str(_id) not in indexed_ids]
+            if missing_ids:
+                placeholders = ",".join("?" * len(missing_ids))
+                cursor = await safe_db_execute(db, self.by_ids_sql.format(placeholders=placeholders), missing_ids)
+                rows = await cursor.fetchall()
+
+                for batch in group_list(rows, self.embedding_batch):
+                    _, embeddings = await self.create_embedding([row[-1] for row in batch])
+                    await self.index_add(batch, embeddings)
+                    self.added += len(batch)
+
+                    for row in batch:
+                        log.warning(
+                            f"{cls_name(self)}: "
+                            f"Created missing index "
+                            f"name:{self.name} "
+                            f"id:{row[0]}"
+                        )
+
+            position = ids[-1]
+            await self.save_checkpoint(db, "missing", position, max_id)
+            await asyncio.sleep(self.pause)
+
+    async def remove_zombies(self, db):
+        # Index entries above the committed max id may belong to the posts
+        # being saved right now
+        cursor = await safe_db_execute(db, self.max_id_sql)
+        (max_id,) = await cursor.fetchone()
+        max_id = max_id or 0
+
+        # Index can't be deleted from while paging it by offset, so zombies
+        # are collected first, that's why the phase is restarted on resume
+        zombie_ids = []
+        offset = 0
+        while True:
+            index_ids = self.index_get(limit=self.page_size, offset=offset)
+            if not index_ids:
+                break
+            offset += len(index_ids)
+
+            ids = [int(_id) for _id in index_ids if int(_id) <= max_id]
+            if ids:
+                placeholders = ",".join("?" * len(ids))
+                cursor = await safe_db_execute(db, self.by_ids_sql.format(placeholders=placeholders), ids)
+                db_ids = {row[0] for row in await cursor.fetchall()}
+                zombie_ids.extend(str(_id) for _id in ids if _id not in db_ids)
+
+            await asyncio.sleep(self.pause)
+
+        for ids in group_list(zombie_ids, self.page_size):
+            self.index_delete(ids)
+            self.removed += len(ids)
+
+        for _id in zombie_ids:
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Removed zombie index "
+                f"name:{self.name} "
+                f"id:{_id}"
+            )
+
+
+class PostsReconciler(IndexReconciler):
+    name = "posts"
+    count_sql = COUNT_ACCEPTED_POSTS
+    max_id_sql = GET_MAX_POST_ID
+    ids_page_sql = GET_ACCEPTED_POST_IDS_PAGE
+    by_ids_sql = GET_ACCEPTED_POSTS_BY_IDS
+
+    def index_get(self, ids=None, limit=None, offset=None) -> list:
+        return self.index.get_posts(ids=ids, limit=limit, offset=offset, include=[])["ids"]
+
+    async def index_add(self, rows, embeddings):
+        for (post_id, source, _), embedding in zip(rows, embeddings):
+            await self.index.insert_post(post_id=str(post_id), source=source, embedding=embedding)
+
+    def index_delete(self, ids):
+        self.index.remove_posts(ids=ids)
+
+
+class PromptsReconciler(IndexReconciler):
+    name = "prompts"
+    count_sql = COUNT_APPROVED_PROMPTS
+    max_id_sql = GET_MAX_PROMPT_ID
+    ids_page_sql = GET_APPROVED_PROMPT_IDS_PAGE
+    by_ids_sql = GET_APPROVED_PROMPTS_BY_IDS
+
+    async def index_add(self, rows, embeddings):
+        self.index.add(
+            embeddings=list(embeddings),
+            ids=[str(prompt_id) for (prompt_id, _) in rows]
+        )
+
+    def index_delete(self, ids):
+        self.index.delete(ids=ids)
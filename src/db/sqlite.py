@@ -6,6 +6,7 @@ import aiomisc
 import aiosqlite
 
 from common.logging import cls_name
+from common.startup import startup
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
@@ -60,6 +61,20 @@ GET_POST_BY_SOURCE = """
     WHERE source = ?
 """
 
+GET_PROCESSED_SOURCES = """
+    SELECT DISTINCT source
+    FROM posts
+    WHERE source IN ({placeholders})
+"""
+
+GET_RECENT_SOURCES = """
+    SELECT source
+    FROM posts
+    GROUP BY source
+    ORDER BY MAX(post_id) DESC
+    LIMIT ?
+"""
+
 GET_PROMPTS_FOR_PROCESSING = f"""
     SELECT original as prompt, prompt_id, user_id
     FROM prompts
@@ -67,7 +82,7 @@ GET_PROMPTS_FOR_PROCESSING = f"""
         AND active = 1
 """
 
-GET_POSTS_FOR_PROCESSING = """
+MATCHING_CTES = """
     WITH
     numbered_active_prompts AS (
         SELECT
@@ -100,7 +115,12 @@ GET_POSTS_FOR_PROCESSING = """
         WHERE posts.date > date('now','-{days} day') AND
               posts.status = 'accepted'
     )
+"""
 
+# Candidates of a page of prompts, ordered by prompt. The prompts of {new_params}
+# are matched against all recent posts, the rest of {params} only against the posts
+# after from post_id. Parameters: (*prompt ids, *new prompt ids, from post_id, to post_id)
+GET_POSTS_FOR_PROCESSING = MATCHING_CTES + """
     SELECT
         active_prompts.prompt_id,
         active_prompts.for_gpt3 as context_from_gpt4,
@@ -115,6 +135,9 @@ GET_POSTS_FOR_PROCESSING = """
         ON  recent_posts.post_id = users_posts.post_id AND
             active_prompts.prompt_id = users_posts.prompt_id
         WHERE (
+                active_prompts.prompt_id IN ({params}) AND
+                (active_prompts.prompt_id IN ({new_params}) OR recent_posts.post_id > ?) AND
+                recent_posts.post_id <= ? AND
                 users_posts.prompt_id IS NULL AND 
                 users_posts.post_id IS NULL AND 
                 TRIM(COALESCE(active_prompts.original, '')) <> '' AND 
@@ -122,7 +145,18 @@ GET_POSTS_FOR_PROCESSING = """
             )
         -- OR
         --     users_posts.process_status = 'index_approved'
-        ORDER BY recent_posts.post_id, active_prompts.user_id
+        ORDER BY active_prompts.prompt_id, recent_posts.post_id
+"""
+
+GET_ACTIVE_PROMPTS_FOR_MATCHING = MATCHING_CTES + """
+    SELECT prompt_id, original, for_gpt3
+    FROM active_prompts
+    ORDER BY prompt_id
+"""
+
+GET_MAX_POST_ID = """
+SELECT MAX(post_id)
+FROM posts
 """
 
 GET_POST_BY_PID = """
@@ -192,6 +226,62 @@ FROM prompts
 WHERE status != 'rejected' AND status IS NOT NULL
 """
 
+GET_ACCEPTED_POST_IDS_PAGE = """
+SELECT post_id
+FROM posts
+WHERE status <> 'rejected' AND post_id > ? AND post_id <= ?
+ORDER BY post_id
+LIMIT ?
+"""
+
+GET_ACCEPTED_POSTS_BY_IDS = """
+SELECT post_id, source, description
+FROM posts
+WHERE status <> 'rejected' AND post_id IN ({placeholders})
+"""
+
+GET_APPROVED_PROMPT_IDS_PAGE = """
+SELECT prompt_id
+FROM prompts
+WHERE status != 'rejected' AND status IS NOT NULL AND prompt_id > ? AND prompt_id <= ?
+ORDER BY prompt_id
+LIMIT ?
+"""
+
+GET_APPROVED_PROMPTS_BY_IDS = """
+SELECT prompt_id, for_index
+FROM prompts
+WHERE status != 'rejected' AND status IS NOT NULL AND prompt_id IN ({placeholders})
+"""
+
+GET_MAX_PROMPT_ID = """
+SELECT MAX(prompt_id)
+FROM prompts
+"""
+
+GET_RECONCILE_CHECKPOINT = """
+SELECT phase, position, max_id
+FROM reconcile_checkpoints
+WHERE name = ?
+"""
+
+SET_RECONCILE_CHECKPOINT = """
+INSERT
+INTO reconcile_checkpoints(name, phase, position, max_id, updated_at)
+VALUES(?,?,?,?,datetime('now'))
+ON CONFLICT(name) DO UPDATE
+SET phase = excluded.phase, 
+    position = excluded.position, 
+    max_id = excluded.max_id, 
+    updated_at = excluded.updated_at
+"""
+
+DELETE_RECONCILE_CHECKPOINT = """
+DELETE
+FROM reconcile_checkpoints
+WHERE name = ?
+"""
+
 POSTS_FOR_CLEAN = """
 SELECT post_id, status, date
 FROM posts 
@@ -240,6 +330,28 @@ PROMPTS_SET_FIRST_SEARCH_READY = """
     WHERE prompt_id = ?
 """
 
+GET_CHANNEL_SYNC = """
+SELECT last_message_id, deep_synced_at
+FROM channels_sync
+WHERE channel_id = ?
+"""
+
+SET_CHANNEL_LAST_MESSAGE_ID = """
+    INSERT 
+    INTO channels_sync(channel_id, last_message_id) 
+    VALUES(?,?)
+    ON CONFLICT(channel_id) DO UPDATE 
+    SET last_message_id = MAX(COALESCE(last_message_id, 0), excluded.last_message_id)
+"""
+
+SET_CHANNEL_DEEP_SYNCED = """
+    INSERT 
+    INTO channels_sync(channel_id, deep_synced_at) 
+    VALUES(?,?)
+    ON CONFLICT(channel_id) DO UPDATE 
+    SET deep_synced_at = excluded.deep_synced_at
+"""
+
 INSERT_OR_IGNORE_USER_POSTS = """
     INSERT OR IGNORE
     INTO users_posts(user_id, post_id, prompt_id, process_status, gpt_reason, index_distance)
@@ -313,6 +425,27 @@ class SQLLite3Service(aiomisc.Service):
             original_link TEXT,
             markdown_entities TEXT
         );        
+        
+        /* every fetched telegram message is looked up by source */
+        CREATE INDEX IF NOT EXISTS posts_source ON posts(source);
+        """
+
+    CREATE_RECONCILE_CHECKPOINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS reconcile_checkpoints(
+            name TEXT PRIMARY KEY, /* index being reconciled with db */
+            phase TEXT, /* missing, zombies */
+            position INTEGER, /* last db id checked */
+            max_id INTEGER, /* ids above are created after the pass started */
+            updated_at TEXT
+        );
+        """
+
+    CREATE_CHANNELS_SYNC_TABLE = """
+        CREATE TABLE IF NOT EXISTS channels_sync(
+            channel_id INTEGER PRIMARY KEY,
+            last_message_id INTEGER, /* high-water mark of processed messages */
+            deep_synced_at TEXT /* last walk back to the cutoff date */
+        );
         """
 
     #             CREATE TABLE IF NOT EXISTS jobs(
@@ -403,6 +536,8 @@ class SQLLite3Service(aiomisc.Service):
             await db.executescript(self.CREATE_POSTS_TABLE)
             await db.executescript(self.CREATE_USERS_POST_TABLE)
             await db.executescript(self.CREATE_PROMPTS_TABLE)
+            await db.executescript(self.CREATE_CHANNELS_SYNC_TABLE)
+            await db.executescript(self.CREATE_RECONCILE_CHECKPOINTS_TABLE)
 
             if self.add_test_prompts:
                 try:
@@ -420,6 +555,7 @@ class SQLLite3Service(aiomisc.Service):
             await db.commit()
 
         self.context["sqlite_ready"] = True
+        startup.ready(self)
 
     async def stop(self, *args, **kwargs):
         pass
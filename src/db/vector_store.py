@@ -0,0 +1,436 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from common.logging import cls_name
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class IDAlreadyExists(ValueError):
+    pass
+
+
+def match_where(metadata: dict, where: dict) -> bool:
+    """
+    Subset of Chroma metadata filters: $and, $or, $eq, $ne, $in, $nin,
+    $gt, $gte, $lt, $lte, and plain {"field": value} equality
+    """
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(match_where(metadata, sub) for sub in condition):
+                return False
+            continue
+
+        if key == "$or":
+            if not any(match_where(metadata, sub) for sub in condition):
+                return False
+            continue
+
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+
+        for op, operand in condition.items():
+            if op == "$eq":
+                ok = value == operand
+            elif op == "$ne":
+                ok = value != operand
+            elif op == "$in":
+                ok = value in operand
+            elif op == "$nin":
+                ok = value not in operand
+            elif op == "$gt":
+                ok = value is not None and value > operand
+            elif op == "$gte":
+                ok = value is not None and value >= operand
+            elif op == "$lt":
+                ok = value is not None and value < operand
+            elif op == "$lte":
+                ok = value is not None and value <= operand
+            else:
+                raise NotImplementedError(f"Unsupported where operator: {op}")
+
+            if not ok:
+                return False
+
+    return True
+
+
+class NumpyCollection:
+    """
+    In-process replacement for Chroma collection with cosine space, exposing
+    the subset of the Collection API we use (add, get, query, delete, peek, count).
+
+    Vectors are kept in a contiguous float32 matrix, memory-mapped from disk,
+    with a cache of the row norms and id -> row map. Deleting swaps the last
+    row into the freed one, so that the live rows are always [0, count).
+    Ids and metadata are persisted in an append-only journal, replayed on load.
+
+    All the methods take a lock, so the collection can be used from worker threads.
+    """
+
+    def __init__(self, path, name, dimension=None, initial_capacity=1024):
+        self.name = name
+        self._vectors_path = os.path.join(path, f"{name}.f32")
+        self._journal_path = os.path.join(path, f"{name}.journal")
+        self._lock = threading.RLock()
+
+        self._dimension = dimension
+        self._capacity = 0
+        self._count = 0
+        self._matrix = None
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._ids = []
+        self._metadatas = []
+        self._id_to_row = {}
+        self._journal = None
+
+        os.makedirs(path, exist_ok=True)
+        self._load(initial_capacity)
+
+    def _load(self, initial_capacity):
+        journal_lines = 0
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    try:
+                        entry = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # Torn write at the end of the journal, the rest is fine
+                        log.warning(f"{cls_name(self)}: Skipping corrupted journal entry, name:{self.name}")
+                        continue
+
+                    journal_lines += 1
+                    self._replay(entry)
+
+        if self._dimension and os.path.exists(self._vectors_path):
+            size = os.path.getsize(self._vectors_path) // (4 * self._dimension)
+            self._open_matrix(max(size, self._count, initial_capacity))
+        elif self._dimension:
+            self._open_matrix(initial_capacity)
+
+        if self._count:
+            self._norms = np.linalg.norm(self._matrix[:self._count], axis=1).astype(np.float32)
+
+        self._journal = open(self._journal_path, "a")
+        if journal_lines == 0 and self._dimension:
+            self._write({"op": "init", "dimension": self._dimension})
+        elif journal_lines > 2 * self._count + 100:
+            self._compact()
+
+        log.info(
+            f"{cls_name(self)}: "
+            f"Loaded collection "
+            f"name:{self.name} "
+            f"count:{self._count} "
+            f"dimension:{self._dimension}"
+        )
+
+    def _replay(self, entry):
+        op = entry["op"]
+        if op == "init":
+            self._dimension = entry["dimension"]
+        elif op == "add":
+            row = entry["row"]
+            while len(self._ids) <= row:
+                self._ids.append(None)
+                self._metadatas.append(None)
+            self._ids[row] = entry["id"]
+            self._metadatas[row] = entry.get("metadata")
+            self._id_to_row[entry["id"]] = row
+            self._count = max(self._count, row + 1)
+        elif op == "move":
+            # Row entry["from"] moved into entry["row"], the previous owner is deleted
+            row, from_row = entry["row"], entry["from"]
+            self._id_to_row.pop(self._ids[row], None)
+            self._ids[row] = self._ids[from_row]
+            self._metadatas[row] = self._metadatas[from_row]
+            self._id_to_row[self._ids[row]] = row
+            self._truncate(from_row)
+        elif op == "delete":
+            self._id_to_row.pop(self._ids[entry["row"]], None)
+            self._truncate(entry["row"])
+        else:
+            raise NotImplementedError(f"Unknown journal op: {op}")
+
+    def _truncate(self, row):
+        del self._ids[row:]
+        del self._metadatas[row:]
+        self._count = row
+
+    def _compact(self):
+        self._journal.close()
+        temp_path = self._journal_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(json.dumps({"op": "init", "dimension": self._dimension}) + "\n")
+            for row in range(self._count):
+                f.write(json.dumps({
+                    "op": "add",
+                    "row": row,
+                    "id": self._ids[row],
+                    "metadata": self._metadatas[row]
+                }) + "\n")
+        os.replace(temp_path, self._journal_path)
+        self._journal = open(self._journal_path, "a")
+
+    def _write(self, *entries):
+        for entry in entries:
+            self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
+    def _open_matrix(self, capacity):
+        if self._matrix is not None:
+            self._matrix.flush()
+            del self._matrix
+
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(capacity * self._dimension * 4)
+
+        self._capacity = capacity
+        self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r+",
+                                 shape=(capacity, self._dimension))
+
+    def _ensure_capacity(self, size):
+        if size <= self._capacity:
+            return
+        self._open_matrix(max(size, self._capacity * 2))
+
+    def _rows_for(self, ids=None, where=None):
+        if ids is not None:
+            rows = [self._id_to_row[_id] for _id in ids if _id in self._id_to_row]
+        else:
+            rows = list(range(self._count))
+
+        if where:
+            rows = [row for row in rows if match_where(self._metadatas[row] or {}, where)]
+
+        return np.asarray(rows, dtype=np.int64)
+
+    def _result(self, rows, include):
+        return {
+            "ids": [self._ids[row] for row in rows],
+            "embeddings": self._matrix[rows].tolist() if "embeddings" in include else None,
+            "metadatas": [self._metadatas[row] for row in rows] if "metadatas" in include else None,
+            "documents": [None for _ in rows] if "documents" in include else None,
+        }
+
+    def count(self):
+        with self._lock:
+            return self._count
+
+    def add(self, ids, embeddings, metadatas=None, documents=None):
+        if documents is not None:
+            raise NotImplementedError("documents are not stored")
+
+        with self._lock:
+            if len(set(ids)) != len(ids):
+                raise IDAlreadyExists(f"Duplicate ids in the batch: {ids}")
+            for _id in ids:
+                if _id in self._id_to_row:
+                    raise IDAlreadyExists(f"ID {_id} already exists")
+
+            vectors = np.asarray(embeddings, dtype=np.float32)
+            if vectors.ndim != 2:
+                raise ValueError("embeddings should be a list of vectors")
+
+            if self._dimension is None:
+                self._dimension = vectors.shape[1]
+                self._open_matrix(1024)
+                self._write({"op": "init", "dimension": self._dimension})
+
+            if vectors.shape[1] != self._dimension:
+                raise ValueError(f"Expected dimension {self._dimension}, got {vectors.shape[1]}")
+
+            start = self._count
+            self._ensure_capacity(start + len(ids))
+            self._matrix[start:start + len(ids)] = vectors
+            self._matrix.flush()
+            self._norms = np.concatenate([self._norms[:start], np.linalg.norm(vectors, axis=1)])
+
+            metadatas = metadatas or [None] * len(ids)
+            for n, (_id, metadata) in enumerate(zip(ids, metadatas)):
+                self._ids.append(_id)
+                self._metadatas.append(metadata)
+                self._id_to_row[_id] = start + n
+
+            self._count += len(ids)
+            self._write(*[
+                {"op": "add", "row": start + n, "id": _id, "metadata": metadata}
+                for n, (_id, metadata) in enumerate(zip(ids, metadatas))
+            ])
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("metadatas",)):
+        with self._lock:
+            rows = self._rows_for(ids, where)
+            if offset:
+                rows = rows[offset:]
+            if limit:
+                rows = rows[:limit]
+            return self._result(rows, include)
+
+    def peek(self, limit=10):
+        return self.get(limit=limit, include=("embeddings", "metadatas"))
+
+    def query(self, query_embeddings, n_results=10, where=None, include=("metadatas", "distances"), ids=None):
+        """
+        Cosine distance top-k. Besides Chroma-like `where`, candidates can be
+        restricted with `ids`, which is a row mask instead of metadata predicates.
+        """
+        with self._lock:
+            rows = self._rows_for(ids, where)
+            results = {
+                "ids": [],
+                "distances": [] if "distances" in include else None,
+                "metadatas": [] if "metadatas" in include else None,
+                "embeddings": [] if "embeddings" in include else None,
+                "documents": [] if "documents" in include else None,
+            }
+
+            queries = np.asarray(query_embeddings, dtype=np.float32)
+            if len(rows) == 0:
+                for key in results:
+                    if results[key] is not None:
+                        results[key] = [[] for _ in queries]
+                return results
+
+            candidates = self._matrix[rows]
+            candidate_norms = self._norms[rows]
+            query_norms = np.linalg.norm(queries, axis=1)
+
+            similarities = queries @ candidates.T
+            denominator = np.outer(query_norms, candidate_norms)
+            denominator[denominator == 0] = 1
+            distances = 1 - similarities / denominator
+
+            k = min(n_results, len(rows))
+            for query_distances in distances:
+                if k < len(rows):
+                    top = np.argpartition(query_distances, k - 1)[:k]
+                else:
+                    top = np.arange(len(rows))
+                top = top[np.argsort(query_distances[top], kind="stable")]
+
+                top_rows = rows[top]
+                partial = self._result(top_rows, include)
+                results["ids"].append(partial["ids"])
+                if results["distances"] is not None:
+                    results["distances"].append(query_distances[top].tolist())
+                for key in ["metadatas", "embeddings", "documents"]:
+                    if results[key] is not None:
+                        results[key].append(partial[key])
+
+            return results
+
+    def delete(self, ids=None, where=None):
+        with self._lock:
+            if ids is None and where is None:
+                raise ValueError("specify ids or where to delete")
+
+            # Delete from the bottom, so that swapped rows are always live ones
+            rows = sorted(self._rows_for(ids, where).tolist(), reverse=True)
+            for row in rows:
+                last = self._count - 1
+                self._id_to_row.pop(self._ids[row], None)
+
+                if row != last:
+                    self._matrix[row] = self._matrix[last]
+                    self._norms[row] = self._norms[last]
+                    self._ids[row] = self._ids[last]
+                    self._metadatas[row] = self._metadatas[last]
+                    self._id_to_row[self._ids[row]] = row
+                    self._write({"op": "move", "row": row, "from": last})
+                else:
+                    self._write({"op": "delete", "row": row})
+
+                self._truncate(last)
+                self._norms = self._norms[:last]
+
+            if rows:
+                self._matrix.flush()
+
+    def close(self):
+        with self._lock:
+            if self._matrix is not None:
+                self._matrix.flush()
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+
+
+class NumpyClient:
+    """
+    Holds NumpyCollection's in one directory, mimics the bits of Chroma client we use
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._collections = {}
+
+    def get_or_create_collection(self, name, dimension=None, **kwargs):
+        if name not in self._collections:
+            self._collections[name] = NumpyCollection(self.path, name, dimension=dimension)
+        return self._collections[name]
+
+    def delete_collection(self, name):
+        collection = self._collections.pop(name, None)
+        if collection:
+            collection.close()
+
+        existed = False
+        for suffix in [".f32", ".journal"]:
+            try:
+                os.remove(os.path.join(self.path, f"{name}{suffix}"))
+                existed = True
+            except FileNotFoundError:
+                pass
+
+        if not existed:
+            raise ValueError(f"Collection {name} does not exist")
+
+    def stop(self):
+        for collection in self._collections.values():
+            collection.close()
+
+
+def query_by_ids(collection, query_embeddings, ids, n_results=None, include=("metadatas", "distances")):
+    """
+    Top-k restricted to the given ids, NumpyCollection uses a row mask,
+    for Chroma we fall back to the "post_id" metadata predicates
+    """
+    n_results = n_results or len(ids)
+
+    if isinstance(collection, NumpyCollection):
+        return collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            include=list(include),
+            ids=[str(_id) for _id in ids]
+        )
+
+    if len(ids) == 1:
+        where = {"post_id": {"$eq": str(ids[0])}}
+    elif len(ids) > 1:
+        where = {
+            "$or": [
+                {"post_id": {"$eq": str(_id)}}
+                for _id in ids
+            ]
+        }
+    else:
+        raise ValueError(f"Unexpected number of ids: {len(ids)}")
+
+    return collection.query(
+        query_embeddings=query_embeddings,
+        n_results=n_results,
+        include=list(include),
+        where=where
+    )
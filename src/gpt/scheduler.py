@@ -0,0 +1,247 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from enum import IntEnum
+
+import aiomisc
+
+from common.logging import cls_name
+from common.startup import startup
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class Priority(IntEnum):
+    # User is waiting for the results of the search
+    FIRST_SEARCH = 0
+    # New posts from the channels, new posts<>prompts pairs
+    LIVE = 1
+    # Periodical channel sync, reconciliation, index repair
+    SYNC = 2
+
+
+_priority = contextvars.ContextVar("openai_priority", default=Priority.SYNC)
+
+
+@contextmanager
+def openai_priority(priority: Priority):
+    """
+    Sets priority of OpenAI requests made within the block, tasks created
+    inside inherit it
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def get_openai_priority() -> Priority:
+    return _priority.get()
+
+
+class Reservation:
+    def __init__(self, scheduler, model, entry):
+        self._scheduler = scheduler
+        self._model = model
+        self._entry = entry
+
+    def used(self, tokens):
+        """
+        Replaces the estimated tokens with the actually used ones
+        """
+        self._scheduler.correct(self._model, self._entry, tokens)
+
+
+class OpenAIScheduler(aiomisc.Service):
+    """
+    Single gate for all OpenAI requests. Requests and tokens of the last
+    minute are accounted per model, on estimate when the request is let
+    through and corrected by the actual usage afterwards. Waiting requests
+    are served by priority, and in the order of arrival within one priority.
+    """
+
+    # model: (requests per minute, tokens per minute)
+    limits = {
+        "gpt-3.5-turbo-0613": (60, 90_000),
+        "gpt-3.5-turbo-16k-0613": (60, 180_000),
+        "gpt-4-0613": (20, 10_000),
+        "text-embedding-ada-002": (60, 1_000_000),
+    }
+    default_limits = (20, 40_000)
+    window = 60
+
+    stats_period = 60
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._windows = {}
+        self._queues = {}
+        self._timers = {}
+        self._counter = itertools.count()
+
+        self._requests = {priority: 0 for priority in Priority}
+        self._tokens = {priority: 0 for priority in Priority}
+        self._wait_total = {priority: 0.0 for priority in Priority}
+        self._wait_max = {priority: 0.0 for priority in Priority}
+
+    def get_limits(self, model):
+        return self.limits.get(model, self.default_limits)
+
+    def _window(self, model):
+        entries = self._windows.setdefault(model, deque())
+        cutoff = time.monotonic() - self.window
+        while entries and entries[0][0] <= cutoff:
+            entries.popleft()
+        return entries
+
+    def _has_budget(self, model, tokens):
+        rpm, tpm = self.get_limits(model)
+        entries = self._window(model)
+        if len(entries) >= rpm:
+            return False
+
+        # Request bigger than the whole budget is let through on the empty window
+        used_tokens = sum(entry[1] for entry in entries)
+        return not entries or used_tokens + tokens <= tpm
+
+    def _dispatch(self, model):
+        self._timers.pop(model, None)
+        queue = self._queues.get(model, [])
+
+        while queue:
+            (priority, _, tokens, enqueued_at, future) = queue[0]
+            if future.done():
+                # Cancelled while waiting
+                heapq.heappop(queue)
+                continue
+
+            if not self._has_budget(model, tokens):
+                break
+
+            heapq.heappop(queue)
+            entry = [time.monotonic(), tokens, Priority(priority)]
+            self._windows[model].append(entry)
+            future.set_result((entry, time.monotonic() - enqueued_at))
+
+        if queue and model not in self._timers:
+            # Retry once the oldest request leaves the window
+            entries = self._window(model)
+            delay = max(0.05, entries[0][0] + self.window - time.monotonic()) if entries else 0.05
+            self._timers[model] = asyncio.get_running_loop().call_later(delay, self._dispatch, model)
+
+    async def acquire(self, model, tokens, priority=None) -> Reservation:
+        priority = get_openai_priority() if priority is None else priority
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(
+            self._queues.setdefault(model, []),
+            (int(priority), next(self._counter), tokens, time.monotonic(), future)
+        )
+
+        self._dispatch(model)
+        try:
+            entry, waited = await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+        self._requests[priority] += 1
+        self._tokens[priority] += tokens
+        self._wait_total[priority] += waited
+        self._wait_max[priority] = max(self._wait_max[priority], waited)
+
+        if waited > 5:
+            log.debug(
+                f"{cls_name(self)}: "
+                f"Request waited for OpenAI budget "
+                f"model:{model} "
+                f"priority:{priority.name} "
+                f"waited:{waited:.1f}s"
+            )
+
+        return Reservation(self, model, entry)
+
+    def correct(self, model, entry, tokens):
+        (_, estimated_tokens, priority) = entry
+        self._tokens[priority] += tokens - estimated_tokens
+        entry[1] = tokens
+        # Less tokens than estimated could unblock someone
+        self._dispatch(model)
+
+    def slot(self, model, tokens, priority=None):
+        """
+        async with scheduler.slot(model, estimated_tokens) as reservation:
+            response = await openai...
+            reservation.used(response["usage"]["total_tokens"])
+        """
+        return _Slot(self, model, tokens, priority)
+
+    def queue_depth(self):
+        depth = {priority.name: 0 for priority in Priority}
+        for queue in self._queues.values():
+            for (priority, _, _, _, future) in queue:
+                if not future.done():
+                    depth[Priority(priority).name] += 1
+        return depth
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "requests": {priority.name: self._requests[priority] for priority in Priority},
+            "tokens": {priority.name: self._tokens[priority] for priority in Priority},
+            "avg_wait": {
+                priority.name: round(self._wait_total[priority] / self._requests[priority], 2)
+                if self._requests[priority] else 0.0
+                for priority in Priority
+            },
+            "max_wait": {priority.name: round(self._wait_max[priority], 2) for priority in Priority},
+        }
+
+    async def start(self):
+        log.info(f"{cls_name(self)}: Start service")
+        self.context["openai_scheduler"] = self
+        self.start_event.set()
+        startup.ready(self)
+
+        while True:
+            await asyncio.sleep(self.stats_period)
+            stats = self.stats()
+            if not any(stats["requests"].values()) and not any(stats["queue_depth"].values()):
+                continue
+
+            log.info(
+                f"{cls_name(self)}: "
+                f"OpenAI requests "
+                f"queue_depth:{stats['queue_depth']} "
+                f"requests:{stats['requests']} "
+                f"tokens:{stats['tokens']} "
+                f"avg_wait:{stats['avg_wait']} "
+                f"max_wait:{stats['max_wait']}"
+            )
+
+    async def stop(self, *args, **kwargs):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+
+class _Slot:
+    def __init__(self, scheduler, model, tokens, priority):
+        self._scheduler = scheduler
+        self._model = model
+        self._tokens = tokens
+        self._priority = priority
+
+    async def __aenter__(self) -> Reservation:
+        return await self._scheduler.acquire(self._model, self._tokens, self._priority)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
@@ -17,3 +17,19 @@ schema = {
     },
     "required": ["user_requirements", "reason", "score"],
 }
+
+# Response on several numbered job postings at once, one item per posting
+batch_schema = {
+    "type": "array",
+    "minItems": 1,
+    "items": {
+        **schema,
+        "properties": {
+            **schema["properties"],
+            "post": {
+                "type": "integer"
+            },
+        },
+        "required": ["post", *schema["required"]],
+    },
+}
@@ -1,3 +1,5 @@
+from common.startup import startup
+
 import os
 
 import sentry_sdk
@@ -19,6 +21,7 @@ from common.telegram import WaitOnFloodTelegramClient, remove_posts_from_channel
 from aiomisc import get_context
 from db.embedding import EmbeddingDB
 from db.sqlite import GET_ACCEPTED_POSTS, SQLLite3Service
+from gpt.scheduler import OpenAIScheduler
 
 import asyncio
 import logging
@@ -26,6 +29,8 @@ import aiomisc
 import aiosqlite
 from pyee import AsyncIOEventEmitter
 
+startup.mark("imports")
+
 FORMAT = "[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -111,36 +116,44 @@ log.info(
 
 emitter = AsyncIOEventEmitter()
 
+services = [
+    OpenAIScheduler(),
+    SQLLite3Service(
+        environment=os.getenv("ENV"),
+        # drop_user_posts=True,
+        # drop_prompts=True,
+        # add_test_posts=True,
+        # add_test_prompts=True,
+    ),
+    EmbeddingDB(
+        environment=os.getenv("ENV"),
+        # recreate_prompts=True,
+    ),
+    SetupTelegramSession(),
+    TelegramBot(
+        api_key=os.getenv("TELEGRAM_BOT_API_KEY"),
+        emitter=emitter,
+    ),
+    PostManager(
+        api_key=os.getenv("HELPER_BOT"),
+        emitter=emitter,
+    ),
+    PromptTranslate(emitter=emitter),
+    JobDescriptionsCheck(emitter=emitter),
+    JobPostingParser(),
+    Preprocessing(channel_sync_period=channel_sync_period),
+]
+# Report is logged once all of them are ready
+startup.track(*services)
+
 try:
     with aiomisc.entrypoint(
-            SQLLite3Service(
-                environment=os.getenv("ENV"),
-                # drop_user_posts=True,
-                # drop_prompts=True,
-                # add_test_posts=True,
-                # add_test_prompts=True,
-            ),
-            EmbeddingDB(
-                environment=os.getenv("ENV"),
-                # recreate_prompts=True,
-            ),
-            SetupTelegramSession(),
-            TelegramBot(
-                api_key=os.getenv("TELEGRAM_BOT_API_KEY"),
-                emitter=emitter,
-            ),
-            PostManager(
-                api_key=os.getenv("HELPER_BOT"),
-                emitter=emitter,
-            ),
-            PromptTranslate(emitter=emitter),
-            JobDescriptionsCheck(emitter=emitter),
-            JobPostingParser(),
-            Preprocessing(channel_sync_period=channel_sync_period),
+            *services,
             log_level="info",
             log_format="color",
             log_buffer_size=10,
     ) as loop:
+        startup.mark("services")
         log.info("Started services")
         loop.run_forever()
 except KeyboardInterrupt as e:
@@ -0,0 +1,87 @@
+"""
+Compares grouping of posts<>prompt pairs with and without pandas on
+synthetic rows, shaped like the rows produced by JobDescriptionsCheck.
+
+    python -m matching.bench_grouping --sizes 1000 10000 100000 1000000
+"""
+import argparse
+import random
+import time
+
+from matching.utils import group_user_data_for_index, group_user_data_for_gpt_check, \
+    group_user_data_for_index_pandas, group_user_data_for_gpt_check_pandas
+
+PROCESS_STATUSES = ["index_approved", "rejected", "accepted"]
+
+
+def make_rows(num_pairs, posts_per_prompt=1000, seed=0):
+    rnd = random.Random(seed)
+    num_prompts = max(1, num_pairs // posts_per_prompt)
+
+    prompts = [
+        {
+            "user_id": prompt_id + 1000,
+            "prompt_id": prompt_id,
+            "original_user_request": f"original request {prompt_id}",
+            "context_from_gpt4": f"context from gpt4 {prompt_id}",
+            "prompt_status": rnd.choice(["approved", "first_search_done"]),
+        }
+        for prompt_id in range(num_prompts)
+    ]
+
+    rows = []
+    for n in range(num_pairs):
+        prompt = prompts[n % num_prompts]
+        rows.append({
+            **prompt,
+            "post_id": n // num_prompts,
+            "process_status": rnd.choice(PROCESS_STATUSES),
+            "index_distance": rnd.random(),
+        })
+
+    rnd.shuffle(rows)
+    return rows
+
+
+def measure(func, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = list(func(rows))
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--posts-per-prompt", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'pairs':>10} {'function':<30} {'python, s':>10} {'pandas, s':>10} {'speedup':>8}")
+    for size in args.sizes:
+        rows = make_rows(size, posts_per_prompt=args.posts_per_prompt)
+
+        for name, func, reference in [
+            ("group_user_data_for_index", group_user_data_for_index, group_user_data_for_index_pandas),
+            ("group_user_data_for_gpt_check", group_user_data_for_gpt_check, group_user_data_for_gpt_check_pandas),
+        ]:
+            elapsed, result = measure(func, rows, args.repeat)
+            reference_elapsed, reference_result = measure(reference, rows, args.repeat)
+
+            if result != reference_result:
+                raise AssertionError(f"{name}: results differ from pandas implementation, pairs:{size}")
+
+            print(
+                f"{size:>10} "
+                f"{name:<30} "
+                f"{elapsed:>10.4f} "
+                f"{reference_elapsed:>10.4f} "
+                f"{reference_elapsed / elapsed:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,40 +3,84 @@ import json
 import logging
 import math
 import sqlite3
+import time
 from pprint import pprint
+from typing import TYPE_CHECKING
 
 import aiomisc
 import aiosqlite
 import numpy as np
 import openai
-from aiolimiter import AsyncLimiter
 from aiomisc import get_context
-from chromadb.api.models.Collection import Collection
-from jsonschema import validate
+from jsonschema import validate, ValidationError
 from pyee import AsyncIOEventEmitter
 from telethon.sync import TelegramClient
 
 from common.db import safe_db_execute
+from common.exceptions import CorruptedAIResponse
 from common.logging import cls_name, shorten_text
-from common.utils import get_prompt
+from common.startup import startup
+from common.utils import get_prompt, get_prompt_version, get_prompt_tokens, group_list
 from db.sqlite import INSERT_OR_IGNORE_USER_POSTS, SQLLite3Service, GET_POSTS_FOR_PROCESSING, GET_POST_BY_PID, \
-    GET_PROMPT_BASE_DISTANCE, SET_PROMPT_BASE_DISTANCE, PROMPTS_SET_FIRST_SEARCH_READY
-from gpt.schemas.filter import schema as filter_schema
-from matching.utils import group_user_data_for_gpt_check, group_user_data_for_index
+    GET_PROMPT_BASE_DISTANCE, SET_PROMPT_BASE_DISTANCE, PROMPTS_SET_FIRST_SEARCH_READY, \
+    GET_ACTIVE_PROMPTS_FOR_MATCHING, GET_MAX_POST_ID
+from db.batching import estimate_tokens
+from db.cache import GptResponseCache, cache_db_path
+from db.vector_store import query_by_ids
+from gpt.scheduler import OpenAIScheduler, Priority, openai_priority, get_openai_priority
+from gpt.schemas.filter import schema as filter_schema, batch_schema as filter_batch_schema
+from matching.utils import group_user_data_for_gpt_check, group_user_data_for_index, normalize_rows, \
+    cosine_distances, count_index_approved
 from preprocessing.post_sourser import CUTFOFF_DAYS
 
+if TYPE_CHECKING:
+    from chromadb.api.models.Collection import Collection
+
 log = logging.getLogger(__name__)
 
 
 class JobDescriptionsCheck(aiomisc.Service):
     emitter: AsyncIOEventEmitter = None
-    rate_limit: AsyncLimiter = None
+    scheduler: OpenAIScheduler = None
     client: TelegramClient = None
 
-    index_posts: Collection = None
-    index_prompts: Collection = None
+    index_posts: "Collection" = None
+    index_prompts: "Collection" = None
     lock: asyncio.Lock = None
 
+    # Score all posts<>prompts pairs with matrix multiplications instead of query per prompt
+    batched_index_check = True
+    max_scoring_cells = 10_000_000
+
+    # Incremental matching: only new posts and new / changed prompts are evaluated,
+    # the full cross product is scanned on start and periodically as reconciliation
+    reconcile_every = 60 * 30
+    last_post_id: int = None
+    prompt_fingerprints: dict = None
+    last_full_scan: float = None
+    fetch_page_size = 1000
+    # Prompts scored against the posts in one matrix, bounds the rows held in memory
+    prompts_page_size = 50
+
+    # Pack several index approved posts of the same prompt into one GPT request
+    batched_gpt_check = True
+    gpt_batch_max_posts = 8
+    # Reserved for the answer on the single post check, and on every post in the batch
+    gpt_check_answer_tokens = 150
+    gpt_batch_answer_tokens = 200
+    gpt_context_tokens = {
+        "gpt-3.5-turbo-0613": 4096,
+        "gpt-3.5-turbo-16k-0613": 16384,
+    }
+    gpt_accept_score = 90
+
+    # Verdicts on the same post text, user request, model and filter prompt are reused
+    use_gpt_cache = True
+    gpt_cache: GptResponseCache = None
+    gpt_calls = 0
+    gpt_cached = 0
+    gpt_tokens = 0
+
     @aiomisc.asyncbackoff(
         attempt_timeout=30,
         deadline=60,
@@ -60,42 +104,189 @@ class JobDescriptionsCheck(aiomisc.Service):
             # safety check
             raise NotImplementedError
 
-        async with self.rate_limit:
+        messages = [
+            {
+                "role": "system",
+                "content": get_prompt("filter.txt"),
+            },
+            {
+                "role": "user",
+                "content": f"Job description / posting:\n"
+                           f"{text}\n\n"
+                           f"Original user search request:\n"
+                           f"{original_user_request}\n\n"
+                           f"Explanation of user search request:\n "
+                           f"{context_from_gpt4}"
+            }
+        ]
+        num_tokens = sum(estimate_tokens(message["content"]) for message in messages) + self.gpt_check_answer_tokens
+
+        async with self.scheduler.slot(model, num_tokens) as reservation:
             chat_completions = await openai.ChatCompletion.acreate(
                 model=model,
                 temperature=0,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": get_prompt("filter.txt"),
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Job description / posting:\n"
-                                   f"{text}\n\n"
-                                   f"Original user search request:\n"
-                                   f"{original_user_request}\n\n"
-                                   f"Explanation of user search request:\n "
-                                   f"{context_from_gpt4}"
-                    }
-                ]
+                messages=messages
             )
 
             tokens_used = chat_completions['usage']['total_tokens']
+            reservation.used(tokens_used)
             response = json.loads(chat_completions['choices'][0]['message']["content"])
             validate(response, filter_schema)
-            return tokens_used, response["score"] >= 90, response.get("reason", "")
+            return tokens_used, response["score"], response.get("reason", "")
 
-    async def do_gpt_check(self, db, rows, post_id, context_from_gpt4, original_user_request, prompt_id, index_distance,
-                           user_id,
-                           model="gpt-3.5-turbo-0613"):
+    @aiomisc.asyncbackoff(
+        attempt_timeout=60,
+        deadline=120,
+        pause=2,
+        max_tries=20,
+        exceptions=(
+                openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError,
+        )
+    )
+    async def gpt_check_batch(self, texts, context_from_gpt4, original_user_request, model="gpt-3.5-turbo-0613"):
+        """
+        Checks several job postings against the same search request in one
+        request, returns (score, reason) in the order of texts
+        """
+        if not context_from_gpt4 and len(context_from_gpt4.strip()) == 0:
+            # safety check
+            raise NotImplementedError
+
+        if not original_user_request and len(original_user_request.strip()) == 0:
+            # safety check
+            raise NotImplementedError
+
+        postings = "\n\n".join(f"[{n}]\n{text}" for n, text in enumerate(texts, start=1))
+
+        messages = [
+            {
+                "role": "system",
+                "content": get_prompt("filter_batch.txt"),
+            },
+            {
+                "role": "user",
+                "content": f"Job descriptions / postings:\n"
+                           f"{postings}\n\n"
+                           f"Original user search request:\n"
+                           f"{original_user_request}\n\n"
+                           f"Explanation of user search request:\n "
+                           f"{context_from_gpt4}"
+            }
+        ]
+        num_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        num_tokens += self.gpt_batch_answer_tokens * len(texts)
+
+        async with self.scheduler.slot(model, num_tokens) as reservation:
+            chat_completions = await openai.ChatCompletion.acreate(
+                model=model,
+                temperature=0,
+                messages=messages
+            )
+            tokens_used = chat_completions['usage']['total_tokens']
+            reservation.used(tokens_used)
+        choice = chat_completions['choices'][0]
+        if choice.get("finish_reason") == "length":
+            raise CorruptedAIResponse("response has been cut by the token limit")
+
+        response = json.loads(choice['message']["content"])
+        validate(response, filter_batch_schema)
+
+        verdicts = {item["post"]: item for item in response}
+        if len(verdicts) != len(response) or sorted(verdicts.keys()) != list(range(1, len(texts) + 1)):
+            raise CorruptedAIResponse(
+                f"expected one verdict on each of posts 1..{len(texts)}, "
+                f"received on {sorted(item['post'] for item in response)}"
+            )
+
+        return tokens_used, [
+            (verdicts[n]["score"], verdicts[n].get("reason", ""))
+            for n in range(1, len(texts) + 1)
+        ]
+
+    async def get_post_text(self, db, post_id):
         cursor = await safe_db_execute(db, GET_POST_BY_PID, [post_id])
         row = await cursor.fetchone()
         if not row: raise NotImplementedError()
         (post_text,) = row
+        return post_text
+
+    async def do_gpt_check(self, db, rows, post_id, context_from_gpt4, original_user_request, prompt_id, index_distance,
+                           user_id,
+                           model="gpt-3.5-turbo-0613",
+                           post_text=None):
+        # Callers passing the text have looked it up in the cache already
+        verdict = None
+        if post_text is None:
+            post_text = await self.get_post_text(db, post_id)
+            verdict = await self.get_cached_verdict(post_text, context_from_gpt4, original_user_request, model)
+
+        if verdict:
+            score, reason = verdict
+        else:
+            tokens_used, score, reason = await self.gpt_check(post_text, context_from_gpt4, original_user_request,
+                                                              model=model)
+            self.gpt_calls += 1
+            self.gpt_tokens += tokens_used
+            await self.cache_verdict(post_text, context_from_gpt4, original_user_request, model,
+                                     score, reason, tokens_used)
+
+        return await self.save_gpt_verdict(
+            db=db,
+            rows=rows,
+            post_id=post_id,
+            post_text=post_text,
+            context_from_gpt4=context_from_gpt4,
+            original_user_request=original_user_request,
+            prompt_id=prompt_id,
+            index_distance=index_distance,
+            user_id=user_id,
+            is_gpt_accepted=score >= self.gpt_accept_score,
+            reason=reason,
+        )
+
+    def verdict_key(self, post_text, context_from_gpt4, original_user_request, model):
+        return GptResponseCache.key(
+            "filter",
+            model,
+            get_prompt_version("filter.txt", "filter_batch.txt"),
+            post_text,
+            original_user_request,
+            context_from_gpt4,
+        )
 
-        _, is_gpt_accepted, reason = await self.gpt_check(post_text, context_from_gpt4, original_user_request,
-                                                          model=model)
+    async def get_cached_verdict(self, post_text, context_from_gpt4, original_user_request, model):
+        """
+        Returns (score, reason) of the same check made before, or None
+        """
+        if not self.gpt_cache:
+            return None
+
+        cached = await self.gpt_cache.get(
+            self.verdict_key(post_text, context_from_gpt4, original_user_request, model)
+        )
+        if not cached or cached["score"] is None:
+            return None
+
+        self.gpt_cached += 1
+        return cached["score"], cached["reason"] or ""
+
+    async def cache_verdict(self, post_text, context_from_gpt4, original_user_request, model, score, reason,
+                            tokens_used):
+        if not self.gpt_cache:
+            return
+
+        await self.gpt_cache.put(
+            self.verdict_key(post_text, context_from_gpt4, original_user_request, model),
+            kind="filter",
+            model=model,
+            tokens=tokens_used,
+            score=score,
+            reason=reason,
+        )
+
+    async def save_gpt_verdict(self, db, rows, post_id, post_text, context_from_gpt4, original_user_request, prompt_id,
+                               index_distance, user_id, is_gpt_accepted, reason):
         reason = reason.capitalize()
 
         rows[(post_id, prompt_id)]["process_status"] = "accepted" if is_gpt_accepted else "rejected"
@@ -135,21 +326,289 @@ class JobDescriptionsCheck(aiomisc.Service):
 
         return is_gpt_accepted
 
-    async def find_matching_posts(self, db):
-        rows = {
-            (row[4], row[0]): {
-                "prompt_id": row[0],
-                "context_from_gpt4": row[1],
-                "original_user_request": row[2],
-                "prompt_status": row[3],
-                "post_id": row[4],
-                "user_id": row[5],
-                "process_status": row[6],
-                "index_distance": row[7],
-            } async for row in await safe_db_execute(db, GET_POSTS_FOR_PROCESSING.format(days=CUTFOFF_DAYS))
+    def pack_gpt_batches(self, posts, context_from_gpt4, original_user_request, model):
+        """
+        Splits (post_id, index_distance, text) into batches, which fit into the
+        model context together with the prompt and the expected answers
+        """
+        budget = self.gpt_context_tokens.get(model, 4096) - get_prompt_tokens("filter_batch.txt") - estimate_tokens(
+            original_user_request + context_from_gpt4
+        )
+
+        batches, batch, batch_tokens = [], [], 0
+        for post in posts:
+            (_, _, text) = post
+            num_tokens = estimate_tokens(text) + self.gpt_batch_answer_tokens
+
+            if batch and (batch_tokens + num_tokens > budget or len(batch) >= self.gpt_batch_max_posts):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+
+            batch.append(post)
+            batch_tokens += num_tokens
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    async def do_gpt_check_batch(self, db, rows, posts, context_from_gpt4, original_user_request, prompt_id, user_id,
+                                 model="gpt-3.5-turbo-0613"):
+        """
+        Checks (post_id, index_distance, text) in one request, falls back on
+        the check post by post if the response is malformed
+        """
+        verdicts = None
+        if len(posts) > 1:
+            try:
+                verdicts = await self.gpt_check_batch(
+                    [text for (_, _, text) in posts],
+                    context_from_gpt4,
+                    original_user_request,
+                    model=model
+                )
+            except (json.decoder.JSONDecodeError, ValidationError, CorruptedAIResponse) as e:
+                log.warning(
+                    f"{cls_name(self)} "
+                    f"Malformed batch GPT response, checking posts one by one "
+                    f"prid:{prompt_id} "
+                    f"num_posts:{len(posts)} "
+                    f"err:{shorten_text(str(e))}"
+                )
+
+        if verdicts is None:
+            return list(await asyncio.gather(*[
+                self.do_gpt_check(
+                    db=db,
+                    rows=rows,
+                    post_id=post_id,
+                    context_from_gpt4=context_from_gpt4,
+                    original_user_request=original_user_request,
+                    prompt_id=prompt_id,
+                    index_distance=index_distance,
+                    user_id=user_id,
+                    model=model,
+                    post_text=text,
+                )
+                for (post_id, index_distance, text) in posts
+            ]))
+
+        tokens_used, verdicts = verdicts
+        self.gpt_calls += 1
+        self.gpt_tokens += tokens_used
+
+        log.debug(
+            f"{cls_name(self)} "
+            f"Batch GPT check "
+            f"prid:{prompt_id} "
+            f"num_posts:{len(posts)} "
+            f"tokens_used:{tokens_used}"
+        )
+
+        for ((_, _, text), (score, reason)) in zip(posts, verdicts):
+            await self.cache_verdict(text, context_from_gpt4, original_user_request, model,
+                                     score, reason, tokens_used // len(posts))
+
+        return [
+            await self.save_gpt_verdict(
+                db=db,
+                rows=rows,
+                post_id=post_id,
+                post_text=text,
+                context_from_gpt4=context_from_gpt4,
+                original_user_request=original_user_request,
+                prompt_id=prompt_id,
+                index_distance=index_distance,
+                user_id=user_id,
+                is_gpt_accepted=score >= self.gpt_accept_score,
+                reason=reason,
+            )
+            for ((post_id, index_distance, text), (score, reason)) in zip(posts, verdicts)
+        ]
+
+    async def do_gpt_checks(self, db, rows, posts, context_from_gpt4, original_user_request, prompt_id, user_id,
+                            model="gpt-3.5-turbo-0613"):
+        """
+        Runs GPT check on (post_id, index_distance) of the same prompt, returns verdicts in the same order
+        """
+        if not self.batched_gpt_check:
+            return await asyncio.gather(*[
+                self.do_gpt_check(
+                    db=db,
+                    rows=rows,
+                    post_id=post_id,
+                    context_from_gpt4=context_from_gpt4,
+                    original_user_request=original_user_request,
+                    prompt_id=prompt_id,
+                    index_distance=index_distance,
+                    user_id=user_id,
+                    model=model
+                )
+                for (post_id, index_distance) in posts
+            ])
+
+        verdicts = {}
+        uncached_posts = []
+        for (post_id, index_distance) in posts:
+            post_text = await self.get_post_text(db, post_id)
+
+            verdict = await self.get_cached_verdict(post_text, context_from_gpt4, original_user_request, model)
+            if not verdict:
+                uncached_posts.append((post_id, index_distance, post_text))
+                continue
+
+            score, reason = verdict
+            verdicts[post_id] = await self.save_gpt_verdict(
+                db=db,
+                rows=rows,
+                post_id=post_id,
+                post_text=post_text,
+                context_from_gpt4=context_from_gpt4,
+                original_user_request=original_user_request,
+                prompt_id=prompt_id,
+                index_distance=index_distance,
+                user_id=user_id,
+                is_gpt_accepted=score >= self.gpt_accept_score,
+                reason=reason,
+            )
+
+        batches = self.pack_gpt_batches(uncached_posts, context_from_gpt4, original_user_request, model)
+        results = await asyncio.gather(*[
+            self.do_gpt_check_batch(
+                db=db,
+                rows=rows,
+                posts=batch,
+                context_from_gpt4=context_from_gpt4,
+                original_user_request=original_user_request,
+                prompt_id=prompt_id,
+                user_id=user_id,
+                model=model
+            )
+            for batch in batches
+        ])
+
+        for batch, batch_results in zip(batches, results):
+            for ((post_id, _, _), is_gpt_accepted) in zip(batch, batch_results):
+                verdicts[post_id] = is_gpt_accepted
+
+        return [verdicts[post_id] for (post_id, _) in posts]
+
+    def is_reconciliation_due(self):
+        if self.last_post_id is None or self.last_full_scan is None:
+            return True
+        return time.monotonic() - self.last_full_scan >= self.reconcile_every
+
+    async def get_matching_state(self, db):
+        """
+        Returns the latest post id and the fingerprints of the active prompts
+        """
+        cursor = await safe_db_execute(db, GET_MAX_POST_ID)
+        (max_post_id,) = await cursor.fetchone()
+
+        fingerprints = {
+            prompt_id: hash((original, for_gpt3))
+            async for (prompt_id, original, for_gpt3) in await safe_db_execute(
+                db, GET_ACTIVE_PROMPTS_FOR_MATCHING.format(days=CUTFOFF_DAYS)
+            )
         }
+        return max_post_id or 0, fingerprints
 
-        if len(rows) == 0:
+    async def iter_prompt_pages(self, db, max_post_id, fingerprints, full_scan):
+        """
+        Yields unprocessed posts<>prompts pairs a page of prompts at a time, so that
+        only prompts_page_size prompt groups are held in memory, and the prompts of
+        the page are scored together. Every page is read completely before it is
+        yielded, so no cursor stays open during the processing.
+        """
+        # New / changed prompts are checked against all recent posts,
+        # the rest only against the posts which appeared after the last pass
+        prompt_ids, new_prompt_ids = [], set()
+        for prompt_id, fingerprint in fingerprints.items():
+            if full_scan or self.prompt_fingerprints.get(prompt_id) != fingerprint:
+                new_prompt_ids.add(prompt_id)
+            elif self.last_post_id >= max_post_id:
+                continue
+            prompt_ids.append(prompt_id)
+
+        for page_ids in group_list(prompt_ids, self.prompts_page_size):
+            page_new_ids = [prompt_id for prompt_id in page_ids if prompt_id in new_prompt_ids]
+            cursor = await safe_db_execute(
+                db, GET_POSTS_FOR_PROCESSING.format(
+                    days=CUTFOFF_DAYS,
+                    params=",".join("?" * len(page_ids)),
+                    new_params=",".join("?" * len(page_new_ids)),
+                ), [
+                    *page_ids,
+                    *page_new_ids,
+                    self.last_post_id or 0,
+                    max_post_id,
+                ]
+            )
+
+            rows = {}
+            # Prompt texts are shared between the rows of the prompt
+            headers = {}
+            while True:
+                page = await cursor.fetchmany(self.fetch_page_size)
+                if not page:
+                    break
+
+                for row in page:
+                    (prompt_id, context_from_gpt4, original_user_request, prompt_status) = headers.setdefault(
+                        row[0], row[:4]
+                    )
+
+                    rows[(row[4], prompt_id)] = {
+                        "prompt_id": prompt_id,
+                        "context_from_gpt4": context_from_gpt4,
+                        "original_user_request": original_user_request,
+                        "prompt_status": prompt_status,
+                        "post_id": row[4],
+                        "user_id": row[5],
+                        "process_status": row[6],
+                        "index_distance": row[7],
+                    }
+            await cursor.close()
+
+            if rows:
+                yield rows
+
+    async def find_matching_posts(self, db, full_scan=True):
+        post_embeddings = {}
+        num_pairs, num_prompts = 0, 0
+        gpt_calls, gpt_cached, gpt_tokens = self.gpt_calls, self.gpt_cached, self.gpt_tokens
+
+        (max_post_id, fingerprints) = await self.get_matching_state(db)
+        unscored_prompts = set()
+        async for rows in self.iter_prompt_pages(db, max_post_id, fingerprints, full_scan):
+            if num_prompts == 0:
+                log.info(
+                    f"{cls_name(self)} "
+                    f"Processing posts<>prompt pairs "
+                    f"mode:{'full' if full_scan else 'incremental'}"
+                )
+
+            num_pairs += len(rows)
+            num_prompts += len({prompt_id for (_, prompt_id) in rows})
+            with openai_priority(Priority.SYNC if full_scan else Priority.LIVE):
+                unscored_prompts |= await self.process_prompt_page(db, rows, post_embeddings)
+
+        if unscored_prompts:
+            log.warning(
+                f"{cls_name(self)} "
+                f"Some pairs weren't scored by index, retrying on the next pass "
+                f"prompt_ids:{sorted(unscored_prompts)}"
+            )
+
+        # Prompts with unscored pairs aren't recorded as processed, so they are
+        # matched against all recent posts again, the pairs in users_posts are skipped
+        self.save_watermark(max_post_id, {
+            prompt_id: fingerprint
+            for prompt_id, fingerprint in fingerprints.items()
+            if prompt_id not in unscored_prompts
+        }, full_scan)
+
+        if num_prompts == 0:
             log.debug(
                 f"{cls_name(self)} "
                 f"Skipping, no posts<>prompt pairs for filtering"
@@ -158,12 +617,26 @@ class JobDescriptionsCheck(aiomisc.Service):
 
         log.info(
             f"{cls_name(self)} "
-            f"Processing posts<>prompt pairs "
-            f"num:{len(rows)}"
+            f"Processed posts<>prompt pairs "
+            f"num:{num_pairs} "
+            f"num_prompts:{num_prompts} "
+            f"gpt_calls:{self.gpt_calls - gpt_calls} "
+            f"gpt_cached:{self.gpt_cached - gpt_cached} "
+            f"gpt_tokens:{self.gpt_tokens - gpt_tokens}"
         )
 
+    async def process_prompt_page(self, db, rows, post_embeddings=None):
+        """
+        Returns ids of the prompts, which have pairs left unscored by index,
+        e.g. embedding isn't in the index yet. Such pairs aren't saved
+        """
         # Mutates the statuses of rows dictionary data
-        await self.apply_index_check(db, rows)
+        if self.batched_index_check:
+            await self.apply_index_check_batched(db, rows, post_embeddings)
+        else:
+            await self.apply_index_check(db, rows)
+
+        unscored_prompts = {prompt_id for (_, prompt_id), row in rows.items() if row["process_status"] is None}
 
         for (
                 user_id,
@@ -189,23 +662,22 @@ class JobDescriptionsCheck(aiomisc.Service):
                     "prompt_id": prompt_id,
                 })
 
-            futures = [
-                self.do_gpt_check(
+            # User is waiting for the first search results
+            with openai_priority(Priority.FIRST_SEARCH if is_first_search else get_openai_priority()):
+                gpt_results = await self.do_gpt_checks(
                     db=db,
                     rows=rows,
-                    post_id=post_id,
+                    posts=[
+                        (post_id, index_distance)
+                        for (n, (post_id, post_status, index_distance)) in posts
+                        if post_status == 'index_approved'
+                    ],
                     context_from_gpt4=context_from_gpt4,
                     original_user_request=original_user_request,
                     prompt_id=prompt_id,
-                    index_distance=index_distance,
                     user_id=user_id,
                     model="gpt-3.5-turbo-0613"
                 )
-                for (n, (post_id, post_status, index_distance)) in posts
-                if post_status == 'index_approved'
-            ]
-
-            gpt_results = await asyncio.gather(*futures)
             num_posts = sum(gpt_results)
             is_no_gpt_accepted_posts = num_posts == 0
 
@@ -271,6 +743,14 @@ class JobDescriptionsCheck(aiomisc.Service):
                 )
             await db.commit()
 
+        return unscored_prompts
+
+    def save_watermark(self, max_post_id, fingerprints, full_scan):
+        self.last_post_id = max_post_id
+        self.prompt_fingerprints = fingerprints
+        if full_scan:
+            self.last_full_scan = time.monotonic()
+
     @staticmethod
     async def get_percentile_distance(db, prompt_id, distances):
         cursor = await safe_db_execute(db, GET_PROMPT_BASE_DISTANCE, [prompt_id])
@@ -288,22 +768,117 @@ class JobDescriptionsCheck(aiomisc.Service):
 
         return percentile_distance
 
+    async def apply_index_check_batched(self, db, rows, post_embeddings=None):
+        """
+        Same rules as apply_index_check, but all the prompt and post embeddings are
+        loaded once, and distances are computed with a few matrix multiplications.
+        Post embeddings of the previous call are reused from `post_embeddings`,
+        which only keeps the posts of the latest call.
+        """
+        if len(rows) == 0:
+            return
+
+        if post_embeddings is None:
+            post_embeddings = {}
+
+        groups = list(group_user_data_for_index(rows.values()))
+
+        results = self.index_prompts.get(
+            ids=list({str(prompt_id) for (_, prompt_id, _) in groups}),
+            include=["embeddings"]
+        )
+        prompt_embeddings = dict(zip(results["ids"], results["embeddings"]))
+
+        post_ids = {post_id for (_, _, post_ids) in groups for post_id in post_ids}
+        missing_ids = [str(post_id) for post_id in post_ids if post_id not in post_embeddings]
+        if missing_ids:
+            results = self.index_posts.get(ids=missing_ids, include=["embeddings"])
+            if len(results["ids"]) > 0:
+                vectors = normalize_rows(np.asarray(results["embeddings"], dtype=np.float32))
+                post_embeddings.update(zip(map(int, results["ids"]), vectors))
+            del results
+
+        for post_id in list(post_embeddings.keys()):
+            if post_id not in post_ids:
+                del post_embeddings[post_id]
+
+        if len(post_embeddings) == 0:
+            log.warning(
+                f"{cls_name(self)} "
+                f"Something is wrong, unable to find any post embedding "
+                f"num_posts:{len(rows)} "
+            )
+            return
+
+        post_columns = {post_id: n for n, post_id in enumerate(post_embeddings.keys())}
+        post_matrix = np.stack(list(post_embeddings.values()))
+
+        found_groups = []
+        for user_id, prompt_id, post_ids in groups:
+            if str(prompt_id) not in prompt_embeddings:
+                log.warning(
+                    f"{cls_name(self)} "
+                    f"Something is wrong, unable to find prompt embedding "
+                    f"user_id:{user_id} "
+                    f"prompt_id:{prompt_id} "
+                )
+                continue
+            found_groups.append((user_id, prompt_id, post_ids))
+
+        # Bound the size of the distance matrix held in memory at once
+        chunk_size = max(1, self.max_scoring_cells // len(post_columns))
+
+        for chunk_start in range(0, len(found_groups), chunk_size):
+            chunk = found_groups[chunk_start:chunk_start + chunk_size]
+            prompt_matrix = normalize_rows(np.asarray([
+                prompt_embeddings[str(prompt_id)]
+                for (_, prompt_id, _) in chunk
+            ], dtype=np.float32))
+            chunk_distances = cosine_distances(prompt_matrix, post_matrix)
+
+            for (user_id, prompt_id, post_ids), all_distances in zip(chunk, chunk_distances):
+                post_ids = np.asarray([post_id for post_id in post_ids if post_id in post_columns])
+                if len(post_ids) == 0:
+                    # Left unscored, retried on the next pass
+                    log.warning(
+                        f"{cls_name(self)} "
+                        f"Something is wrong, unable to find post embeddings "
+                        f"user_id:{user_id} "
+                        f"prompt_id:{prompt_id} "
+                    )
+                    continue
+
+                # float64 is a float subclass, so percentile can be stored by sqlite
+                distances = all_distances[[post_columns[post_id] for post_id in post_ids]].astype(np.float64)
+                order = np.argsort(distances, kind="stable")
+                post_ids, distances = post_ids[order], distances[order]
+
+                percentile_distance = await JobDescriptionsCheck.get_percentile_distance(db, prompt_id, distances)
+                if not percentile_distance:
+                    continue
+
+                num_approved = count_index_approved(distances, percentile_distance)
+                for n, (post_id, distance) in enumerate(zip(post_ids.tolist(), distances.tolist())):
+                    rows[(post_id, prompt_id)]["index_distance"] = distance
+                    if n < num_approved:
+                        rows[(post_id, prompt_id)]["process_status"] = "index_approved"
+                        log.info(
+                            f"{cls_name(self)} "
+                            f"Approved by index db "
+                            f"user_id:{user_id} "
+                            f"pid:{post_id} "
+                            f"prompt_id:{prompt_id} "
+                            f"distance:{distance:.4f} < {percentile_distance:.4f}"
+                        )
+                    else:
+                        rows[(post_id, prompt_id)]["process_status"] = "rejected"
+
     async def apply_index_check(self, db, rows):
         if len(rows) == 0:
             return
 
         for user_id, prompt_id, post_ids in group_user_data_for_index(rows.values()):
-            if len(post_ids) == 1:
-                query = {"post_id": {"$eq": str(post_ids[0])}}
-
-            elif len(post_ids) > 1:
-                query = {
-                    "$or": [
-                        {"post_id": {"$eq": str(post_id)}}
-                        for post_id in post_ids
-                    ]
-                }
-            else:
+            if len(post_ids) == 0:
                 raise ValueError(f"{cls_name(self)}: Unexpected number of post ids: {len(post_ids)}")
 
             results = self.index_prompts.get(
@@ -322,11 +897,11 @@ class JobDescriptionsCheck(aiomisc.Service):
             prompt_embedding = results["embeddings"][0]
 
             try:
-                results = self.index_posts.query(
+                results = query_by_ids(
+                    self.index_posts,
                     query_embeddings=[prompt_embedding],
-                    n_results=len(post_ids),
+                    ids=post_ids,
                     include=["distances", "metadatas"],
-                    where=query
                 )
             except RuntimeError as e:
                 log.warning(
@@ -394,7 +969,7 @@ class JobDescriptionsCheck(aiomisc.Service):
         async with self.lock:
             try:
                 async with aiosqlite.connect(SQLLite3Service.db_path) as db:
-                    await self.find_matching_posts(db)
+                    await self.find_matching_posts(db, full_scan=self.is_reconciliation_due())
             except (openai.error.ServiceUnavailableError, sqlite3.OperationalError) as e:
                 log.warning(f"{cls_name(self)}: Sleeping for 20 seconds, reason: {str(e)}")
                 await asyncio.sleep(20)
@@ -422,8 +997,16 @@ class JobDescriptionsCheck(aiomisc.Service):
             )
             return
 
-        if not self.rate_limit:
-            self.rate_limit = AsyncLimiter(max_rate=20, time_period=60)
+        log.info(f"{cls_name(self)}: Waiting for OpenAI scheduler")
+        try:
+            if not self.scheduler:
+                self.scheduler = await asyncio.wait_for(context['openai_scheduler'], 3)
+        except asyncio.exceptions.TimeoutError:
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Exiting: Haven't received OpenAI scheduler"
+            )
+            return
 
         log.info(f"{cls_name(self)}: Waiting for ChromaDB posts collection")
         try:
@@ -446,6 +1029,11 @@ class JobDescriptionsCheck(aiomisc.Service):
             )
             return
 
+        if self.use_gpt_cache and not self.gpt_cache:
+            log.info(f"{cls_name(self)}: Opening GPT cache")
+            self.gpt_cache = GptResponseCache(cache_db_path(SQLLite3Service.environment))
+            await self.gpt_cache.open()
+
         log.info(f"{cls_name(self)}: Waiting for ChromaDB prompts collection")
         try:
             if not self.index_prompts:
@@ -462,6 +1050,7 @@ class JobDescriptionsCheck(aiomisc.Service):
         self.emitter.on("search_result", self.print_event)
 
         log.info(f"{cls_name(self)}: Start checking / filtering")
+        startup.ready(self)
         while True:
             await self.on_new_approved_prompt()
             await asyncio.sleep(10)
@@ -470,4 +1059,12 @@ class JobDescriptionsCheck(aiomisc.Service):
         # for future in self._futures.keys():
         #     await future
         # log.info(f"{cls_name(self)}: Stopped service")
-        pass
+        if self.gpt_cache:
+            log.info(
+                f"{cls_name(self)}: "
+                f"Closing GPT cache, "
+                f"gpt_calls:{self.gpt_calls} "
+                f"gpt_cached:{self.gpt_cached} "
+                f"stats:{self.gpt_cache.stats()}"
+            )
+            await self.gpt_cache.close()
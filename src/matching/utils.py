@@ -1,7 +1,8 @@
+import math
 from collections import defaultdict
+from operator import itemgetter
 
 import numpy as np
-import pandas as pd
 
 
 def compute_percentile(dist, bin_edges, cumulative_density):
@@ -9,7 +10,129 @@ def compute_percentile(dist, bin_edges, cumulative_density):
     return cumulative_density[index - 1]
 
 
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def cosine_distances(queries, candidates):
+    """
+    Both matrices are expected to be row-normalized, returns (queries x candidates)
+    """
+    return 1 - queries @ candidates.T
+
+
+def count_index_approved(sorted_distances, percentile_distance):
+    """
+    Number of the closest posts approved by index: top 1% is allowed by default,
+    after that everything below the percentile distance, but not more than top 3%
+    """
+    num = len(sorted_distances)
+    min_num = math.floor(num * 1 / 100)
+    max_num = math.ceil(num * 3 / 100)
+    num_good = int(np.searchsorted(sorted_distances, percentile_distance, side="left"))
+    return min(max_num, max(min_num, num_good))
+
+
+def _is_nan(value):
+    return value != value
+
+
+def _is_missing(value):
+    return value is None or _is_nan(value)
+
+
 def group_user_data_for_index(rows):
+    """
+    Same output as group_user_data_for_index_pandas: groups sorted by
+    (user_id, prompt_id), post ids unique in the order of appearance
+    """
+    groups = {}
+    for row in rows:
+        user_id, prompt_id, post_id = row["user_id"], row["prompt_id"], row["post_id"]
+        if _is_missing(user_id) or _is_missing(prompt_id) or _is_missing(post_id):
+            continue
+
+        # dict is used as an ordered set
+        groups.setdefault((user_id, prompt_id), {})[post_id] = None
+
+    keys = sorted(groups.keys())
+
+    user_ids = [int(user_id) for (user_id, _) in keys]
+    user_prompts_ids = [int(prompt_id) for (_, prompt_id) in keys]
+    user_post_ids = [[int(post_id) for post_id in groups[key]] for key in keys]
+
+    return zip(user_ids, user_prompts_ids, user_post_ids)
+
+
+GPT_CHECK_GROUP_COLUMNS = (
+    'user_id',
+    'prompt_id',
+    'original_user_request',
+    'context_from_gpt4',
+    'prompt_status',
+)
+
+
+def group_user_data_for_gpt_check(rows):
+    """
+    Same output as group_user_data_for_gpt_check_pandas, groups are sorted by
+    (user_id, prompt_id, original_user_request, context_from_gpt4, prompt_status)
+    """
+    get_key = itemgetter(*GPT_CHECK_GROUP_COLUMNS)
+    get_values = itemgetter('post_id', 'process_status', 'index_distance')
+
+    groups = {}
+    for row in rows:
+        key = get_key(row)
+        post_id, process_status, index_distance = values = get_values(row)
+        if None in key or None in values or any(map(_is_nan, key + values)):
+            continue
+
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = ({}, [], [])
+
+        group[0][post_id] = None
+        group[1].append(process_status)
+        group[2].append(index_distance)
+
+    keys = sorted(groups.keys())
+
+    user_ids = [int(key[0]) for key in keys]
+    prompt_ids = [int(key[1]) for key in keys]
+    original_user_requests = [key[2] for key in keys]
+    contexts_from_gpt4 = [key[3] for key in keys]
+
+    is_first_search = [key[4] == "approved" for key in keys]
+    is_all_rejected = [all([v == "rejected" for v in groups[key][1]]) for key in keys]
+
+    user_post_ids = [[int(i) for i in groups[key][0]] for key in keys]
+    user_index_distances = [[float(i) for i in groups[key][2]] for key in keys]
+    user_process_statuses = [groups[key][1] for key in keys]
+
+    return zip(
+        user_ids,
+        prompt_ids,
+        contexts_from_gpt4,
+        original_user_requests,
+        is_all_rejected,
+        is_first_search,
+
+        user_post_ids,
+        user_process_statuses,
+        user_index_distances,
+    )
+
+
+# Reference implementations, pandas is imported lazily, since the matcher doesn't
+# need it anymore. Kept for comparison, see matching/bench_grouping.py
+
+
+def group_user_data_for_index_pandas(rows):
+    import pandas as pd
+
     # Convert list of dictionaries to pandas DataFrame
     df = pd.DataFrame(rows)
 
@@ -33,7 +156,9 @@ def group_user_data_for_index(rows):
     return zip(user_ids, user_prompts_ids, user_post_ids)
 
 
-def group_user_data_for_gpt_check(rows):
+def group_user_data_for_gpt_check_pandas(rows):
+    import pandas as pd
+
     # Convert list of dictionaries to pandas DataFrame
     df = pd.DataFrame(rows)
 
@@ -2,19 +2,20 @@ import os
 from urllib.parse import urlencode
 
 from dotenv import load_dotenv
-from fake_useragent import UserAgent
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.firefox.service import Service
-from webdriver_manager.firefox import GeckoDriverManager
 
-GECKO_DRIVER_PATH = GeckoDriverManager("v0.33.0").install()
+from common.assets import get_gecko_driver_path, get_user_agents
 
 load_dotenv()
 assert (os.getenv("PROXIES_API_AUTH_KEY") is not None)
 
 
 def setup_driver():
+    # Selenium is imported on the first driver, geckodriver and user agents
+    # are resolved from the asset cache
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+    from selenium.webdriver.firefox.service import Service
+
     options = Options()
     options.add_argument("--no-sandbox")
     options.add_argument("--headless")
@@ -23,12 +24,12 @@ def setup_driver():
     # Can be used only for testing atm
     # options.set_capability("pageLoadStrategy", "eager")
 
-    ua = UserAgent()
+    ua = get_user_agents()
     options.add_argument("--window-size=1920,1080")
     options.add_argument(f"--user-agent={ua.random}")
     driver = webdriver.Firefox(
         service=Service(
-            executable_path=GECKO_DRIVER_PATH,
+            executable_path=get_gecko_driver_path(),
             log_path=os.path.devnull
         ),
         options=options
@@ -5,7 +5,6 @@ import selenium
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
 
 from parsing.converter import ToTelegramMarkdown
 from parsing.exceptions import JobArchived
@@ -16,6 +15,8 @@ log.setLevel(logging.INFO)
 
 
 class GeekJobsParser(Parser):
+    static_html = True
+
     S_RESPOND_BUTTON = ".respondbtn"
     S_NAME = ".vacancy h1"  # Unity Developer
     S_COMPANY = ".main .company-name a"  # Octo Games
@@ -103,7 +104,7 @@ class GeekJobsParser(Parser):
             pass
 
         try:
-            WebDriverWait(driver, 5).until(EC.element_to_be_clickable((By.CSS_SELECTOR, self.S_RESPOND_BUTTON)))
+            self.wait_until(driver, EC.element_to_be_clickable((By.CSS_SELECTOR, self.S_RESPOND_BUTTON)))
         except selenium.common.exceptions.TimeoutException:
             try:
                 text = driver.find_element(By.CSS_SELECTOR, self.S_404).text
@@ -5,7 +5,6 @@ import selenium
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.wait import WebDriverWait
 
 from common.logging import cls_name
 from common.markdown import remove_excessive_n
@@ -18,6 +17,8 @@ log.setLevel(logging.INFO)
 
 
 class HabrParser(Parser):
+    static_html = True
+
     S_WAIT_FOR = ".button-comp--size-sm span"
     S_NAME = ".page-title__title"  # Unity Developer
     S_COMPANY = ".company_info .company_name"  # Octo Games
@@ -109,7 +110,7 @@ class HabrParser(Parser):
         info = {}
 
         try:
-            WebDriverWait(driver, 5).until(EC.element_to_be_clickable((By.CSS_SELECTOR, self.S_WAIT_FOR)))
+            self.wait_until(driver, EC.element_to_be_clickable((By.CSS_SELECTOR, self.S_WAIT_FOR)))
         except selenium.common.exceptions.TimeoutException:
             try:
                 text = driver.find_element(By.CSS_SELECTOR, self.S_404).text
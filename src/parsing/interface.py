@@ -1,7 +1,14 @@
 from abc import ABC, abstractmethod
 
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from selenium.webdriver.support.wait import WebDriverWait
+
 
 class Parser(ABC):
+    # Page is rendered on the server, so it can be parsed from the html
+    # fetched without browser
+    static_html = False
+
     @abstractmethod
     def check_correct_url(self, url):
         raise NotImplementedError()
@@ -23,3 +30,21 @@ class Parser(ABC):
     @abstractmethod
     def get_name():
         raise NotImplementedError()
+
+    @staticmethod
+    def wait_until(driver, condition, timeout=5):
+        """
+        WebDriverWait in browser. Static page won't change, so the condition
+        is checked once, instead of waiting for the timeout
+        """
+        if not getattr(driver, "is_static", False):
+            return WebDriverWait(driver, timeout).until(condition)
+
+        try:
+            result = condition(driver)
+        except NoSuchElementException:
+            result = False
+
+        if not result:
+            raise TimeoutException()
+        return result
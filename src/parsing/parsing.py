@@ -1,35 +1,43 @@
 import asyncio
+import copy
 import logging
-import queue
-import threading
-import time
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 from typing import Optional, Union
 
 import aiomisc
 import langid
 import selenium
-import urllib3
 import validators
-from selenium.common import WebDriverException
 from tldextract import tldextract
 
-from common.logging import cls_name, suppress_logs
+from common.logging import cls_name
 from common.markdown import MarkdownPost
+from common.singleflight import SingleFlight
+from common.startup import startup
 from common.telegram import TelegramTextTools
+from db.cache import ParsedPageCache, cache_db_path
+from db.sqlite import SQLLite3Service
 from parsing.driver import setup_driver
 from parsing.exceptions import NotFound, NotSupported
 from parsing.geeekjobs import GeekJobsParser
 from parsing.habrahabr import HabrParser
 from parsing.headhunter import HeadHunterParser, JobArchived, LoginRequired
 from parsing.interface import Parser
+from parsing.pool import DriverPool, PoolClosed
+from parsing.static import HttpFetcher, StaticPage
 from parsing.telegraph import TelegraphParser
-from preprocessing.utils import run_pkill
+from parsing.utils import canonical_url
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 logging.getLogger("urllib3.connectionpool").setLevel(logging.CRITICAL)
 
+PARSERS = {
+    cls_name(parser): parser
+    for parser in [HeadHunterParser, GeekJobsParser, HabrParser, TelegraphParser]
+}
+
 
 class KnownNoneParser(Parser):
     def check_correct_url(self, url):
@@ -51,17 +59,61 @@ class KnownNoneParser(Parser):
 
 
 class JobPostingParser(aiomisc.Service):
-    queue = queue.Queue()
     _futures = {}
+    # Pages in progress by url, the same link posted in several channels is loaded once
+    inflight: SingleFlight = None
+
+    # Server-rendered pages are fetched over HTTP, browser is the fallback
+    use_static = True
+    fetcher: HttpFetcher = None
+    static_parsed = 0
+    static_fallbacks = 0
+
+    # Parsed pages and the archived / not found ones by canonical url
+    use_page_cache = True
+    page_cache: ParsedPageCache = None
+
+    # Browsers are started while parses wait for them, between the sizes
+    min_drivers = 1
+    max_drivers = 4
+    # Threads running the parses, static pages don't take a driver
+    parse_workers = 8
+    pool: DriverPool = None
+    executor: ThreadPoolExecutor = None
+    metrics_period = 10 * 60
+    stop_timeout = 30
 
     async def start(self):
         self.context["parser"] = self
         self.start_event.set()
 
-        self.stop_event = threading.Event()
-        self.done_event = threading.Event()
+        self.stopping = False
+        self.loop = asyncio.get_running_loop()
+        self.inflight = SingleFlight()
+        self.executor = ThreadPoolExecutor(max_workers=self.parse_workers, thread_name_prefix="parsing")
+        self.pool = DriverPool(setup_driver, min_size=self.min_drivers, max_size=self.max_drivers)
+        await self.pool.open()
+
+        if self.use_static and not self.fetcher:
+            self.fetcher = HttpFetcher()
+            await self.fetcher.open()
 
-        await self.keep_queue(self.done_event, self.stop_event)
+        if self.use_page_cache and not self.page_cache:
+            try:
+                log.info(f"{cls_name(self)}: Waiting for SQLite3 to be ready")
+                await asyncio.wait_for(self.context["sqlite_ready"], 3)
+
+                log.info(f"{cls_name(self)}: Opening parsed page cache")
+                self.page_cache = ParsedPageCache(cache_db_path(SQLLite3Service.environment))
+                await self.page_cache.open()
+            except asyncio.exceptions.TimeoutError:
+                log.warning(
+                    f"{cls_name(self)}: "
+                    f"Haven't received SQLite3, parsing without page cache"
+                )
+        startup.ready(self)
+
+        self.metrics_logging = asyncio.create_task(self.log_metrics())
 
     @staticmethod
     def _get_domain(url):
@@ -112,116 +164,45 @@ class JobPostingParser(aiomisc.Service):
         del self._futures[gather_future]
         return res
 
-    async def stop(self, *args, **kwargs):
-        self.stop_event.set()
-
-        log.debug(
-            f"{cls_name(self)}: "
-            f"Waiting for keep_queue to finish"
-        )
-
-        while not self.done_event.is_set():
-            time.sleep(1)
-
-        log.debug(
-            f"{cls_name(self)}: "
-            f"Stopping, waiting for parsing to finish"
-        )
+    async def log_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_period)
+            log.info(
+                f"{cls_name(self)}: "
+                f"Driver pool "
+                f"stats:{self.pool.stats()}"
+            )
 
-        # for future in self._futures.keys():
-        #     await future
+    async def stop(self, *args, **kwargs):
+        self.stopping = True
+        self.metrics_logging.cancel()
 
         log.debug(
             f"{cls_name(self)}: "
-            f"Stopping, quiting drivers"
+            f"Stopping, waiting for parsing to finish and quiting drivers"
         )
+        await self.pool.close(timeout=self.stop_timeout)
+        self.executor.shutdown(wait=False)
 
-        initial_size = self.queue.qsize()
-        with suppress_logs("urllib3.connectionpool"):
-            while not self.queue.empty():
-                driver, _ = self.queue.get()
-                driver.quit()
+        if self.fetcher:
+            await self.fetcher.close()
 
-        # TODO: Not sure clean up works, will fix later
-        run_pkill("geckodriver")
-        run_pkill("Firefox")
+        if self.page_cache:
+            log.info(
+                f"{cls_name(self)}: "
+                f"Closing parsed page cache, "
+                f"stats:{self.page_cache.stats()}"
+            )
+            await self.page_cache.close()
 
         log.info(
             f"{cls_name(self)}: "
             f"Stopped, "
-            f"drivers spawned: {initial_size} "
-            f"queue size: {self.queue.qsize()} "
-        )
-
-    @aiomisc.threaded_separate
-    def keep_queue(self, done: threading.Event, stopped: threading.Event):
-        log.debug(
-            f"{cls_name(self)}: "
-            f"Started job processing queue"
-        )
-        while not stopped.is_set():
-            if self.queue.qsize() < 1:
-                try:
-                    driver = setup_driver()
-                    self.queue.put((driver, 0))
-                    log.debug(
-                        f"{cls_name(self)}: "
-                        f"Added new driver to queue, "
-                        f"size: {self.queue.qsize()}"
-                    )
-                except (WebDriverException,
-                        urllib3.exceptions.ProtocolError) as e:
-                    log.warning(
-                        f"{cls_name(self)}: "
-                        f"Can't setup driver "
-                        f"err: {str(e)}"
-                    )
-                    time.sleep(3)
-                    continue
-
-                except Exception as e:
-                    log.exception(e)
-
-            elif self.queue.qsize() > 15:
-                while self.queue.qsize() > 10:
-                    driver, _ = self.queue.get()
-                    with suppress_logs("urllib3.connectionpool"):
-                        driver.quit()
-                    log.debug(
-                        f"{cls_name(self)}: "
-                        f"Removed driver from queue, "
-                        f"size: {self.queue.qsize()}"
-                    )
-            else:
-                time.sleep(2)
-
-        log.debug(
-            f"{cls_name(self)}: "
-            f"Exiting keep_queue "
-            f"size: {self.queue.qsize()}"
+            f"pool: {self.pool.stats()} "
+            f"static_parsed: {self.static_parsed} "
+            f"static_fallbacks: {self.static_fallbacks} "
+            f"fetcher: {self.fetcher.stats() if self.fetcher else None} "
         )
-        done.set()
-
-    def return_driver(self, driver, counter, close=True):
-        if counter >= 10:
-            log.debug(
-                f"{cls_name(self)}: "
-                f"Driver used more than 10 times quiting, "
-                f"size:{self.queue.qsize()}"
-            )
-            with suppress_logs("urllib3.connectionpool"):
-                driver.quit()
-        else:
-            if len(driver.window_handles) > 1 and close:
-                with suppress_logs("urllib3.connectionpool"):
-                    driver.close()
-
-            self.queue.put((driver, counter))
-            log.debug(
-                f"{cls_name(self)}: "
-                f"Added driver back to queue, "
-                f"size:{self.queue.qsize()}"
-            )
 
     @staticmethod
     def check_for_redirect(parser, prev_url, current_url):
@@ -236,7 +217,7 @@ class JobPostingParser(aiomisc.Service):
             return parser, is_redirect
         return parser, is_redirect
 
-    def _parse(self, driver, counter, iteration, url, add_info_link=False, log_info=None):
+    def _parse(self, driver, iteration, url, add_info_link=False, log_info=None):
         li = {} or log_info
 
         parser = JobPostingParser._get_parser(url)
@@ -246,7 +227,6 @@ class JobPostingParser(aiomisc.Service):
         try:
             driver.get(url)
             current_url = driver.current_url
-            counter += 1
         except selenium.common.exceptions.TimeoutException:
             log.warning(
                 f"{cls_name(self)}: "
@@ -273,6 +253,17 @@ class JobPostingParser(aiomisc.Service):
             prev_url=url,
             current_url=current_url
         )
+        if is_redirected and parser and getattr(driver, "is_static", False) and not parser.static_html:
+            log.debug(
+                f"{cls_name(self)}: "
+                f"({li['n']} / {li['ns']}) "
+                f"Redirected to the page, which needs browser "
+                f"url:{current_url} "
+                f"parser: {','.join(parser.get_domains())} "
+                f"iteration:{iteration}"
+            )
+            return None, None, None
+
         if is_redirected:
             if parser:
                 log.debug(
@@ -328,11 +319,44 @@ class JobPostingParser(aiomisc.Service):
         )
         return content, parser, current_url
 
-    @aiomisc.threaded_separate
-    def _iterative_parse(self, url_to_parse, add_info_link=False, log_info=None):
+    def _fetch_static(self, url):
+        # Called from the parsing thread, the session lives in the event loop
+        return asyncio.run_coroutine_threadsafe(self.fetcher.fetch(url), self.loop).result()
+
+    async def _run(self, func, *args):
+        # Parses are blocking, they run in the bounded executor
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def _load_and_parse(self, iteration, url, add_info_link=False, log_info=None):
         li = {} or log_info
 
-        if self.stop_event.is_set(): return None
+        parser = JobPostingParser._get_parser(url)
+        if self.fetcher and parser.static_html:
+            page = StaticPage(self._fetch_static)
+            result = await self._run(self._parse, page, iteration, url, add_info_link, li)
+            if result[0]:
+                self.static_parsed += 1
+                return result
+
+            self.static_fallbacks += 1
+            log.debug(
+                f"{cls_name(self)}: "
+                f"({li['n']} / {li['ns']}) "
+                f"Can't parse static page, loading in browser "
+                f"url:{url} "
+                f"iteration:{iteration}"
+            )
+
+        async with self.pool.driver() as driver:
+            return await self._run(self._parse, driver, iteration, url, add_info_link, li)
+
+    async def _identify_language(self, content):
+        return await self._run(JobPostingParser.identify_language, content)
+
+    async def _iterative_parse(self, url_to_parse, add_info_link=False, log_info=None):
+        li = {} or log_info
+
+        if self.stopping: return None, None, None, None, None
         last_parsed_content = None
         last_parser = None
         iteration = 0
@@ -355,15 +379,15 @@ class JobPostingParser(aiomisc.Service):
                 break
 
             iteration += 1
-            (driver, counter) = self.queue.get()
 
             try:
-                parsed_content, used_parser, url_after_load = self._parse(driver,
-                                                                          counter,
-                                                                          iteration,
-                                                                          url_to_parse,
-                                                                          add_info_link,
-                                                                          log_info=li)
+                parsed_content, used_parser, url_after_load = await self._load_and_parse(iteration,
+                                                                                         url_to_parse,
+                                                                                         add_info_link,
+                                                                                         log_info=li)
+            except PoolClosed:
+                return none_result + (None,)
+
             except JobArchived as e:
                 log.info(
                     f"{cls_name(self)}: "
@@ -373,7 +397,7 @@ class JobPostingParser(aiomisc.Service):
                     f"parser:{','.join(e.parser.get_domains())} "
                     f"iteration:{iteration}"
                 )
-                return none_result
+                return none_result + ("archived",)
 
             except NotFound as e:
                 log.info(
@@ -384,7 +408,7 @@ class JobPostingParser(aiomisc.Service):
                     f"parser:{','.join(e.parser.get_domains())} "
                     f"iteration:{iteration}"
                 )
-                return none_result
+                return none_result + ("not_found",)
 
             except NotSupported as e:
                 log.info(
@@ -400,7 +424,8 @@ class JobPostingParser(aiomisc.Service):
                     last_parsed_content,
                     last_parser,
                     last_parsed_url,
-                    JobPostingParser.identify_language(last_parsed_content)
+                    await self._identify_language(last_parsed_content),
+                    ParsedPageCache.PARSED if last_parsed_content else None
                 )
 
             except LoginRequired as e:
@@ -417,12 +442,10 @@ class JobPostingParser(aiomisc.Service):
                     last_parsed_content,
                     last_parser,
                     last_parsed_url,
-                    JobPostingParser.identify_language(last_parsed_content)
+                    await self._identify_language(last_parsed_content),
+                    ParsedPageCache.PARSED if last_parsed_content else "login_required"
                 )
 
-            finally:
-                self.return_driver(driver, counter)
-
             if not parsed_content:
                 break
 
@@ -460,12 +483,70 @@ class JobPostingParser(aiomisc.Service):
                 f"iteration:{iteration}"
             )
 
+        # Outcome tells what to cache, transient failures aren't cached
         return (
             last_parsed_content,
             last_parser,
             last_parsed_url,
-            JobPostingParser.identify_language(last_parsed_content)
+            await self._identify_language(last_parsed_content),
+            ParsedPageCache.PARSED if last_parsed_content else None
+        )
+
+    @staticmethod
+    def _from_cache(cached):
+        if cached["outcome"] != ParsedPageCache.PARSED:
+            return None, None, None, None
+
+        parser = PARSERS.get(cached["parser"])
+        if not parser:
+            # Parser was renamed since, the page is parsed again
+            return None
+
+        content = MarkdownPost(cached["text"], entities=cached["entities"])
+        return content, parser(), cached["final_url"], cached["language"]
+
+    async def _cached_parse(self, url, add_info_link=False, log_info=None):
+        key = ParsedPageCache.key(canonical_url(url), add_info_link)
+        if self.page_cache:
+            cached = await self.page_cache.get(key)
+            result = JobPostingParser._from_cache(cached) if cached else None
+            if result:
+                log.debug(
+                    f"{cls_name(self)}: "
+                    f"Page is cached "
+                    f"link:{url} "
+                    f"outcome:{cached['outcome']}"
+                )
+                return result
+
+        (content, parser, final_link, language, outcome) = await self._iterative_parse(
+            url, add_info_link=add_info_link, log_info=log_info
+        )
+
+        if self.page_cache and outcome:
+            try:
+                await self.page_cache.put(
+                    key,
+                    canonical_url(url),
+                    outcome,
+                    parser=cls_name(parser) if parser else None,
+                    final_url=final_link,
+                    language=language,
+                    text=content.plain() if content else None,
+                    entities=content.json_entities() if content else None,
+                )
+            except Exception as e:
+                log.exception(e)
+
+        return content, parser, final_link, language
+
+    async def _shared_parse(self, url, add_info_link=False, log_info=None):
+        (content, parser, final_link, language) = await self.inflight.run(
+            (canonical_url(url), add_info_link), self._cached_parse, url, add_info_link=add_info_link,
+            log_info=log_info
         )
+        # Every caller gets its own copy, the content is modified further
+        return copy.deepcopy(content), parser, final_link, language
 
     @staticmethod
     def identify_language(content: MarkdownPost):
@@ -499,7 +580,7 @@ class JobPostingParser(aiomisc.Service):
                 continue
 
             log_info = {"n": n + 1, "ns": num_urls}
-            future = self._iterative_parse(url, add_info_link=add_info_link, log_info=log_info)
+            future = self._shared_parse(url, add_info_link=add_info_link, log_info=log_info)
             futures.append(future)
 
         if futures:
@@ -0,0 +1,433 @@
+"""
+Pool of browser drivers, sized by demand. It keeps min_size drivers warm,
+starts new ones while parses are waiting for a driver, up to max_size, and
+trims the ones idle for long. Drivers are recycled after max_uses, max_age
+or once the browser grows over max_memory_mb, idle ones are health checked
+periodically. Blocking driver calls run in the pool executor, so the event
+loop is never blocked by the browser.
+"""
+import asyncio
+import glob
+import logging
+import os
+import time
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from typing import Optional
+
+from selenium.common.exceptions import WebDriverException
+
+from common.logging import cls_name, suppress_logs
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class PoolClosed(Exception):
+    pass
+
+
+def process_memory_mb(pid) -> Optional[float]:
+    """
+    Resident memory of the process with its children, e.g. content processes
+    of Firefox. None where /proc isn't available
+    """
+    if not os.path.exists(f"/proc/{pid}/statm"):
+        return None
+
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+            for path in glob.glob(f"/proc/{pid}/task/*/children"):
+                with open(path) as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            # Process has exited meanwhile
+            continue
+
+    return total / 1024 / 1024
+
+
+class PooledDriver:
+    def __init__(self, driver):
+        self.driver = driver
+        self.created_at = time.monotonic()
+        self.acquired_at = None
+        self.released_at = self.created_at
+        self.uses = 0
+
+    def age(self):
+        return time.monotonic() - self.created_at
+
+    def idle(self):
+        return time.monotonic() - self.released_at
+
+    def pid(self):
+        return self.driver.capabilities.get("moz:processID")
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.acquired = 0
+        self.spawned = 0
+        self.spawn_failed = 0
+        self.recycled = Counter()
+        # Time parses waited for a driver
+        self.waited = 0.0
+        self.max_wait = 0.0
+        # Time drivers were in use, and were alive at all
+        self.busy = 0.0
+        self.alive = 0.0
+
+    def as_dict(self, live, size, idle, busy, waiting):
+        alive = self.alive + sum(pooled.age() for pooled in live)
+        # Drivers in use now are counted as busy since they were acquired
+        in_use = self.busy + sum(time.monotonic() - pooled.acquired_at for pooled in live if pooled.acquired_at)
+        return {
+            "size": size,
+            "idle": idle,
+            "busy": busy,
+            "waiting": waiting,
+            "acquired": self.acquired,
+            "spawned": self.spawned,
+            "spawn_failed": self.spawn_failed,
+            "recycled": dict(self.recycled),
+            "avg_wait": round(self.waited / self.acquired, 2) if self.acquired else 0.0,
+            "max_wait": round(self.max_wait, 2),
+            "utilization": round(in_use / alive, 2) if alive else 0.0,
+        }
+
+
+class DriverPool:
+    min_size = 1
+    max_size = 4
+    max_uses = 10
+    # Seconds
+    max_age = 30 * 60
+    idle_timeout = 5 * 60
+    health_check_period = 30
+    spawn_retry_delay = 3
+    max_memory_mb = 1500
+
+    def __init__(self, create_driver, min_size=None, max_size=None):
+        self.create_driver = create_driver
+        if min_size is not None:
+            self.min_size = min_size
+        if max_size is not None:
+            self.max_size = max_size
+        if self.min_size > self.max_size:
+            raise ValueError(f"min_size:{self.min_size} is greater than max_size:{self.max_size}")
+
+        # Drivers are started, checked and quit here, parses run elsewhere
+        self.executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix="driver-pool")
+        self.metrics = PoolMetrics()
+        self.closed = False
+
+        self._idle = deque()
+        self._busy = set()
+        # Taken out of idle for the health check
+        self._checking = set()
+        self._spawning = 0
+        self._waiters = deque()
+        self._tasks = set()
+        self._released = asyncio.Event()
+        self._maintenance: asyncio.Task = None
+
+    @property
+    def size(self):
+        return len(self._idle) + len(self._busy) + len(self._checking) + self._spawning
+
+    async def open(self):
+        self._maintenance = asyncio.create_task(self.maintain())
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _create_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _scale(self):
+        """
+        Starts drivers for the parses waiting, which the drivers being
+        started won't cover, and up to min_size
+        """
+        if self.closed:
+            return
+
+        needed = max(len(self._waiters) - self._spawning, self.min_size - self.size, 0)
+        for _ in range(min(needed, self.max_size - self.size)):
+            self._spawning += 1
+            self._create_task(self._spawn())
+
+    async def _spawn(self):
+        try:
+            driver = await self._run(self.create_driver)
+        except Exception as e:
+            self.metrics.spawn_failed += 1
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Can't setup driver "
+                f"err: {str(e)}"
+            )
+            # Keeps the slot taken, so the failing setup isn't retried in a loop
+            await asyncio.sleep(self.spawn_retry_delay)
+            self._spawning -= 1
+            self._scale()
+            return
+
+        self._spawning -= 1
+        self.metrics.spawned += 1
+        pooled = PooledDriver(driver)
+        if self.closed:
+            self._retire(pooled, "closed")
+            return
+
+        log.debug(
+            f"{cls_name(self)}: "
+            f"Started driver, "
+            f"size:{self.size + 1} "
+            f"waiting:{len(self._waiters)}"
+        )
+        self._put(pooled)
+
+    def _put(self, pooled: PooledDriver):
+        # Driver goes to the longest waiting parse, if any
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._busy.add(pooled)
+                waiter.set_result(pooled)
+                return
+
+        self._idle.append(pooled)
+
+    def _retire(self, pooled: PooledDriver, reason):
+        self.metrics.recycled[reason] += 1
+        self.metrics.alive += pooled.age()
+        log.debug(
+            f"{cls_name(self)}: "
+            f"Quitting driver "
+            f"reason:{reason} "
+            f"uses:{pooled.uses} "
+            f"age:{pooled.age():.0f}s"
+        )
+        self._create_task(self._quit(pooled.driver))
+
+    async def _quit(self, driver):
+        def quit_driver():
+            with suppress_logs("urllib3.connectionpool"):
+                driver.quit()
+
+        try:
+            await self._run(quit_driver)
+        except Exception as e:
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Can't quit driver "
+                f"err: {str(e)}"
+            )
+
+    async def acquire(self) -> PooledDriver:
+        if self.closed:
+            raise PoolClosed()
+
+        started_at = time.monotonic()
+        if self._idle:
+            # The most recently used one, the rest are left to idle out
+            pooled = self._idle.pop()
+            self._busy.add(pooled)
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            self._scale()
+            try:
+                pooled = await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # Driver was handed over at the same moment
+                    pooled = waiter.result()
+                    self._busy.discard(pooled)
+                    self._put(pooled)
+                raise
+
+        waited = time.monotonic() - started_at
+        self.metrics.acquired += 1
+        self.metrics.waited += waited
+        self.metrics.max_wait = max(self.metrics.max_wait, waited)
+        pooled.acquired_at = time.monotonic()
+        return pooled
+
+    @staticmethod
+    def _reset(driver):
+        # Windows opened by the page are closed, the driver is switched back
+        # to the one it started with
+        handles = driver.window_handles
+        if len(handles) > 1:
+            with suppress_logs("urllib3.connectionpool"):
+                for handle in handles[1:]:
+                    driver.switch_to.window(handle)
+                    driver.close()
+                driver.switch_to.window(handles[0])
+
+    def _recycle_reason(self, pooled: PooledDriver):
+        if pooled.uses >= self.max_uses:
+            return "uses"
+        if pooled.age() >= self.max_age:
+            return "age"
+        return None
+
+    async def release(self, pooled: PooledDriver, healthy=True):
+        if pooled not in self._busy:
+            # Quit already by close()
+            return
+
+        if healthy and not self.closed:
+            try:
+                await self._run(self._reset, pooled.driver)
+            except Exception:
+                healthy = False
+
+        self._busy.discard(pooled)
+        self._released.set()
+        pooled.uses += 1
+        pooled.released_at = time.monotonic()
+        self.metrics.busy += pooled.released_at - pooled.acquired_at
+        pooled.acquired_at = None
+
+        reason = "closed" if self.closed else "unhealthy" if not healthy else self._recycle_reason(pooled)
+        if reason:
+            self._retire(pooled, reason)
+            self._scale()
+            return
+
+        self._put(pooled)
+
+    @asynccontextmanager
+    async def driver(self):
+        pooled = await self.acquire()
+        healthy = True
+        try:
+            yield pooled.driver
+        except (WebDriverException, asyncio.CancelledError):
+            # Cancelled parse might still be using the driver in its thread
+            healthy = False
+            raise
+        finally:
+            await self.release(pooled, healthy=healthy)
+
+    def _check(self, pooled: PooledDriver):
+        """
+        Runs in the executor, returns the reason to recycle the idle driver
+        """
+        try:
+            pooled.driver.current_url
+        except Exception:
+            return "unhealthy"
+
+        if self.max_memory_mb:
+            pid = pooled.pid()
+            memory = process_memory_mb(pid) if pid else None
+            if memory is not None and memory > self.max_memory_mb:
+                return "memory"
+
+        return None
+
+    async def check_idle(self):
+        for pooled in list(self._idle):
+            if pooled not in self._idle:
+                continue
+
+            if self.size > self.min_size and pooled.idle() >= self.idle_timeout:
+                self._idle.remove(pooled)
+                self._retire(pooled, "idle")
+                continue
+
+            reason = self._recycle_reason(pooled)
+            if not reason:
+                self._idle.remove(pooled)
+                self._checking.add(pooled)
+                try:
+                    reason = await self._run(self._check, pooled)
+                except asyncio.CancelledError:
+                    self._idle.append(pooled)
+                    raise
+                finally:
+                    self._checking.discard(pooled)
+
+                if not reason and not self.closed:
+                    self._put(pooled)
+                    continue
+            else:
+                self._idle.remove(pooled)
+
+            self._retire(pooled, reason or "closed")
+
+    async def maintain(self):
+        while not self.closed:
+            self._scale()
+            await asyncio.sleep(self.health_check_period)
+            try:
+                await self.check_idle()
+            except Exception as e:
+                log.exception(e)
+
+    async def close(self, timeout=30):
+        """
+        Stops handing out drivers, waits for the ones in use to be released
+        and quits all of them
+        """
+        self.closed = True
+        if self._maintenance:
+            self._maintenance.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._maintenance
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(PoolClosed())
+
+        deadline = time.monotonic() + timeout
+        while self._busy and time.monotonic() < deadline:
+            self._released.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._released.wait(), deadline - time.monotonic())
+
+        if self._busy:
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Quitting drivers still in use, "
+                f"busy:{len(self._busy)}"
+            )
+
+        for pooled in list(self._idle) + list(self._busy):
+            self._retire(pooled, "closed")
+        self._idle.clear()
+        self._busy.clear()
+
+        # Drivers being started are quit once they are up
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        live = list(self._idle) + list(self._busy) + list(self._checking)
+        return self.metrics.as_dict(
+            live,
+            size=self.size,
+            idle=len(self._idle),
+            busy=len(self._busy),
+            waiting=len(self._waiters),
+        )
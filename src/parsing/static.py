@@ -0,0 +1,240 @@
+"""
+Pages which are rendered on the server are fetched over pooled HTTP and
+parsed from html, without starting a browser. StaticPage mimics the bits
+of selenium driver the parsers use, so that they keep their selectors.
+"""
+import asyncio
+import logging
+import re
+
+import aiohttp
+from bs4 import BeautifulSoup, NavigableString, Comment, Doctype
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+
+from common.assets import get_user_agents
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "dd", "div", "dl", "dt", "fieldset", "figcaption",
+    "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main",
+    "nav", "ol", "p", "pre", "section", "table", "tr", "ul",
+}
+INVISIBLE_TAGS = {"script", "style", "template", "noscript", "head"}
+
+# Subset of XPath the parsers use: //*[@data-qa='vacancy-title']
+SIMPLE_XPATH = re.compile(r"^//([\w*]+)\[@([\w-]+)=['\"]([^'\"]*)['\"]\]$")
+
+
+class FetchFailed(Exception):
+    pass
+
+
+def xpath_to_css(xpath):
+    match = SIMPLE_XPATH.match(xpath)
+    if not match:
+        raise NotImplementedError(f"Unsupported xpath for static page: {xpath}")
+
+    (tag, attribute, value) = match.groups()
+    return f"{'' if tag == '*' else tag}[{attribute}=\"{value}\"]"
+
+
+def render_text(tag):
+    """
+    Approximates WebElement.text: text of the block elements goes on its own
+    lines, whitespace is collapsed, empty lines are dropped
+    """
+    parts = []
+
+    def walk(node):
+        for child in node.children:
+            if isinstance(child, (Comment, Doctype)):
+                continue
+
+            if isinstance(child, NavigableString):
+                parts.append(str(child))
+            elif child.name in INVISIBLE_TAGS:
+                continue
+            elif child.name == "br":
+                parts.append("\n")
+            else:
+                is_block = child.name in BLOCK_TAGS
+                if is_block:
+                    parts.append("\n")
+                walk(child)
+                if is_block:
+                    parts.append("\n")
+
+    walk(tag)
+    lines = [re.sub(r"[^\S\n]+", " ", line).strip() for line in "".join(parts).split("\n")]
+    return "\n".join(line for line in lines if line)
+
+
+class StaticElement:
+    def __init__(self, tag):
+        self._tag = tag
+
+    @property
+    def text(self):
+        return render_text(self._tag)
+
+    def get_attribute(self, name):
+        if name == "innerHTML":
+            return self._tag.decode_contents()
+        if name == "outerHTML":
+            return str(self._tag)
+        if name in ("textContent", "innerText"):
+            return self._tag.get_text()
+
+        value = self._tag.get(name)
+        if isinstance(value, list):
+            return " ".join(value)
+        return value
+
+    def is_displayed(self):
+        style = (self._tag.get("style") or "").replace(" ", "").lower()
+        return not self._tag.has_attr("hidden") and "display:none" not in style
+
+    def is_enabled(self):
+        return not self._tag.has_attr("disabled")
+
+    @staticmethod
+    def _selector(by, value):
+        if by == By.CSS_SELECTOR:
+            return value
+        if by == By.XPATH:
+            return xpath_to_css(value)
+        if by == By.CLASS_NAME:
+            return f".{value}"
+        if by == By.ID:
+            return f"#{value}"
+        if by == By.TAG_NAME:
+            return value
+        raise NotImplementedError(f"Unsupported locator for static page: {by}")
+
+    def find_element(self, by=By.ID, value=None):
+        tag = self._tag.select_one(self._selector(by, value))
+        if tag is None:
+            raise NoSuchElementException(f"Unable to locate element: {value}")
+        return StaticElement(tag)
+
+    def find_elements(self, by=By.ID, value=None):
+        return [StaticElement(tag) for tag in self._tag.select(self._selector(by, value))]
+
+
+class StaticPage:
+    """
+    Stands for selenium driver over the page, which doesn't need javascript.
+    fetch(url) returns (url after redirects, html). Fetch errors are raised
+    as the driver ones, so the page is handled the same way as in browser.
+    """
+    is_static = True
+    window_handles = []
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._root = None
+        self.current_url = None
+        self.page_source = None
+
+    def get(self, url):
+        try:
+            (self.current_url, self.page_source) = self._fetch(url)
+        except asyncio.TimeoutError:
+            raise TimeoutException(f"Page is loading too long: {url}")
+        except FetchFailed as e:
+            raise WebDriverException(str(e))
+
+        self._root = StaticElement(BeautifulSoup(self.page_source, "html.parser"))
+
+    def find_element(self, by=By.ID, value=None):
+        return self._root.find_element(by, value)
+
+    def find_elements(self, by=By.ID, value=None):
+        return self._root.find_elements(by, value)
+
+    def close(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+class HttpFetcher:
+    """
+    Keeps one aiohttp session with the pooled connections for all pages
+    """
+
+    max_connections = 20
+    max_connections_per_host = 4
+    timeout = 15
+    max_page_size = 5 * 1024 * 1024
+
+    def __init__(self):
+        self.session: aiohttp.ClientSession = None
+        self.fetched = 0
+        self.failed = 0
+
+    async def open(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                ttl_dns_cache=300,
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={
+                "User-Agent": get_user_agents().random,
+                "Accept": "text/html,application/xhtml+xml",
+                "Accept-Language": "ru-RU,ru;q=0.9,en;q=0.8",
+            },
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self, url):
+        """
+        Returns url after redirects and html of the page. Pages which are
+        blocked or failed on the server side raise FetchFailed, 404 pages
+        are returned as is, parsers recognize them
+        """
+        try:
+            async with self.session.get(url, allow_redirects=True) as response:
+                if response.status >= 500 or response.status in (401, 403, 429):
+                    raise FetchFailed(f"Unexpected status, url:{url} status:{response.status}")
+
+                content_type = response.headers.get("Content-Type", "")
+                if "html" not in content_type:
+                    raise FetchFailed(f"Not html, url:{url} content_type:{content_type}")
+
+                body = bytearray()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    body += chunk
+                    if len(body) > self.max_page_size:
+                        raise FetchFailed(f"Page is too big, url:{url}")
+
+                try:
+                    encoding = response.get_encoding()
+                except (RuntimeError, LookupError):
+                    encoding = "utf-8"
+
+                html = body.decode(encoding, errors="replace")
+                self.fetched += 1
+                return str(response.url), html
+        except aiohttp.ClientError as e:
+            self.failed += 1
+            raise FetchFailed(f"Can't fetch, url:{url} err:{e!r}")
+        except (FetchFailed, asyncio.TimeoutError):
+            self.failed += 1
+            raise
+
+    def stats(self):
+        return {
+            "fetched": self.fetched,
+            "failed": self.failed,
+        }
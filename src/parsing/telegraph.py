@@ -13,6 +13,8 @@ log.setLevel(logging.INFO)
 
 
 class TelegraphParser(Parser):
+    static_html = True
+
     CSS_DESCRIPTION = ".tl_article"  # everything else
     S_404 = ".tl_message"
 
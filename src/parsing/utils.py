@@ -1,3 +1,9 @@
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Query parameters which don't change the page, only tell where the visitor came from
+TRACKING_PARAMS = {"from", "hhtmfrom", "hhtmfromlabel", "ref", "fbclid", "gclid", "yclid"}
+
+
 def remove_spaces(text):
     if len(text.strip()) == 0:
         return text
@@ -14,3 +20,23 @@ def remove_spaces(text):
 
     right_n = n
     return "\n" * left_n + text.strip() + "\n" * right_n
+
+
+def canonical_url(url):
+    """
+    The same page posted with different tracking params, fragment, letter
+    case of the host or trailing slash gives the same url
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+
+    query = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not name.lower().startswith("utm_") and name.lower() not in TRACKING_PARAMS
+    )
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit(("https" if parts.scheme in ("http", "https") else parts.scheme, host, path, urlencode(query), ""))
@@ -0,0 +1,318 @@
+import base64
+import gzip
+import json
+import logging
+import os
+import re
+import struct
+import zlib
+from itertools import groupby
+
+import aiosqlite
+from telethon.extensions import BinaryReader
+from telethon.tl.alltlobjects import LAYER
+
+from common.db import safe_db_execute
+from common.utils import str_utc_time
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+ARCHIVE_VERSION = 1
+
+CREATE_ARCHIVE_INDEX = """
+    CREATE TABLE IF NOT EXISTS messages(
+        channel_id INTEGER,
+        message_id INTEGER,
+        date TEXT,
+        segment INTEGER, /* number of the segment file */
+        offset INTEGER, /* of the record in the segment, past the length prefix */
+        length INTEGER, /* of the compressed record */
+        PRIMARY KEY (channel_id, message_id)
+    ) WITHOUT ROWID;
+"""
+
+GET_ARCHIVED_IDS = """
+    SELECT message_id
+    FROM messages
+    WHERE channel_id = ? AND message_id IN ({placeholders})
+"""
+
+INSERT_ARCHIVED = """
+    INSERT OR IGNORE 
+    INTO messages(channel_id, message_id, date, segment, offset, length) 
+    VALUES(?,?,?,?,?,?)
+"""
+
+GET_ARCHIVED = """
+    SELECT segment, offset, length
+    FROM messages
+    WHERE channel_id = ? AND message_id = ?
+"""
+
+GET_CHANNEL_ARCHIVE = """
+    SELECT segment, offset, length
+    FROM messages
+    WHERE channel_id = ? AND message_id > ?
+    ORDER BY message_id
+"""
+
+COUNT_ARCHIVED = """
+    SELECT channel_id, COUNT(*)
+    FROM messages
+    GROUP BY channel_id
+"""
+
+
+def archive_path(environment):
+    if environment == "DEV":
+        return os.path.join(os.getcwd(), "archive", "dev")
+    elif environment == "TEST":
+        return os.path.join(os.getcwd(), "archive", "test")
+    else:
+        return os.path.join(os.getcwd(), "archive", "prod")
+
+
+class ArchivedChat:
+    """
+    Stands for message.chat of the restored message, get_original_pid_cid
+    needs only the username
+    """
+
+    def __init__(self, channel_id, username=None, title=None):
+        self.id = channel_id
+        self.username = username
+        self.title = title
+
+
+def serialize_message(message, chat=None) -> dict:
+    """
+    Message is kept as Telegram sends it: text, entities, reply markup,
+    reactions and forward info, serialized with the TL schema of the
+    current layer
+    """
+    chat = chat or message.chat
+    return {
+        "version": ARCHIVE_VERSION,
+        "layer": LAYER,
+        "channel_id": message.peer_id.channel_id,
+        "channel_username": getattr(chat, "username", None),
+        "channel_title": getattr(chat, "title", None),
+        "message_id": message.id,
+        "date": str_utc_time(message.date),
+        "tl": base64.b64encode(bytes(message)).decode("ascii"),
+    }
+
+
+def restore_message(record):
+    if record["layer"] != LAYER:
+        log.debug(f"Restoring message archived with another layer "
+                  f"layer:{record['layer']} "
+                  f"current_layer:{LAYER}")
+
+    tl = record["tl"]
+    if isinstance(tl, str):
+        tl = base64.b64decode(tl)
+
+    message = BinaryReader(tl).tgread_object()
+    message._chat = ArchivedChat(record["channel_id"], record["channel_username"], record["channel_title"])
+    return message
+
+
+def iter_archive(path):
+    """
+    Yields records of .jsonl.gz archive, oldest first. Such archives were
+    written before MessageArchive, they are only read
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class MessageArchive:
+    """
+    Append-only store of raw messages. Records are compressed one by one and
+    appended to segment files, so any message is read with one seek. SQLite
+    index keeps the position of every message by channel, and lets skip the
+    messages archived before.
+
+    Segment is a sequence of: 4 bytes of length, zlib(json header + "\\n" + TL bytes)
+    """
+
+    segment_size = 64 * 1024 * 1024
+    compression_level = 6
+
+    def __init__(self, path):
+        self.path = path
+        self.appended = 0
+
+        self._db = None
+        self._segment = 0
+        self._file = None
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, f"segment-{segment:06d}.bin")
+
+    def segments(self):
+        return sorted(
+            int(match.group(1))
+            for match in (re.fullmatch(r"segment-(\d+)\.bin", name) for name in os.listdir(self.path))
+            if match
+        )
+
+    async def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._db = await aiosqlite.connect(os.path.join(self.path, "index.sqlite"))
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.executescript(CREATE_ARCHIVE_INDEX)
+        await self._db.commit()
+
+        segments = self.segments()
+        self._segment = segments[-1] if segments else 1
+        self._file = open(self.segment_path(self._segment), "ab")
+
+    async def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    @staticmethod
+    def encode(record) -> bytes:
+        tl = base64.b64decode(record.pop("tl"))
+        header = json.dumps(record, ensure_ascii=False).encode("utf-8")
+        return header + b"\n" + tl
+
+    @staticmethod
+    def decode(payload) -> dict:
+        header, tl = payload.split(b"\n", 1)
+        record = json.loads(header)
+        record["tl"] = tl
+        return record
+
+    def _write(self, payload):
+        if self._file.tell() >= self.segment_size:
+            self._file.close()
+            self._segment += 1
+            self._file = open(self.segment_path(self._segment), "ab")
+
+        compressed = zlib.compress(payload, self.compression_level)
+        self._file.write(struct.pack(">I", len(compressed)))
+        offset = self._file.tell()
+        self._file.write(compressed)
+        return self._segment, offset, len(compressed)
+
+    async def append_many(self, messages, chat=None):
+        """
+        Archives the messages, which aren't archived yet, returns their number
+        """
+        if self._db is None:
+            return 0
+
+        num_appended = 0
+        messages = sorted(messages, key=lambda message: message.peer_id.channel_id)
+        for channel_id, channel_messages in groupby(messages, key=lambda message: message.peer_id.channel_id):
+            channel_messages = list(channel_messages)
+            message_ids = [message.id for message in channel_messages]
+
+            placeholders = ",".join("?" * len(message_ids))
+            cursor = await safe_db_execute(self._db, GET_ARCHIVED_IDS.format(placeholders=placeholders),
+                                           [channel_id, *message_ids])
+            archived_ids = {message_id for (message_id,) in await cursor.fetchall()}
+
+            rows = []
+            for message in channel_messages:
+                if message.id in archived_ids:
+                    continue
+                archived_ids.add(message.id)
+
+                record = serialize_message(message, chat=chat)
+                (segment, offset, length) = self._write(self.encode(record))
+                rows.append((channel_id, message.id, record["date"], segment, offset, length))
+
+            if not rows:
+                continue
+
+            # Index is written only after the records are on disk
+            self._file.flush()
+            await self._db.executemany(INSERT_ARCHIVED, rows)
+            await self._db.commit()
+            num_appended += len(rows)
+
+        self.appended += num_appended
+        return num_appended
+
+    def _read(self, files, segment, offset, length):
+        f = files.get(segment)
+        if f is None:
+            f = files[segment] = open(self.segment_path(segment), "rb")
+
+        f.seek(offset)
+        return self.decode(zlib.decompress(f.read(length)))
+
+    async def get(self, channel_id, message_id):
+        cursor = await safe_db_execute(self._db, GET_ARCHIVED, [channel_id, message_id])
+        row = await cursor.fetchone()
+        if not row:
+            return None
+
+        self._file.flush()
+        files = {}
+        try:
+            return self._read(files, *row)
+        finally:
+            for f in files.values():
+                f.close()
+
+    async def iter_channel(self, channel_id, min_id=0):
+        """
+        Yields records of the channel above min_id, oldest first
+        """
+        cursor = await safe_db_execute(self._db, GET_CHANNEL_ARCHIVE, [channel_id, min_id])
+        rows = await cursor.fetchall()
+
+        self._file.flush()
+        files = {}
+        try:
+            for row in rows:
+                yield self._read(files, *row)
+        finally:
+            for f in files.values():
+                f.close()
+
+    def iter_all(self):
+        """
+        Yields all records in the order they were archived, reading segments
+        sequentially, without the index
+        """
+        if self._file is not None:
+            self._file.flush()
+
+        for segment in self.segments():
+            with open(self.segment_path(segment), "rb") as f:
+                while True:
+                    prefix = f.read(4)
+                    if len(prefix) < 4:
+                        break
+
+                    (length,) = struct.unpack(">I", prefix)
+                    compressed = f.read(length)
+                    if len(compressed) < length:
+                        # Unfinished write
+                        break
+
+                    yield self.decode(zlib.decompress(compressed))
+
+    async def stats(self):
+        cursor = await safe_db_execute(self._db, COUNT_ARCHIVED)
+        counts = dict(await cursor.fetchall())
+        return {
+            "channels": len(counts),
+            "messages": sum(counts.values()),
+            "segments": len(self.segments()),
+            "appended": self.appended,
+        }
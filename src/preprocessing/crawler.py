@@ -0,0 +1,227 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from functools import partial
+
+import telethon
+from pytz import utc
+
+from common.db import safe_db_execute
+from common.logging import cls_name, shorten_text
+from common.telegram import get_original_pid_cid
+from common.utils import str_utc_time
+from db.sqlite import GET_CHANNEL_SYNC, SET_CHANNEL_LAST_MESSAGE_ID, SET_CHANNEL_DEEP_SYNCED
+from preprocessing.jobs import PostJob
+from preprocessing.pipeline import Pipeline
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class ChannelProgress:
+    """
+    Tracks messages of one channel, which have been fetched but not yet
+    processed. Messages are processed out of order, the high-water mark is
+    moved only over the continuous prefix of processed messages.
+    """
+
+    def __init__(self, peer, channel_name, deep, last_message_id):
+        self.peer = peer
+        self.channel_name = channel_name
+        self.deep = deep
+        self.last_message_id = last_message_id
+
+        self.max_message_id = last_message_id or 0
+        self.num_fetched = 0
+        self.num_skipped = 0
+        self.num_failed = 0
+        self.failed = False
+
+        self._pending = deque()
+        self._processed = set()
+        self._outstanding = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def fetched(self, message_id):
+        self._pending.append(message_id)
+        self._outstanding += 1
+        self._idle.clear()
+        self.num_fetched += 1
+        self.max_message_id = max(self.max_message_id, message_id)
+
+    def processed(self, message_id, success=True):
+        """
+        Returns new high-water mark, if it can be moved
+        """
+        self._outstanding -= 1
+        if self._outstanding == 0:
+            self._idle.set()
+
+        if not success:
+            # Keep the mark before the failed message, it will be retried next time
+            self.failed = True
+            self.num_failed += 1
+        self._processed.add(message_id)
+
+        mark = None
+        while self._pending and self._pending[0] in self._processed:
+            message_id = self._pending.popleft()
+            self._processed.discard(message_id)
+            mark = message_id
+
+        if self.failed or self.deep:
+            return None
+        return mark
+
+    async def wait_processed(self):
+        await self._idle.wait()
+
+
+class ChannelCrawler:
+    """
+    Fetches several channels concurrently and feeds their messages into the
+    ingestion pipeline. The pipeline queues are bounded, so fetching stops
+    when the downstream stages are saturated. FloodWait on fetching pauses
+    only the channel which got it, and the channel resumes from the last
+    fetched page.
+
+    The stages don't call Telegram, a job failed in any of them isn't
+    retried by the pipeline. The channel mark is kept before the failed
+    message instead, so it is fetched and processed again on the next sync.
+    """
+
+    def __init__(self, preprocessing, iter_channel_messages, cutoff_date, max_channels=3, page_size=100):
+        self.preprocessing = preprocessing
+        self.iter_channel_messages = iter_channel_messages
+        self.cutoff_date = cutoff_date
+        self.max_channels = max_channels
+        # Messages checked against db at once
+        self.page_size = page_size
+
+    @property
+    def client(self):
+        return self.preprocessing.client
+
+    async def crawl(self, db, channels, deep=None):
+        semaphore = asyncio.Semaphore(self.max_channels)
+
+        pipeline = Pipeline(self.preprocessing.ingestion_stages(), on_done=partial(self.done, db))
+        async with pipeline:
+            await asyncio.gather(*[
+                self.fetch_channel(db, semaphore, pipeline, peer, channel_name, deep)
+                for peer, channel_name, _ in channels
+            ])
+            await pipeline.join()
+
+    async def get_channel(self, peer):
+        # Try to get from cache first
+        channel = self.client.session.get_input_entity(peer)
+        if not channel:
+            channel = await self.client.get_input_entity(peer)
+        return channel
+
+    def iter_messages(self, channel, progress, resume_id):
+        if progress.deep:
+            # Newest first, down to the cutoff date
+            return self.iter_channel_messages(self.client, channel,
+                                              cutoff_date=self.cutoff_date,
+                                              offset_id=resume_id or 0)
+
+        # Oldest first, above the high-water mark
+        return self.iter_channel_messages(self.client, channel,
+                                          min_id=resume_id or progress.last_message_id,
+                                          reverse=True)
+
+    async def fetch_channel(self, db, semaphore, pipeline, peer, channel_name, deep):
+        cursor = await safe_db_execute(db, GET_CHANNEL_SYNC, [peer.channel_id])
+        (last_message_id, deep_synced_at) = await cursor.fetchone() or (None, None)
+
+        if deep is None:
+            deep = last_message_id is None or self.preprocessing.is_deep_sync_due(deep_synced_at)
+
+        progress = ChannelProgress(peer, channel_name, deep, last_message_id)
+        resume_id = None
+
+        log.info(f"{cls_name(self)}: "
+                 f"Start checking channel: {shorten_text(channel_name)} "
+                 f"mode:{'deep' if deep else 'incremental'}")
+
+        while True:
+            try:
+                async with semaphore:
+                    channel = await self.get_channel(peer)
+                    page = []
+                    async for post_candidate in self.iter_messages(channel, progress, resume_id):
+                        page.append(post_candidate)
+                        if len(page) < self.page_size:
+                            continue
+
+                        await self.feed(db, pipeline, progress, page)
+                        resume_id = page[-1].id
+                        page = []
+
+                    if page:
+                        await self.feed(db, pipeline, progress, page)
+                break
+            except telethon.errors.rpcerrorlist.FloodWaitError as e:
+                log.warning(f"{cls_name(self)}: "
+                            f"Pausing channel on flood wait: {shorten_text(channel_name)} "
+                            f"seconds:{e.seconds}")
+                await asyncio.sleep(e.seconds)
+            except Exception as e:
+                log.exception(e)
+                progress.failed = True
+                break
+
+        await progress.wait_processed()
+
+        if progress.deep and not progress.failed:
+            await safe_db_execute(db, SET_CHANNEL_LAST_MESSAGE_ID, [peer.channel_id, progress.max_message_id])
+            await safe_db_execute(db, SET_CHANNEL_DEEP_SYNCED, [peer.channel_id, str_utc_time(datetime.now(utc))])
+            await db.commit()
+
+        log.info(f"{cls_name(self)}: "
+                 f"Synced channel: {shorten_text(channel_name)} "
+                 f"mode:{'deep' if deep else 'incremental'} "
+                 f"num_messages:{progress.num_fetched} "
+                 f"num_already_processed:{progress.num_skipped} "
+                 f"num_failed:{progress.num_failed} "
+                 f"failed:{progress.failed}")
+
+    async def feed(self, db, pipeline, progress, page):
+        page = [
+            post_candidate
+            for post_candidate in page
+            if post_candidate.date >= self.cutoff_date
+        ]
+
+        await self.preprocessing.archive_messages(page)
+
+        sources = [get_original_pid_cid(post_candidate)[0] for post_candidate in page]
+        processed = await self.preprocessing.find_processed_sources(db, sources)
+
+        mark = None
+        for post_candidate, source in zip(page, sources):
+            progress.fetched(post_candidate.id)
+            if source in processed:
+                progress.num_skipped += 1
+                mark = progress.processed(post_candidate.id) or mark
+                continue
+
+            # Blocks when the pipeline can't keep up
+            await pipeline.put(PostJob(post_candidate, progress.channel_name, progress))
+
+        if mark:
+            await safe_db_execute(db, SET_CHANNEL_LAST_MESSAGE_ID, [progress.peer.channel_id, mark])
+            await db.commit()
+
+    async def done(self, db, job, success):
+        self.preprocessing.release(job, success)
+
+        progress = job.progress
+        mark = progress.processed(job.post_candidate.id, success)
+        if mark:
+            await safe_db_execute(db, SET_CHANNEL_LAST_MESSAGE_ID, [progress.peer.channel_id, mark])
+            await db.commit()
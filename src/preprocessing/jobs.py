@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+from common.markdown import MarkdownPost
+
+
+class JobPosting:
+    def __init__(self, content, more_info, language, reject_reason):
+        self.content = content
+        self.more_info = more_info
+        self.language = language
+        self.reject_reason = reject_reason
+
+        self.embedding = None
+        self.similar_post = None
+        self.skipped = False
+        self.post_id = None
+
+
+class PostJob:
+    """
+    Telegram message on its way through the ingestion stages
+    """
+
+    def __init__(self, post_candidate, channel_name, progress=None):
+        self.post_candidate = post_candidate
+        self.channel_name = channel_name
+        self.progress = progress
+
+        self.markdown_post: MarkdownPost = None
+        self.date = None
+        self.source = None
+        self.original_tg_link = None
+        self.channel_stop_list = None
+        self.log_info = {}
+
+        # The whole message is rejected before parsing
+        self.reject_reason = None
+        # Registered in single-flight registry by source
+        self.in_flight = False
+        self.job_infos = []
+        self.postings: list[JobPosting] = []
+
+    def is_rejected(self):
+        return self.reject_reason is not None
+
+
+class RecentSources:
+    """
+    Bounded set of sources known to be in db, the least recently added are
+    forgotten first
+    """
+
+    def __init__(self, maxsize=100_000):
+        self.maxsize = maxsize
+        self._sources = OrderedDict()
+
+    def add(self, source):
+        self._sources[source] = None
+        self._sources.move_to_end(source)
+        while len(self._sources) > self.maxsize:
+            self._sources.popitem(last=False)
+
+    def __contains__(self, source):
+        return source in self._sources
+
+    def __len__(self):
+        return len(self._sources)
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import time
+
+import aiosqlite
+
+from common.logging import cls_name
+from db.sqlite import SQLLite3Service
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class StageMetrics:
+    def __init__(self):
+        self.processed = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.failed = 0
+        # Time spent in the handler
+        self.busy = 0.0
+        # Time jobs spent waiting in the stage queue
+        self.queued = 0.0
+        # Time the previous stage was blocked on the full queue
+        self.blocked = 0.0
+
+    def as_dict(self, queue_depth):
+        handled = self.processed + self.dropped + self.failed
+        return {
+            "queue": queue_depth,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "busy": round(self.busy, 1),
+            "avg": round(self.busy / handled, 2) if handled else 0.0,
+            "avg_queued": round(self.queued / handled, 2) if handled else 0.0,
+            "blocked": round(self.blocked, 1),
+        }
+
+
+class Stage:
+    """
+    One step of the pipeline. Handler is called as handler(db, job), where
+    db is a connection owned by the worker, or None if the stage doesn't need
+    one. Handler returns True to pass the job further, False when the job is
+    finished on this stage. Jobs matching skip pass through the stage as is.
+    """
+
+    def __init__(self, name, handler, num_workers=1, queue_size=10, db=False, skip=None):
+        self.name = name
+        self.handler = handler
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.db = db
+        self.skip = skip
+
+        self.metrics = StageMetrics()
+        self.queue: asyncio.Queue = None
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues. When a stage can't keep up, its
+    queue fills up and the previous stage blocks on putting the job, up to
+    the producer calling put(). on_done(job, success) is called once per job,
+    whenever it leaves the pipeline.
+    """
+
+    stats_period = 60
+
+    def __init__(self, stages, on_done=None):
+        self.stages = stages
+        self.on_done = on_done
+        self._tasks = []
+        self._started_at = None
+
+    async def start(self):
+        self._started_at = time.monotonic()
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+
+        for n, stage in enumerate(self.stages):
+            next_stage = self.stages[n + 1] if n + 1 < len(self.stages) else None
+            for _ in range(stage.num_workers):
+                self._tasks.append(asyncio.create_task(self.worker(stage, next_stage)))
+
+        self._tasks.append(asyncio.create_task(self.report()))
+
+    async def put(self, job):
+        await self._put(self.stages[0], job)
+
+    async def join(self):
+        # Jobs move forward only, so the queues are drained in order
+        for stage in self.stages:
+            await stage.queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+        self.log_stats()
+        return False
+
+    async def _put(self, stage, job):
+        started_at = time.monotonic()
+        await stage.queue.put((started_at, job))
+        stage.metrics.blocked += time.monotonic() - started_at
+
+    async def _done(self, job, success):
+        if not self.on_done:
+            return
+
+        try:
+            await self.on_done(job, success)
+        except Exception as e:
+            log.exception(e)
+
+    async def worker(self, stage, next_stage):
+        if stage.db:
+            # Every worker has its own connection, so that transactions don't mix
+            async with aiosqlite.connect(SQLLite3Service.db_path) as db:
+                await self._work(stage, next_stage, db)
+        else:
+            await self._work(stage, next_stage, None)
+
+    async def _work(self, stage, next_stage, db):
+        metrics = stage.metrics
+        while True:
+            (queued_at, job) = await stage.queue.get()
+            started_at = time.monotonic()
+            metrics.queued += started_at - queued_at
+
+            try:
+                if stage.skip and stage.skip(job):
+                    metrics.skipped += 1
+                    passed = True
+                else:
+                    passed = await stage.handler(db, job)
+                    metrics.busy += time.monotonic() - started_at
+                    if passed:
+                        metrics.processed += 1
+                    else:
+                        metrics.dropped += 1
+            except asyncio.CancelledError:
+                stage.queue.task_done()
+                raise
+            except Exception as e:
+                log.exception(e)
+                metrics.busy += time.monotonic() - started_at
+                metrics.failed += 1
+                if db:
+                    await db.rollback()
+                await self._done(job, False)
+                stage.queue.task_done()
+                continue
+
+            try:
+                if passed and next_stage:
+                    # Blocks while the next stage is saturated
+                    await self._put(next_stage, job)
+                else:
+                    await self._done(job, True)
+            finally:
+                stage.queue.task_done()
+
+    def stats(self):
+        return {
+            stage.name: stage.metrics.as_dict(stage.queue.qsize() if stage.queue else 0)
+            for stage in self.stages
+        }
+
+    def log_stats(self):
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0.0
+        stats = self.stats()
+        log.info(
+            f"{cls_name(self)}: "
+            f"Stage metrics "
+            f"elapsed:{elapsed:.1f}s \n" +
+            "\n".join(f"{name}: {metrics}" for name, metrics in stats.items())
+        )
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.stats_period)
+            self.log_stats()
@@ -14,6 +14,7 @@ from telegram.ext import CallbackQueryHandler, ContextTypes, \
 from common.db import safe_db_execute
 from common.logging import cls_name
 from common.post import prepare_post
+from common.startup import startup
 from common.telegram import AsyncRunApplication, WaitOnFloodTelegramClient, remove_posts_from_channel
 from db.embedding import PostsCollection
 from db.sqlite import SQLLite3Service, GET_POST_BY_TID, FLAG_POST_BY_TID, RESEND_POST_BY_TID, \
@@ -111,6 +112,7 @@ class PostManager(aiomisc.Service):
         # Service is ready
         self.start_event.set()
         self.post_map = await get_transient_posts_map(self.client, TRANSIENT_CHANNEL)
+        startup.ready(self)
 
         await asyncio.gather(
             self.application.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None),
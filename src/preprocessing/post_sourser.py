@@ -7,16 +7,12 @@ from datetime import datetime, timedelta
 
 import aiomisc
 import aiosqlite
-import chromadb
 import jsonschema
+import numpy as np
 import openai
 import telethon
-import tiktoken
-from aiolimiter import AsyncLimiter
 from aiomisc import get_context
 from aiosqlite import Connection
-from chromadb.api.models import Collection
-from chromadb.errors import IDAlreadyExistsError
 from jsonschema import validate
 from pytz import utc
 from telethon import events
@@ -27,16 +23,26 @@ from common.exceptions import IntegrityCheck, TokenLimitExceeded
 from common.logging import cls_name, shorten_text, humanize_time
 from common.markdown import MarkdownPost, ignore_asterics, remove_excessive_n, remove_weird_ending, \
     fix_brain_cancer
+from common.singleflight import SingleFlight
+from common.startup import startup
 from common.telegram import WaitOnFloodTelegramClient, TelegramTextTools, extract_button_text, get_original_pid_cid, \
     is_negative_sentiment
-from common.utils import get_match_percentage, get_prompt, str_utc_time, group_list
+from common.utils import get_match_percentage, get_prompt, str_utc_time, group_list, get_prompt_version, \
+    get_prompt_tokens, count_tokens
+from db.cache import GptResponseCache, cache_db_path
 from db.embedding import PostsCollection
-from db.sqlite import SQLLite3Service, GET_POST_BY_POST_ID, GET_POST_BY_SOURCE, INSERT_INTO_POSTS, POSTS_FOR_CLEAN, \
-    CLEAN_POSTS, COUNT_ACCEPTED_POSTS, GET_ALL_ACCEPTED_POSTS
+from db.reconcile import PostsReconciler
+from db.sqlite import SQLLite3Service, GET_POST_BY_POST_ID, INSERT_INTO_POSTS, POSTS_FOR_CLEAN, \
+    CLEAN_POSTS, GET_PROCESSED_SOURCES, GET_RECENT_SOURCES
+from gpt.scheduler import OpenAIScheduler, Priority, openai_priority
 from gpt.schemas.preprocess import schema as json_preprocess_schema
 from parsing.parsing import JobPostingParser
 from parsing.telegraph import TelegraphParser
+from preprocessing.archive import MessageArchive, archive_path
 from preprocessing.channels import ACTIVE_CHANNELS, get_stop_list
+from preprocessing.crawler import ChannelCrawler
+from preprocessing.jobs import JobPosting, PostJob, RecentSources
+from preprocessing.pipeline import Stage
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
@@ -96,6 +102,7 @@ class SetupTelegramSession(aiomisc.Service):
             f"Connected to telegram"
         )
         self.context['tg_client'] = self.client
+        startup.ready(self)
 
     async def stop(self, *args, **kwargs):
         self.client.disconnect()
@@ -103,64 +110,77 @@ class SetupTelegramSession(aiomisc.Service):
 
 class Preprocessing(aiomisc.Service):
     client: WaitOnFloodTelegramClient = None
-    _post_collection: chromadb.api.models.Collection = None
+    _post_collection: PostsCollection = None
     create_embedding = None
-    preprocessing_rate_limit: AsyncLimiter = None
+    scheduler: OpenAIScheduler = None
     parser: JobPostingParser = None
     channel_sync_period = None
+    # Periodical sync fetches only messages above the channel high-water mark,
+    # the walk back to the cutoff date is done once in a while as a repair
+    deep_sync_period = 60 * 60 * 24
+
+    # Channels fetched at once
+    crawler: ChannelCrawler = None
+    crawl_max_channels = 3
+
+    # Workers per ingestion stage, dedupe and persist always have one
+    ingestion_workers = {
+        "pre_dedupe": 2,
+        "parse": 2,
+        "decompose": 4,
+        "embed": 2,
+    }
+    ingestion_queue_size = 10
+    # Sub-posts of one digest decomposed and embedded at once
+    subpost_concurrency = 4
+    # Posts passed dedupe, but not in the index yet
+    unindexed: dict = None
+    # Messages in progress by source
+    inflight: SingleFlight = None
+
+    # Sources known to be in db, answer most of "already processed?" lookups
+    recent_sources: RecentSources = None
+    recent_sources_size = 100_000
+    # Max variables in one sqlite query is 999
+    sources_lookup_size = 500
+
+    # Decomposition of the same content with the same prompt and model is reused
+    use_gpt_cache = True
+    gpt_cache: GptResponseCache = None
+    gpt_calls = 0
+    gpt_cached = 0
+    gpt_tokens = 0
+
+    # Raw incoming messages are kept, to reprocess them without Telegram
+    use_archive = True
+    archive: MessageArchive = None
 
     futures = {}
     transient_map_cache = {}
 
-    async def sync_index_and_db(self, db):
-        cursor = await safe_db_execute(db, COUNT_ACCEPTED_POSTS)
-        (sqlite_accepted_count,) = await cursor.fetchone()
-        chroma_count = len(self._post_collection.peek(limit=0)["ids"])
-        if chroma_count == sqlite_accepted_count: return
-
-        log.warning(
-            f'{cls_name(self)}: '
-            f'Seems like mismatch between chroma and sqlite, '
-            f"sqlite_count: {sqlite_accepted_count} "
-            f"chroma_count: {chroma_count} "
-        )
-
-        rows = await safe_db_execute(db, GET_ALL_ACCEPTED_POSTS)
-        post_map = {
-            str(post_id): {
-                "text": text,
-                "source": source,
-            }
-            async for (post_id, source, text,) in rows or []
-        }
+    # Startup index cleaning and reconciliation, runs in the background
+    maintenance: asyncio.Task = None
 
-        index_ids = self._post_collection.get_posts(ids=list(post_map.keys()))["ids"]
-
-        # IDs in db which are not in index
-        mismatch_ids = sorted(list(set(post_map.keys()) - set(index_ids)))
-        for post_ids in group_list(mismatch_ids, 100):
-            texts = [post_map[post_id]["text"] for post_id in post_ids]
-            _, embeddings = await self.create_embedding(texts)
-
-            for n, (post_id, embedding) in enumerate(zip(post_ids, embeddings)):
-                await self._post_collection.insert_post(
-                    post_id=post_id,
-                    source=post_map[post_id]["source"],
-                    embedding=embedding
-                )
-
-                log.warning(
-                    f'{cls_name(self)}: '
-                    f'{n + 1}: Created missing index for, '
-                    f"post_id: {post_id} "
-                    f"source: {post_map[str(post_id)]['source']} "
-                )
-
-            await asyncio.sleep(1)
+    async def sync_index_and_db(self, db):
+        reconciler = PostsReconciler(self._post_collection, self.create_embedding)
+        await reconciler.run(db)
+
+    async def maintain_index(self):
+        """
+        Cleans and reconciles the index in the background, so that live
+        updates and syncing don't wait for it on startup
+        """
+        try:
+            async with aiosqlite.connect(SQLLite3Service.db_path) as db:
+                log.info(f"{cls_name(self)}: Removing old posts")
+                await self.remove_old_posts(db)
 
-        # IDs in index which are not in db
-        mismatch_ids = sorted(list(set(index_ids) - set(post_map.keys())))
-        await self._post_collection.remove_posts(ids=mismatch_ids)
+                log.info(f"{cls_name(self)}: Syncing index with db")
+                await self.sync_index_and_db(db)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception(e)
 
     async def remove_old_posts(self, db):
         cursor = await safe_db_execute(db, POSTS_FOR_CLEAN.format(days=CUTFOFF_DAYS))
@@ -234,16 +254,30 @@ class Preprocessing(aiomisc.Service):
                 openai.error.APIError,
         )
     )
-    async def gpt_decompose(self, content):
-        async with self.preprocessing_rate_limit:
-            enc = tiktoken.get_encoding("cl100k_base")
-            num_tokens = len(enc.encode(get_prompt("preprocess.txt") + content))
+    async def gpt_decompose(self, content, model="gpt-3.5-turbo-0613"):
+        cache_key = GptResponseCache.key("decompose", model, get_prompt_version("preprocess.txt"), content)
+        if self.gpt_cache:
+            cached = await self.gpt_cache.get(cache_key)
+            if cached and cached["response"] is not None:
+                self.gpt_cached += 1
+                log.debug(
+                    f"{cls_name(self)}: "
+                    f"GPT response served from cache "
+                    f"tokens_saved:{cached['tokens']} "
+                    f"text:'{shorten_text(content)}'"
+                )
+                return 0, cached["response"]
 
-            if num_tokens > 7500:
-                raise TokenLimitExceeded(num_tokens=num_tokens)
+        # Only the content is encoded, the prompt tokens are counted once
+        num_tokens = get_prompt_tokens("preprocess.txt") + count_tokens(content)
 
+        if num_tokens > 7500:
+            raise TokenLimitExceeded(num_tokens=num_tokens)
+
+        # approximate answer tokens
+        async with self.scheduler.slot(model, num_tokens + 500) as reservation:
             chat_completions = await openai.ChatCompletion.acreate(
-                model="gpt-3.5-turbo-0613",
+                model=model,
                 temperature=0,
                 messages=[
                     {
@@ -257,6 +291,9 @@ class Preprocessing(aiomisc.Service):
                 ]
             )
             tokens_used = chat_completions['usage']['total_tokens']
+            reservation.used(tokens_used)
+            self.gpt_calls += 1
+            self.gpt_tokens += tokens_used
 
             log.debug(
                 f"{cls_name(self)}: "
@@ -287,13 +324,19 @@ class Preprocessing(aiomisc.Service):
             if not invalid_job_post:
                 validate(response, json_preprocess_schema)
 
-            return tokens_used, response
+            if self.gpt_cache:
+                await self.gpt_cache.put(cache_key, kind="decompose", model=model, tokens=tokens_used,
+                                         response=response)
 
-    async def extract_job_postings(self, markdown_text: MarkdownPost, channel_stop_list, original_tg_link,
-                                   log_info=None):
-        log_info = log_info or {}
+            return tokens_used, response
 
+    async def find_job_infos(self, markdown_text: MarkdownPost, original_tg_link):
+        """
+        Returns job infos found in the post and its external links, and the
+        postings rejected right away
+        """
         job_infos = []
+        rejected = []
 
         # Find all known external links which lead to job descriptions
         known_links = JobPostingParser.find_known_external_links(markdown_text)
@@ -309,12 +352,12 @@ class Preprocessing(aiomisc.Service):
         if processable_links:
             for (content, parser, final_link, language) in await self.parser.parse(urls=processable_links):
                 if not content:
-                    yield (
+                    rejected.append((
                         content or markdown_text,
                         None,
                         None,
                         f"can't process {final_link}"
-                    )
+                    ))
                     continue
 
                 external = content.all_external_links()
@@ -336,13 +379,13 @@ class Preprocessing(aiomisc.Service):
         # If we found some known link, but it is currently unprocessable
         # than skip this post, and it is mostly just a link
         if known_links and not processable_links and (len(markdown_text) < 700 or len(known_links) > 8):
-            yield (
+            rejected.append((
                 markdown_text,
                 None,
                 None,
                 "known_links more than one, or length is small"
-            )
-            return
+            ))
+            return [], rejected
 
         if not processable_links and len(markdown_text) >= 500 and len(known_links) <= 1:
             external = markdown_text.all_external_links()
@@ -357,68 +400,85 @@ class Preprocessing(aiomisc.Service):
                     "external": external
                 })
 
-        del known_links
-        del processable_links
+        return job_infos, rejected
 
-        temp_job_infos = []
-        for job_info in job_infos:
-            # TODO: asyncio.gather
+    async def decompose_job_info(self, job_info, log_info):
+        """
+        Returns job info decomposed by GPT, or None if GPT failed on it
+        """
+        # Process content with GPT if it came from telegram or telegraph
+        # it might contain contacts or ads
+        if job_info["origin"] not in ["telegram",
+                                      "TelegraphParser"]:
+            return job_info
 
-            # Process content with GPT if it came from telegram or telegraph
-            # it might contain contacts or ads
-            if job_info["origin"] not in ["telegram",
-                                          "TelegraphParser"]:
-                temp_job_infos.append(job_info)
-                continue
+        try:
+            log.info(
+                f'{cls_name(self)}: '
+                f'Checking with gpt, '
+                f"source:{log_info.get('source')} "
+                f"post: {log_info.get('original_tg_link')} "
+                f"channel:{shorten_text(log_info.get('channel_name'))} "
+                f'\ntext:\"{shorten_text(job_info["content"].plain())}\" '
+            )
 
-            try:
-                log.info(
-                    f'{cls_name(self)}: '
-                    f'Checking with gpt, '
-                    f"source:{log_info.get('source')} "
-                    f"post: {log_info.get('original_tg_link')} "
-                    f"channel:{shorten_text(log_info.get('channel_name'))} "
-                    f'\ntext:\"{shorten_text(job_info["content"].plain())}\" '
-                )
+            # job_info["content"] = PostCleaner().clean_channel_ads(
+            #     content=job_info["content"],
+            #     language="russian",
+            #     channel_stop_list=channel_stop_list
+            # )
 
-                # job_info["content"] = PostCleaner().clean_channel_ads(
-                #     content=job_info["content"],
-                #     language="russian",
-                #     channel_stop_list=channel_stop_list
-                # )
+            metadata = pprint.pformat(job_info.get("external", []))
+            content_for_gpt = job_info["content"].markdown() + "\n\nExternal metadata:\n\n" + metadata
 
-                metadata = pprint.pformat(job_info.get("external", []))
-                content_for_gpt = job_info["content"].markdown() + "\n\nExternal metadata:\n\n" + metadata
+            _, gpt_job_info = await self.gpt_decompose(content_for_gpt)
+            if not gpt_job_info:
+                return None
 
-                _, gpt_job_info = await self.gpt_decompose(content_for_gpt)
-                if not gpt_job_info:
-                    continue
+            job_info.update(gpt_job_info)
+            return job_info
+        except jsonschema.exceptions.ValidationError as e:
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Skipping, corrupted GPT request or response "
+                f"source:{log_info.get('source')} "
+                f"post: {log_info.get('original_tg_link')} "
+                f"channel:{shorten_text(log_info.get('channel_name'))} "
+                f"\ntext:{shorten_text(job_info['content'].plain())}"
+                f"\nerr:{str(e)}"
+            )
+            return None
+        except TokenLimitExceeded as e:
+            log.warning(f"{cls_name(self)}: "
+                        f"Skipping, GPT token limit will be exceeded"
+                        f"num_tokens:{e.num_tokens} "
+                        f"source:{log_info.get('source')} "
+                        f"post: {log_info.get('original_tg_link')} "
+                        f"channel:{shorten_text(log_info.get('channel_name'))} "
+                        f"\ntext:{shorten_text(job_info['content'].plain())}")
+            return None
+
+    async def decompose_job_infos(self, job_infos, log_info=None):
+        """
+        Decomposes job infos from telegram and telegraph with GPT, drops the
+        ones GPT failed on. Up to subpost_concurrency job infos of one post
+        are decomposed at once, the order is kept.
+        """
+        log_info = log_info or {}
+        semaphore = asyncio.Semaphore(self.subpost_concurrency)
 
-                job_info.update(gpt_job_info)
-                temp_job_infos.append(job_info)
-            except jsonschema.exceptions.ValidationError as e:
-                log.warning(
-                    f"{cls_name(self)}: "
-                    f"Skipping, corrupted GPT request or response "
-                    f"source:{log_info.get('source')} "
-                    f"post: {log_info.get('original_tg_link')} "
-                    f"channel:{shorten_text(log_info.get('channel_name'))} "
-                    f"\ntext:{shorten_text(job_info['content'].plain())}"
-                    f"\nerr:{str(e)}"
-                )
-                continue
-            except TokenLimitExceeded as e:
-                log.warning(f"{cls_name(self)}: "
-                            f"Skipping, GPT token limit will be exceeded"
-                            f"num_tokens:{e.num_tokens} "
-                            f"source:{log_info.get('source')} "
-                            f"post: {log_info.get('original_tg_link')} "
-                            f"channel:{shorten_text(log_info.get('channel_name'))} "
-                            f"\ntext:{shorten_text(job_info['content'].plain())}")
-                continue
+        async def decompose(job_info):
+            async with semaphore:
+                return await self.decompose_job_info(job_info, log_info)
 
-        job_infos = temp_job_infos
-        del temp_job_infos
+        job_infos = await asyncio.gather(*[decompose(job_info) for job_info in job_infos])
+        return [job_info for job_info in job_infos if job_info]
+
+    def iter_job_postings(self, job_infos, markdown_text: MarkdownPost, channel_stop_list, log_info=None):
+        """
+        Yields (content, more_info, language, reject_reason) per job info
+        """
+        log_info = log_info or {}
 
         for k, job_info in enumerate(job_infos):
             if not job_info.get("category") or job_info.get("category") not in ["one_job_description"]:
@@ -616,149 +676,321 @@ class Preprocessing(aiomisc.Service):
                 None
             )
 
-    async def check_and_save(self, db, post_candidate, channel_name):
-        markdown_post = MarkdownPost(post_candidate.raw_text, post_candidate.entities)
-        markdown_post += extract_button_text(post_candidate)
-        post_candidate_date = str_utc_time(post_candidate.date)
+    def ingestion_stages(self):
+        workers = self.ingestion_workers
+        queue_size = self.ingestion_queue_size
+        return [
+            Stage("pre_dedupe", self.stage_pre_dedupe, workers["pre_dedupe"], queue_size, db=True),
+            Stage("parse", self.stage_parse, workers["parse"], queue_size, skip=PostJob.is_rejected),
+            Stage("decompose", self.stage_decompose, workers["decompose"], queue_size, skip=PostJob.is_rejected),
+            Stage("embed", self.stage_embed, workers["embed"], queue_size, skip=PostJob.is_rejected),
+            # Single worker, so that a post can't slip past its duplicate being checked at the same time
+            Stage("dedupe", self.stage_dedupe, 1, queue_size, db=True, skip=PostJob.is_rejected),
+            Stage("persist", self.stage_persist, 1, queue_size, db=True),
+        ]
 
-        source, original_tg_link = get_original_pid_cid(post_candidate)
-        channel_stop_list = get_stop_list(source)
+    async def check_and_save(self, db, post_candidate, channel_name):
+        job = PostJob(post_candidate, channel_name)
+        success = False
+        try:
+            for stage in self.ingestion_stages():
+                if stage.skip and stage.skip(job):
+                    continue
+                if not await stage.handler(db, job):
+                    break
+            success = True
+        finally:
+            self.release(job, success)
+
+    async def load_recent_sources(self, db):
+        self.recent_sources = RecentSources(self.recent_sources_size)
+
+        cursor = await safe_db_execute(db, GET_RECENT_SOURCES, [self.recent_sources_size])
+        # Oldest first, so that the most recent are forgotten last
+        for (source,) in reversed(await cursor.fetchall()):
+            self.recent_sources.add(source)
+
+    async def find_processed_sources(self, db, sources):
+        """
+        Returns the sources which are already in db, with one query per
+        lookup chunk for the ones not known from memory
+        """
+        processed = {source for source in sources if source in self.recent_sources}
+        unknown = list({source for source in sources if source not in processed})
+
+        for chunk in group_list(unknown, self.sources_lookup_size):
+            placeholders = ",".join("?" * len(chunk))
+            cursor = await safe_db_execute(db, GET_PROCESSED_SOURCES.format(placeholders=placeholders), chunk)
+            for (source,) in await cursor.fetchall():
+                processed.add(source)
+                self.recent_sources.add(source)
+
+        return processed
+
+    async def archive_messages(self, messages, chat=None):
+        if not self.archive:
+            return
 
-        log_info = {
-            "source": source,
-            "original_tg_link": original_tg_link,
-            "channel_name": channel_name
+        try:
+            await self.archive.append_many(messages, chat=chat)
+        except Exception as e:
+            # Archive is never a reason to lose the message
+            log.exception(e)
+
+    def release(self, job, success=True):
+        """
+        Forgets the postings of the job, which passed dedupe, once they are
+        saved or failed, and lets the callers waiting for the same source go
+        """
+        for posting in job.postings:
+            self.unindexed.pop(id(posting), None)
+
+        if job.in_flight:
+            job.in_flight = False
+            self.inflight.end(job.source, success)
+
+    async def stage_pre_dedupe(self, db, job):
+        post_candidate = job.post_candidate
+        job.markdown_post = MarkdownPost(post_candidate.raw_text, post_candidate.entities)
+        job.markdown_post += extract_button_text(post_candidate)
+        job.date = str_utc_time(post_candidate.date)
+
+        job.source, job.original_tg_link = get_original_pid_cid(post_candidate)
+        job.channel_stop_list = get_stop_list(job.source)
+
+        job.log_info = {
+            "source": job.source,
+            "original_tg_link": job.original_tg_link,
+            "channel_name": job.channel_name
         }
 
-        cursor = await db.execute(GET_POST_BY_SOURCE, [source])
+        # Live updates and the periodical sync might pick up the same message at once
+        while self.inflight.get(job.source):
+            log.debug(
+                f"{cls_name(self)}: "
+                f"Waiting for the same post processed by another caller "
+                f"source:{job.source} "
+                f"post: {job.original_tg_link} "
+            )
+            if await self.inflight.wait(job.source):
+                return False
+            # Failed there, try once again here
+
+        self.inflight.begin(job.source)
+        job.in_flight = True
 
         # WARNING:
         # Currently we check whether the telegram post
         # has been processed, it might lead to job
         # postings missing if only half of digest been processed
-        if await cursor.fetchone():
+        if job.source in self.recent_sources or await self.find_processed_sources(db, [job.source]):
             log.debug(
                 f"{cls_name(self)}: "
                 f"Skip processing post already in db"
-                f"source:{source} "
-                f"post: {original_tg_link} "
-                # f"channel:{shorten_text(channel_name)} "
-                # f"text: {shorten_text(post_text_with_button)}"
+                f"source:{job.source} "
+                f"post: {job.original_tg_link} "
             )
-            return
+            return False
 
         if post_candidate.reactions and is_negative_sentiment(post_candidate.reactions.results):
             log.info(
                 f"{cls_name(self)}: "
                 f"Skipping, negative sentiment "
-                f"source:{source} "
-                f"post: {original_tg_link} "
-            )
-            await safe_db_execute(
-                db, INSERT_INTO_POSTS, (
-                    None,
-                    markdown_post.plain(),
-                    post_candidate_date,
-                    source,
-                    'rejected',
-                    'negative sentiment',
-                    None,
-                    None,
-                    original_tg_link,
-                    markdown_post.json_entities(),
-                )
+                f"source:{job.source} "
+                f"post: {job.original_tg_link} "
             )
-            return
+            job.reject_reason = 'negative sentiment'
+            return True
 
         log.debug(
             f"{cls_name(self)}: "
             f"Start processing candidate"
-            f"source:{source} "
-            f"post: {original_tg_link} "
-            # f"channel:{shorten_text(channel_name)} "
-            # f"text: {shorten_text(post_text_with_button)}"
+            f"source:{job.source} "
+            f"post: {job.original_tg_link} "
         )
+        return True
+
+    async def stage_parse(self, db, job):
+        job.job_infos, rejected = await self.find_job_infos(job.markdown_post, job.original_tg_link)
+        job.postings.extend(JobPosting(*job_posting) for job_posting in rejected)
+        return True
+
+    async def stage_decompose(self, db, job):
+        job_infos = await self.decompose_job_infos(job.job_infos, log_info=job.log_info)
+        job.job_infos = []
+
+        job.postings.extend(
+            JobPosting(*job_posting)
+            for job_posting in self.iter_job_postings(job_infos,
+                                                      markdown_text=job.markdown_post,
+                                                      channel_stop_list=job.channel_stop_list,
+                                                      log_info=job.log_info)
+        )
+        return True
 
-        at_least_one_returned = False
-        async for job_posting in self.extract_job_postings(markdown_text=markdown_post,
-                                                           log_info=log_info,
-                                                           channel_stop_list=channel_stop_list,
-                                                           original_tg_link=original_tg_link):
+    async def embed_posting(self, posting):
+        log.debug(
+            f'{cls_name(self)}: '
+            f'Start handling sub-post, '
+            f'more_info:{posting.more_info} '
+            f'text:{shorten_text(posting.content.plain())} '
+        )
 
-            at_least_one_returned = True
+        try:
+            _, embeddings = await self.create_embedding([posting.content.plain()])
+        except openai.error.InvalidRequestError as e:
+            log.warning(
+                f'{cls_name(self)}: '
+                f'Skip, can\'t find same post, '
+                f'err: {e} '
+                f'text:{shorten_text(posting.content.plain())} '
+            )
+            posting.skipped = True
+            return
 
-            (content, more_info, language, reject_reason,) = job_posting
-            if reject_reason:
-                await safe_db_execute(
-                    db, INSERT_INTO_POSTS, (
-                        None,
-                        content.plain() if content else None,
-                        post_candidate_date,  # TODO: Get from parser?
-                        source,
-                        'rejected',
-                        reject_reason,
-                        more_info or None,
-                        language or None,
-                        original_tg_link,
-                        content.json_entities() if content else None,
-                    )
-                )
+        posting.embedding = embeddings[0]
+
+    async def stage_embed(self, db, job):
+        semaphore = asyncio.Semaphore(self.subpost_concurrency)
+
+        async def embed(posting):
+            async with semaphore:
+                await self.embed_posting(posting)
+
+        await asyncio.gather(*[
+            embed(posting)
+            for posting in job.postings
+            if not posting.reject_reason
+        ])
+        return True
+
+    def find_same_unindexed_post(self, posting):
+        """
+        Looks for the same post among the ones which passed dedupe, but
+        aren't in the index yet
+        """
+        embedding = np.asarray(posting.embedding, dtype=np.float32)
+        embedding = embedding / (np.linalg.norm(embedding) or 1)
+
+        for other in self.unindexed.values():
+            other_embedding = np.asarray(other.embedding, dtype=np.float32)
+            distance = 1 - float(embedding @ other_embedding) / (np.linalg.norm(other_embedding) or 1)
+            if distance > 0.1:
                 continue
 
-            log.debug(
-                f'{cls_name(self)}: '
-                f'Start handling sub-post, '
-                f'more_info:{more_info} '
-                f'text:{shorten_text(content.plain())} '
-            )
+            match_ratio = get_match_percentage(posting.content.plain(), other.content.plain())
+            if match_ratio < 0.8:
+                continue
 
-            try:
-                similar_post, embedding = await self._post_collection.find_same_post(db, content.plain())
-            except openai.error.InvalidRequestError as e:
-                log.warning(
-                    f'{cls_name(self)}: '
-                    f'Skip, can\'t find same post, '
-                    f'err: {e} '
-                    f'text:{shorten_text(content.plain())} '
-                )
+            return {
+                "post_id": other.post_id,
+                "match_ratio": match_ratio,
+                "index_distance": distance,
+                "text": other.content.plain(),
+                "unindexed": other,
+            }
+
+        return None
+
+    async def stage_dedupe(self, db, job):
+        for posting in job.postings:
+            if posting.reject_reason or posting.skipped:
                 continue
 
+            similar_post, _ = await self._post_collection.find_same_post(db, posting.content.plain(),
+                                                                         embedding=posting.embedding)
+            if not similar_post:
+                similar_post = self.find_same_unindexed_post(posting)
+
             if similar_post:
                 log.info(
                     f'{cls_name(self)}: '
                     f'Found same post in our channel, '
                     f'match_ratio:{similar_post["match_ratio"]:.2f} '
                     f'index_distance:{similar_post["index_distance"]:.3f} '
-                    f'more_info:{more_info} '
-                    f'fc_source:{source} '
-                    f"post: {original_tg_link} "
-                    f'\ntext:\"{shorten_text(content.plain())}\" '
+                    f'more_info:{posting.more_info} '
+                    f'fc_source:{job.source} '
+                    f"post: {job.original_tg_link} "
+                    f'\ntext:\"{shorten_text(posting.content.plain())}\" '
                     f'\nsame_text:\"{shorten_text(similar_post["text"])}\" '
                 )
+                posting.similar_post = similar_post
+                continue
+
+            self.unindexed[id(posting)] = posting
+        return True
+
+    async def stage_persist(self, db, job):
+        if job.reject_reason:
+            await safe_db_execute(
+                db, INSERT_INTO_POSTS, (
+                    None,
+                    job.markdown_post.plain(),
+                    job.date,
+                    job.source,
+                    'rejected',
+                    job.reject_reason,
+                    None,
+                    None,
+                    job.original_tg_link,
+                    job.markdown_post.json_entities(),
+                )
+            )
+            await db.commit()
+            self.recent_sources.add(job.source)
+            return True
+
+        for posting in job.postings:
+            if posting.skipped:
+                continue
+
+            content = posting.content
+            if posting.reject_reason:
+                await safe_db_execute(
+                    db, INSERT_INTO_POSTS, (
+                        None,
+                        content.plain() if content else None,
+                        job.date,  # TODO: Get from parser?
+                        job.source,
+                        'rejected',
+                        posting.reject_reason,
+                        posting.more_info or None,
+                        posting.language or None,
+                        job.original_tg_link,
+                        content.json_entities() if content else None,
+                    )
+                )
+                continue
+
+            similar_post = posting.similar_post
+            if similar_post and similar_post.get("unindexed"):
+                # Persist handles posts in the dedupe order, so the other one is saved by now
+                similar_post["post_id"] = similar_post["unindexed"].post_id
 
             # Save post id for father easier SQL query on processing stage
             cursor = await safe_db_execute(
                 db, INSERT_INTO_POSTS, (
                     None,
                     content.plain(),
-                    post_candidate_date,  # TODO: Get from parser?
-                    source,
+                    job.date,  # TODO: Get from parser?
+                    job.source,
                     'rejected' if similar_post else 'accepted',
                     f'found similar post - pid:{similar_post["post_id"]} ' if similar_post else None,
-                    more_info,
-                    language,
-                    original_tg_link,
+                    posting.more_info,
+                    posting.language,
+                    job.original_tg_link,
                     content.json_entities(),
                 )
             )
             post_id = cursor.lastrowid
+            posting.post_id = post_id
 
             log.info(
                 f'{cls_name(self)}: '
                 f'Post added to db, '
                 f'status:{"rejected" if similar_post else "accepted"} '
-                f'source:{source} '
-                f"post: {original_tg_link} "
+                f'source:{job.source} '
+                f"post: {job.original_tg_link} "
                 f'post_id:{post_id} '
             )
 
@@ -767,14 +999,14 @@ class Preprocessing(aiomisc.Service):
                 # Add to index store for filtering on processing stage
                 success, tokens_used = await self._post_collection.insert_post(text=content,
                                                                                post_id=str(post_id),
-                                                                               source=source,
-                                                                               embedding=embedding)
+                                                                               source=job.source,
+                                                                               embedding=posting.embedding)
                 if not success: continue
                 log.info(
                     f'{cls_name(self)}: '
                     f'Created index for post, '
-                    f'source:{source} '
-                    f"post: {original_tg_link} "
+                    f'source:{job.source} '
+                    f"post: {job.original_tg_link} "
                     f'post_id:{post_id} '
                     f'tokens_used:{tokens_used} '
                 )
@@ -782,36 +1014,43 @@ class Preprocessing(aiomisc.Service):
             await self.db_integrity_check(db, post_id)
             await db.commit()
 
-        if not at_least_one_returned:
+        if not job.postings:
             await safe_db_execute(
                 db, INSERT_INTO_POSTS, (
                     None,
-                    post_candidate.raw_text,
-                    post_candidate_date,  # TODO: Get from parser?
-                    source,
+                    job.post_candidate.raw_text,
+                    job.date,  # TODO: Get from parser?
+                    job.source,
                     'rejected',
                     "not available postings",
                     None,
                     None,
-                    original_tg_link,
+                    job.original_tg_link,
                     None,
                 )
             )
-            await db.commit()
-
-    async def iter_and_save(self, db):
-        for peer, channel_name, stop_list in ACTIVE_CHANNELS:
-            log.info(f"{cls_name(self)}: "
-                     f"Start checking channel: {shorten_text(channel_name)}")
 
-            # Try to get from cache first
-            channel = self.client.session.get_input_entity(peer)
-            if not channel:
-                channel = await self.client.get_input_entity(peer)
+        await db.commit()
+        self.recent_sources.add(job.source)
+        return True
+
+    def is_deep_sync_due(self, deep_synced_at):
+        if not deep_synced_at:
+            return True
+
+        deep_synced_at = datetime.strptime(deep_synced_at, "%Y-%m-%d %H:%M:%S").replace(tzinfo=utc)
+        return datetime.now(utc) - deep_synced_at >= timedelta(seconds=self.deep_sync_period)
+
+    async def iter_and_save(self, db, deep=None):
+        if not self.crawler:
+            self.crawler = ChannelCrawler(
+                self,
+                iter_channel_messages=iter_channel_messages,
+                cutoff_date=SEARCH_CUTOFF_DATE,
+                max_channels=self.crawl_max_channels,
+            )
 
-            async for post_candidate in iter_channel_messages(self.client, channel, cutoff_date=SEARCH_CUTOFF_DATE):
-                await self.check_and_save(db, post_candidate, channel_name)
-                await db.commit()
+        await self.crawler.crawl(db, ACTIVE_CHANNELS, deep=deep)
 
     async def handle_on_channel_updates(self, event: events.NewMessage):
         forward_candidate = event.message
@@ -825,9 +1064,12 @@ class Preprocessing(aiomisc.Service):
             f"post: {original_tg_link} "
         )
 
-        async with aiosqlite.connect(SQLLite3Service.db_path) as db:
-            await self.check_and_save(db, forward_candidate, channel_name)
-            await db.commit()
+        await self.archive_messages([forward_candidate], chat=event.chat)
+
+        with openai_priority(Priority.LIVE):
+            async with aiosqlite.connect(SQLLite3Service.db_path) as db:
+                await self.check_and_save(db, forward_candidate, channel_name)
+                await db.commit()
 
     async def subscribe_on_channel_update(self):
         for peer, channel_name, _ in ACTIVE_CHANNELS:
@@ -838,21 +1080,13 @@ class Preprocessing(aiomisc.Service):
 
             self.client.on(events.NewMessage(chats=peer))(self.handle_on_channel_updates)
 
-    async def start(self):
-        log.info(f"{cls_name(self)}: Starting service")
-        self.start_event.set()
-
-        context = get_context()
-
-        log.info(f"{cls_name(self)}: Waiting for telegram session")
-        try:
-            self.client = await asyncio.wait_for(context['tg_client'], 3)
-        except asyncio.exceptions.TimeoutError:
-            log.warning(
-                f"{cls_name(self)}: "
-                f"Exiting: Haven't received telegram session"
-            )
-            return
+    async def prepare(self, context):
+        """
+        Waits for everything the ingestion needs, except the telegram session
+        """
+        # Per instance, replay runs its own one in the same process
+        self.unindexed = {}
+        self.inflight = SingleFlight()
 
         log.info(f"{cls_name(self)}: Waiting for ChromaDB index")
         try:
@@ -862,7 +1096,7 @@ class Preprocessing(aiomisc.Service):
                 f"{cls_name(self)}: "
                 f"Exiting: Haven't received ChromaDB index"
             )
-            return
+            return False
 
         log.info(f"{cls_name(self)}: Waiting for GPT embedding function")
         try:
@@ -872,7 +1106,7 @@ class Preprocessing(aiomisc.Service):
                 f"{cls_name(self)}: "
                 f"Exiting: Haven't received GPT embedding function"
             )
-            return
+            return False
 
         log.info(f"{cls_name(self)}: Waiting for SQLite3")
         try:
@@ -882,7 +1116,17 @@ class Preprocessing(aiomisc.Service):
                 f"{cls_name(self)}: "
                 f"Exiting: Haven't received SQLite3 db"
             )
-            return
+            return False
+
+        if self.use_gpt_cache and not self.gpt_cache:
+            log.info(f"{cls_name(self)}: Opening GPT cache")
+            self.gpt_cache = GptResponseCache(cache_db_path(SQLLite3Service.environment))
+            await self.gpt_cache.open()
+
+        if self.use_archive and not self.archive:
+            log.info(f"{cls_name(self)}: Opening message archive")
+            self.archive = MessageArchive(archive_path(SQLLite3Service.environment))
+            await self.archive.open()
 
         log.info(f"{cls_name(self)}: Waiting for job parser")
         try:
@@ -892,26 +1136,54 @@ class Preprocessing(aiomisc.Service):
                 f"{cls_name(self)}: "
                 f"Exiting: Haven't received  job posts parser"
             )
-            return
+            return False
 
         self._post_collection = PostsCollection(index_posts, self.create_embedding)
 
-        log.info(f"{cls_name(self)}: Setup GPT rate limiter")
-        self.preprocessing_rate_limit = AsyncLimiter(max_rate=20, time_period=60)
+        log.info(f"{cls_name(self)}: Waiting for OpenAI scheduler")
+        try:
+            if not self.scheduler:
+                self.scheduler = await asyncio.wait_for(context["openai_scheduler"], 3)
+        except asyncio.exceptions.TimeoutError:
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Exiting: Haven't received OpenAI scheduler"
+            )
+            return False
 
         # Set the OpenAI API key
         assert (os.getenv("OPENAI_API_KEY") is not None)
         openai.api_key = os.getenv("OPENAI_API_KEY")
+        return True
+
+    async def start(self):
+        log.info(f"{cls_name(self)}: Starting service")
+        self.start_event.set()
+
+        context = get_context()
+
+        log.info(f"{cls_name(self)}: Waiting for telegram session")
+        try:
+            self.client = await asyncio.wait_for(context['tg_client'], 3)
+        except asyncio.exceptions.TimeoutError:
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Exiting: Haven't received telegram session"
+            )
+            return
+
+        if not await self.prepare(context):
+            return
 
         async with aiosqlite.connect(SQLLite3Service.db_path) as db:
-            log.info(f"{cls_name(self)}: Removing old posts")
-            await self.remove_old_posts(db)
+            log.info(f"{cls_name(self)}: Loading recent sources")
+            await self.load_recent_sources(db)
 
-            log.info(f"{cls_name(self)}: Syncing index with db")
-            await self.sync_index_and_db(db)
+        self.maintenance = asyncio.create_task(self.maintain_index())
 
         log.info(f"{cls_name(self)}: Subscribe on new posts")
         await self.subscribe_on_channel_update()
+        startup.ready(self)
 
         while True:
             log.info(f"{cls_name(self)}: Enter periodical syncing")
@@ -937,6 +1209,30 @@ class Preprocessing(aiomisc.Service):
     async def stop(self, *args, **kwargs):
         for future in self.futures.keys():
             await future
+
+        if self.maintenance and not self.maintenance.done():
+            # Reconciliation resumes from the checkpoint on the next start
+            self.maintenance.cancel()
+            await asyncio.gather(self.maintenance, return_exceptions=True)
+
+        if self.gpt_cache:
+            log.info(
+                f"{cls_name(self)}: "
+                f"Closing GPT cache, "
+                f"gpt_calls:{self.gpt_calls} "
+                f"gpt_cached:{self.gpt_cached} "
+                f"stats:{self.gpt_cache.stats()}"
+            )
+            await self.gpt_cache.close()
+
+        if self.archive:
+            log.info(
+                f"{cls_name(self)}: "
+                f"Closing message archive, "
+                f"stats:{await self.archive.stats()}"
+            )
+            await self.archive.close()
+
         log.info(f"{cls_name(self)}: Stopped service")
 
 
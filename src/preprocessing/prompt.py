@@ -2,27 +2,30 @@ import asyncio
 import json
 import logging
 from pprint import pprint
+from typing import TYPE_CHECKING
 
 import aiomisc
 import aiosqlite
 import openai
-import tiktoken
-from aiolimiter import AsyncLimiter
 from aiomisc import get_context
-from chromadb.api.models.Collection import Collection
 from jsonschema import validate
 from pyee import AsyncIOEventEmitter
 
 from common.db import safe_db_execute
 from common.exceptions import TokenLimitExceeded
 from common.logging import cls_name, shorten_text
-from common.utils import get_prompt, print_event, group_list
-from db.sqlite import SQLLite3Service, UPDATE_PROMPT, GET_PROMPTS_FOR_PROCESSING, GET_ALL_APPROVED_PROMPTS, \
-    COUNT_APPROVED_PROMPTS
+from common.startup import startup
+from common.utils import get_prompt, print_event, count_tokens
+from db.reconcile import PromptsReconciler
+from db.sqlite import SQLLite3Service, UPDATE_PROMPT, GET_PROMPTS_FOR_PROCESSING
 
+from gpt.scheduler import OpenAIScheduler, Priority, openai_priority
 from gpt.schemas.prompt_check_short import schema as json_preprocess_schema_short
 from gpt.schemas.prompt_check_long import schema as json_preprocess_schema_long
 
+if TYPE_CHECKING:
+    from chromadb.api.models.Collection import Collection
+
 log = logging.getLogger(__name__)
 
 
@@ -31,10 +34,12 @@ class PromptTranslate(aiomisc.Service):
     log_posts_for_forwarding: bool = False
     emitter: AsyncIOEventEmitter = None
 
-    rate_limit: AsyncLimiter = None
-    index_prompts: Collection = None
+    scheduler: OpenAIScheduler = None
+    index_prompts: "Collection" = None
     create_embedding = None
     lock: asyncio.Lock = None
+    # Index reconciliation, runs in the background
+    maintenance: asyncio.Task = None
 
     @aiomisc.asyncbackoff(
         attempt_timeout=60,
@@ -47,8 +52,7 @@ class PromptTranslate(aiomisc.Service):
         )
     )
     async def preprocess_prompt(self, prompt):
-        enc = tiktoken.get_encoding("cl100k_base")
-        num_tokens = len(enc.encode(prompt)) + 300  # approximate system message tokens
+        num_tokens = count_tokens(prompt) + 300  # approximate system message tokens
 
         if num_tokens <= 400:
             is_long = False
@@ -62,7 +66,8 @@ class PromptTranslate(aiomisc.Service):
         if num_tokens >= 6000:
             raise TokenLimitExceeded(num_tokens)
 
-        async with self.rate_limit:
+        # approximate answer tokens
+        async with self.scheduler.slot(model, num_tokens + 300) as reservation:
             chat_completions = await openai.ChatCompletion.acreate(
                 model=model,
                 temperature=0,
@@ -77,8 +82,9 @@ class PromptTranslate(aiomisc.Service):
                     }
                 ]
             )
+            tokens_used = chat_completions['usage']['total_tokens']
+            reservation.used(tokens_used)
 
-        tokens_used = chat_completions['usage']['total_tokens']
         response = chat_completions['choices'][0]['message']["content"]
 
         try:
@@ -107,6 +113,11 @@ class PromptTranslate(aiomisc.Service):
                     log.exception(e)
 
     async def process_new_prompts(self, db):
+        # User is waiting for the first search results
+        with openai_priority(Priority.FIRST_SEARCH):
+            await self._process_new_prompts(db)
+
+    async def _process_new_prompts(self, db):
         rows = [
             row
             async for row in await safe_db_execute(db, GET_PROMPTS_FOR_PROCESSING)
@@ -170,68 +181,36 @@ class PromptTranslate(aiomisc.Service):
             })
 
     async def sync_index_and_db(self, db):
-        cursor = await safe_db_execute(db, COUNT_APPROVED_PROMPTS)
-        (sqlite_active_count,) = await cursor.fetchone()
-        chroma_count = len(self.index_prompts.peek(limit=0)["ids"])
-        if chroma_count == sqlite_active_count: return
-
-        log.warning(
-            f'{cls_name(self)}: '
-            f'Seems like mismatch between chroma and sqlite, '
-            f"sqlite_count: {sqlite_active_count} "
-            f"chroma_count: {chroma_count} "
-        )
-
-        rows = await safe_db_execute(db, GET_ALL_APPROVED_PROMPTS)
-        prompts_map = {
-            str(prompt_id): {
-                "tags": tags,
-            }
-            async for (prompt_id, tags,) in rows or []
-        }
-
-        index_ids = self.index_prompts.get(ids=list(prompts_map.keys()))["ids"]
-        mismatch_ids = sorted(map(int, list(set(prompts_map.keys()) - set(index_ids))))
-
-        for prompts_ids in group_list(mismatch_ids, 100):
-            tags_list = [prompts_map[str(prompt_id)]["tags"] for prompt_id in prompts_ids]
-            _, embeddings = await self.create_embedding(tags_list)
-            for n, (prompt_id, embedding) in enumerate(zip(prompts_ids, embeddings)):
-                self.index_prompts.add(
-                    embeddings=[embedding],
-                    ids=[str(prompt_id)]
-                )
-
-                log.warning(
-                    f'{cls_name(self)}: '
-                    f'{n + 1}: Created missing prompt index for, '
-                    f"prompt_id: {prompt_id} "
-                )
-
-            await asyncio.sleep(1)
-
-        # IDs in index which are not in db
-        mismatch_ids = sorted(list(set(index_ids) - set(prompts_map.keys())))
-        for n, _id in enumerate(mismatch_ids):
-            log.warning(
-                f'{cls_name(self)}: '
-                f'{n + 1}: Remove zombie prompt index, '
-                f"prompt_id: {_id} "
-            )
+        reconciler = PromptsReconciler(self.index_prompts, self.create_embedding)
+        await reconciler.run(db)
 
-        if mismatch_ids:
-            self.index_prompts.delete(ids=mismatch_ids)
+    async def maintain_index(self):
+        try:
+            async with aiosqlite.connect(SQLLite3Service.db_path) as db:
+                await self.sync_index_and_db(db)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception(e)
 
     async def start(self):
         log.info(f"{cls_name(self)}: Start service")
         self.start_event.set()
         self.lock = asyncio.Lock()
 
-        if not self.rate_limit:
-            self.rate_limit = AsyncLimiter(max_rate=20, time_period=60)
-
         context = get_context()
 
+        try:
+            if not self.scheduler:
+                log.info(f"{cls_name(self)}: Waiting for OpenAI scheduler")
+                self.scheduler = await asyncio.wait_for(context['openai_scheduler'], 3)
+        except asyncio.exceptions.TimeoutError:
+            log.warning(
+                f"{cls_name(self)}: "
+                f"Exiting: Haven't received OpenAI scheduler"
+            )
+            return
+
         try:
             log.info(f"{cls_name(self)}: Waiting for SQLite3 to be ready")
             await asyncio.wait_for(context['sqlite_ready'], 3)
@@ -268,9 +247,9 @@ class PromptTranslate(aiomisc.Service):
         self.emitter.on("new_prompt", self.on_new_prompt)
         self.emitter.on("prompt_rejected", print_event)
 
-        log.info(f"{cls_name(self)}: Sync prompt index with db ")
-        async with aiosqlite.connect(SQLLite3Service.db_path) as db:
-            await self.sync_index_and_db(db)
+        log.info(f"{cls_name(self)}: Sync prompt index with db in background")
+        self.maintenance = asyncio.create_task(self.maintain_index())
+        startup.ready(self)
 
         while True:
             async with self.lock:
@@ -281,3 +260,9 @@ class PromptTranslate(aiomisc.Service):
                         log.exception(e)
 
             await asyncio.sleep(10)
+
+    async def stop(self, *args, **kwargs):
+        if self.maintenance and not self.maintenance.done():
+            # Reconciliation resumes from the checkpoint on the next start
+            self.maintenance.cancel()
+            await asyncio.gather(self.maintenance, return_exceptions=True)
@@ -0,0 +1,196 @@
+"""
+Replays archived Telegram messages through the ingestion stages without
+Telegram session, as fast as OpenAI limits allow, and reports throughput,
+GPT usage and stage latencies.
+
+    python src/replay.py --archive archive/prod --channel 1639166908 --min-id 1200
+    python src/replay.py --dump archive/bench --limit 200
+    python src/replay.py --archive messages.jsonl.gz
+
+--archive takes the message archive directory, which Preprocessing fills
+with every incoming message, or .jsonl.gz file written by the earlier
+versions, those are only read. --dump archives messages of the active
+channels into the archive directory, it needs Telegram session. Replay
+writes into the db of the --env environment, TEST starts from the empty one.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import aiomisc
+import aiosqlite
+from aiomisc import get_context
+
+from db.embedding import EmbeddingDB
+from db.sqlite import SQLLite3Service
+from gpt.scheduler import OpenAIScheduler
+from parsing.parsing import JobPostingParser
+from preprocessing.archive import MessageArchive, iter_archive, restore_message
+from preprocessing.channels import ACTIVE_CHANNELS
+from preprocessing.jobs import PostJob
+from preprocessing.pipeline import Pipeline
+from preprocessing.post_sourser import Preprocessing, SetupTelegramSession, iter_channel_messages, \
+    SEARCH_CUTOFF_DATE
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("openai").setLevel(logging.WARNING)
+logging.getLogger("chromadb.segment.impl.vector.local_persistent_hnsw").setLevel(logging.ERROR)
+
+
+async def dump(path, limit=None, page_size=100):
+    client = await asyncio.wait_for(get_context()["tg_client"], 30)
+
+    archive = MessageArchive(path)
+    await archive.open()
+    try:
+        for peer, channel_name, _ in ACTIVE_CHANNELS:
+            num_messages = 0
+            messages = []
+            channel = await client.get_input_entity(peer)
+            async for message in iter_channel_messages(client, channel, cutoff_date=SEARCH_CUTOFF_DATE, limit=limit):
+                messages.append(message)
+                if len(messages) >= page_size:
+                    num_messages += await archive.append_many(messages)
+                    messages = []
+            num_messages += await archive.append_many(messages)
+
+            log.info(f"Archived channel: {channel_name} num_messages:{num_messages}")
+
+        log.info(f"Archive stats: {await archive.stats()}")
+    finally:
+        await archive.close()
+
+
+async def iter_records(path, channel_id=None, min_id=0):
+    if not os.path.isdir(path):
+        for record in iter_archive(path):
+            if channel_id is None or (record["channel_id"] == channel_id and record["message_id"] > min_id):
+                yield record
+        return
+
+    archive = MessageArchive(path)
+    await archive.open()
+    try:
+        if channel_id is None:
+            for record in archive.iter_all():
+                yield record
+        else:
+            async for record in archive.iter_channel(channel_id, min_id=min_id):
+                yield record
+    finally:
+        await archive.close()
+
+
+async def replay(path, limit=None, channel_id=None, min_id=0):
+    # Replayed messages are archived already
+    preprocessing = Preprocessing(use_archive=False)
+    if not await preprocessing.prepare(get_context()):
+        return
+
+    async with aiosqlite.connect(SQLLite3Service.db_path) as db:
+        await preprocessing.load_recent_sources(db)
+
+    counters = {"messages": 0, "saved": 0, "failed": 0, "postings": 0}
+
+    async def done(job, success):
+        preprocessing.release(job, success)
+        counters["saved" if success else "failed"] += 1
+        counters["postings"] += sum(1 for posting in job.postings if not posting.skipped)
+
+    pipeline = Pipeline(preprocessing.ingestion_stages(), on_done=done)
+    started_at = time.monotonic()
+    async with pipeline:
+        async for record in iter_records(path, channel_id=channel_id, min_id=min_id):
+            if limit and counters["messages"] >= limit:
+                break
+
+            counters["messages"] += 1
+            await pipeline.put(PostJob(restore_message(record), record["channel_title"]))
+
+        await pipeline.join()
+    elapsed = time.monotonic() - started_at
+
+    openai_stats = preprocessing.scheduler.stats()
+    print(
+        f"messages:{counters['messages']} "
+        f"saved:{counters['saved']} "
+        f"failed:{counters['failed']} "
+        f"postings:{counters['postings']} "
+        f"elapsed:{elapsed:.1f}s "
+        f"posts_per_sec:{counters['messages'] / elapsed if elapsed else 0.0:.2f}"
+    )
+    print(
+        f"gpt_calls:{preprocessing.gpt_calls} "
+        f"gpt_cached:{preprocessing.gpt_cached} "
+        f"gpt_tokens:{preprocessing.gpt_tokens} "
+        f"openai_requests:{sum(openai_stats['requests'].values())} "
+        f"openai_tokens:{sum(openai_stats['tokens'].values())}"
+    )
+
+    pool_stats = preprocessing.parser.pool.stats()
+    print(
+        f"drivers_spawned:{pool_stats['spawned']} "
+        f"drivers_recycled:{sum(pool_stats['recycled'].values())} "
+        f"driver_avg_wait:{pool_stats['avg_wait']}s "
+        f"driver_max_wait:{pool_stats['max_wait']}s "
+        f"driver_utilization:{pool_stats['utilization']}"
+    )
+
+    print(f"{'stage':<12} {'processed':>10} {'dropped':>8} {'failed':>7} {'avg, s':>8} {'queued, s':>10} "
+          f"{'busy, s':>9} {'blocked, s':>11}")
+    for name, metrics in pipeline.stats().items():
+        print(
+            f"{name:<12} "
+            f"{metrics['processed']:>10} "
+            f"{metrics['dropped']:>8} "
+            f"{metrics['failed']:>7} "
+            f"{metrics['avg']:>8.2f} "
+            f"{metrics['avg_queued']:>10.2f} "
+            f"{metrics['busy']:>9.1f} "
+            f"{metrics['blocked']:>11.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--archive", help="archive to replay")
+    parser.add_argument("--dump", help="archive directory to write messages of the active channels into")
+    parser.add_argument("--limit", type=int, default=None, help="messages to replay, or to dump per channel")
+    parser.add_argument("--channel", type=int, default=None, help="replay only this channel id")
+    parser.add_argument("--min-id", type=int, default=0, help="replay messages of the channel above this id")
+    parser.add_argument("--env", default=os.getenv("ENV"))
+    args = parser.parse_args()
+
+    if args.min_id and args.channel is None:
+        parser.error("--min-id requires --channel, message ids are per channel")
+
+    if args.dump:
+        services = [SetupTelegramSession()]
+        coro = dump(args.dump, limit=args.limit)
+    elif args.archive:
+        services = [
+            OpenAIScheduler(),
+            SQLLite3Service(environment=args.env),
+            EmbeddingDB(environment=args.env),
+            JobPostingParser(),
+        ]
+        coro = replay(args.archive, limit=args.limit, channel_id=args.channel, min_id=args.min_id)
+    else:
+        parser.error("either --archive or --dump is required")
+        return
+
+    with aiomisc.entrypoint(*services, log_level="info", log_format="color") as loop:
+        loop.run_until_complete(coro)
+
+
+if __name__ == "__main__":
+    main()
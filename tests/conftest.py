@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# Modules under src are imported as top level packages, and some of them
+# check their settings on import
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
+
+os.environ.setdefault("ENV", "TEST")
+os.environ.setdefault("CUTOFF_DAYS", "30")
+os.environ.setdefault("PROXIES_API_AUTH_KEY", "test")
+os.environ.setdefault("DEV_TRANSIENT_CHANNEL_ID", "1")
+os.environ.setdefault("DEV_TRANSIENT_CHANNEL_HASH", "1")
+
+
+class Clock:
+    """
+    Stands in for the time module of the module under test
+    """
+
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """
+    Path of the sqlite database with the tables of SQLLite3Service
+    """
+    from db.sqlite import SQLLite3Service
+
+    path = str(tmp_path / "db.sqlite")
+    with sqlite3.connect(path) as db:
+        for script in [
+            SQLLite3Service.CREATE_POSTS_TABLE,
+            SQLLite3Service.CREATE_USERS_POST_TABLE,
+            SQLLite3Service.CREATE_PROMPTS_TABLE,
+            SQLLite3Service.CREATE_CHANNELS_SYNC_TABLE,
+            SQLLite3Service.CREATE_RECONCILE_CHECKPOINTS_TABLE,
+        ]:
+            db.executescript(script)
+    return path
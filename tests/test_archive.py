@@ -0,0 +1,157 @@
+import asyncio
+import gzip
+import json
+import struct
+from datetime import datetime
+
+from pytz import utc
+from telethon.tl.patched import Message
+from telethon.tl.types import PeerChannel, MessageEntityBold, MessageFwdHeader
+
+from common.telegram import get_original_pid_cid
+from preprocessing.archive import ArchivedChat, MessageArchive, serialize_message, restore_message, iter_archive
+from replay import iter_records
+
+DATE = datetime(2023, 8, 1, 10, 0, tzinfo=utc)
+
+
+def make_message(message_id, channel_id=5, forwarded=False):
+    message = Message(
+        id=message_id,
+        peer_id=PeerChannel(channel_id),
+        date=DATE,
+        message=f"Python developer {message_id}",
+        entities=[MessageEntityBold(offset=0, length=6)],
+        fwd_from=MessageFwdHeader(date=DATE, from_id=PeerChannel(7), channel_post=42) if forwarded else None,
+    )
+    message._chat = ArchivedChat(channel_id, username="jobs", title="Jobs")
+    return message
+
+
+def test_restored_message_same_as_live_one():
+    for message in [make_message(1), make_message(2, forwarded=True)]:
+        restored = restore_message(serialize_message(message))
+
+        assert restored.id == message.id
+        assert restored.date == message.date
+        assert restored.raw_text == message.raw_text
+        assert restored.entities == message.entities
+        assert get_original_pid_cid(restored) == get_original_pid_cid(message)
+
+
+def test_record_keeps_channel():
+    record = serialize_message(make_message(1), chat=ArchivedChat(5, username="other", title="Other"))
+
+    assert (record["channel_id"], record["message_id"]) == (5, 1)
+    assert (record["channel_username"], record["channel_title"]) == ("other", "Other")
+    assert restore_message(record).chat.username == "other"
+
+
+def write_file_archive(path, messages):
+    # Appending to gzip adds a new member, as the earlier versions did
+    for message in messages:
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            f.write(json.dumps(serialize_message(message), ensure_ascii=False) + "\n")
+
+
+def test_file_archive_read(tmp_path):
+    path = str(tmp_path / "messages.jsonl.gz")
+    write_file_archive(path, [make_message(1), make_message(2)])
+
+    assert [restore_message(record).id for record in iter_archive(path)] == [1, 2]
+
+
+def archive_records(records):
+    return [(record["channel_id"], record["message_id"]) for record in records]
+
+
+def test_message_archive(tmp_path):
+    async def run():
+        archive = MessageArchive(str(tmp_path))
+        await archive.open()
+        try:
+            appended = [
+                await archive.append_many([make_message(2), make_message(1), make_message(1, channel_id=6)]),
+                # Archived before, and the same message twice in the page
+                await archive.append_many([make_message(2), make_message(3), make_message(3)]),
+            ]
+            found = await archive.get(5, 3), await archive.get(5, 4)
+            channel = [record async for record in archive.iter_channel(5, min_id=1)]
+            return appended, found, channel, list(archive.iter_all()), await archive.stats()
+        finally:
+            await archive.close()
+
+    appended, (found, missing), channel, all_records, stats = asyncio.run(run())
+    assert appended == [3, 1]
+    assert restore_message(found).raw_text == "Python developer 3"
+    assert missing is None
+    assert archive_records(channel) == [(5, 2), (5, 3)]
+    # In the order of archiving
+    assert archive_records(all_records) == [(5, 2), (5, 1), (6, 1), (5, 3)]
+    assert stats == {"channels": 2, "messages": 4, "segments": 1, "appended": 4}
+
+
+def test_archive_segments_and_reopen(tmp_path):
+    async def run():
+        archive = MessageArchive(str(tmp_path))
+        archive.segment_size = 1
+        await archive.open()
+        await archive.append_many([make_message(n) for n in range(1, 4)])
+        await archive.close()
+
+        archive = MessageArchive(str(tmp_path))
+        await archive.open()
+        try:
+            appended = await archive.append_many([make_message(3), make_message(4)])
+            return appended, archive.segments(), [record async for record in archive.iter_channel(5)]
+        finally:
+            await archive.close()
+
+    appended, segments, records = asyncio.run(run())
+    assert appended == 1
+    # Reopened with the default size, appends to the last segment
+    assert segments == [1, 2, 3]
+    assert archive_records(records) == [(5, 1), (5, 2), (5, 3), (5, 4)]
+
+
+def test_unfinished_record_skipped(tmp_path):
+    async def run():
+        archive = MessageArchive(str(tmp_path))
+        await archive.open()
+        await archive.append_many([make_message(1), make_message(2)])
+        await archive.close()
+
+        with open(archive.segment_path(1), "ab") as f:
+            f.write(struct.pack(">I", 100) + b"torn")
+        return list(archive.iter_all())
+
+    assert archive_records(asyncio.run(run())) == [(5, 1), (5, 2)]
+
+
+def test_closed_archive_appends_nothing(tmp_path):
+    assert asyncio.run(MessageArchive(str(tmp_path)).append_many([make_message(1)])) == 0
+
+
+def replayed(path, **kwargs):
+    async def run():
+        return [(record["channel_id"], record["message_id"]) async for record in iter_records(path, **kwargs)]
+
+    return asyncio.run(run())
+
+
+def test_replay_records_of_channel_above_min_id(tmp_path):
+    messages = [make_message(1), make_message(2, channel_id=6), make_message(3)]
+    path = str(tmp_path / "messages.jsonl.gz")
+    write_file_archive(path, messages)
+
+    async def fill():
+        archive = MessageArchive(str(tmp_path / "archive"))
+        await archive.open()
+        await archive.append_many(messages)
+        await archive.close()
+
+    asyncio.run(fill())
+
+    for archive in [path, str(tmp_path / "archive")]:
+        assert replayed(archive, channel_id=5, min_id=1) == [(5, 3)]
+        assert sorted(replayed(archive)) == [(5, 1), (5, 3), (6, 2)]
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from common import assets
+
+
+@pytest.fixture(autouse=True)
+def clean(monkeypatch, tmp_path):
+    monkeypatch.setenv("ASSETS_DIR", str(tmp_path))
+    monkeypatch.delenv("ASSETS_OFFLINE", raising=False)
+    monkeypatch.delenv("GECKO_DRIVER_PATH", raising=False)
+    assets.get_gecko_driver_path.cache_clear()
+    yield
+    assets.get_gecko_driver_path.cache_clear()
+
+
+def test_assets_dir_created(tmp_path):
+    path = assets.assets_dir("nltk")
+
+    assert path == str(tmp_path / "nltk")
+    assert os.path.isdir(path)
+
+
+def test_gecko_driver_from_env(monkeypatch):
+    monkeypatch.setenv("GECKO_DRIVER_PATH", "/opt/geckodriver")
+    monkeypatch.setattr(assets.shutil, "which", lambda name: "/usr/bin/geckodriver")
+
+    assert assets.get_gecko_driver_path() == "/opt/geckodriver"
+    monkeypatch.setenv("GECKO_DRIVER_PATH", "/other/geckodriver")
+    # Resolved once
+    assert assets.get_gecko_driver_path() == "/opt/geckodriver"
+
+
+def test_gecko_driver_on_path(monkeypatch):
+    monkeypatch.setattr(assets.shutil, "which", lambda name: f"/usr/bin/{name}")
+
+    assert assets.get_gecko_driver_path() == "/usr/bin/geckodriver"
+
+
+def test_missing_gecko_driver_offline(monkeypatch):
+    monkeypatch.setenv("ASSETS_OFFLINE", "1")
+    monkeypatch.setattr(assets.shutil, "which", lambda name: None)
+
+    with pytest.raises(assets.AssetMissing):
+        assets.get_gecko_driver_path()
+
+
+def imported_after(modules, dependencies):
+    src = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+    code = (
+        f"import sys, {', '.join(modules)}\n"
+        f"print(' '.join(name for name in {dependencies!r} if name in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], env={**os.environ, "PYTHONPATH": src},
+                            capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def test_import_doesnt_load_heavy_dependencies():
+    assert imported_after(["parsing.driver"], ["selenium", "fake_useragent", "webdriver_manager"]) == []
+    assert imported_after(
+        ["common.telegram", "common.density", "db.embedding", "matching.filtering", "preprocessing.prompt"],
+        ["nltk", "chromadb", "fake_useragent", "webdriver_manager"]
+    ) == []
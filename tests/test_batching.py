@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from db import batching
+from db.batching import EmbeddingBatcher
+
+
+@pytest.fixture(autouse=True)
+def one_token_per_char(monkeypatch):
+    # Real tokenizer loads its encoding over the network
+    monkeypatch.setattr(batching, "estimate_tokens", len)
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.requests = []
+
+    async def __call__(self, contents):
+        self.requests.append(list(contents))
+        return sum(len(text) for text in contents), [[float(len(text))] for text in contents]
+
+
+def test_calls_within_window_share_request():
+    api = FakeEmbeddings()
+
+    async def run():
+        batcher = EmbeddingBatcher(api, window=0.01)
+        results = await asyncio.gather(
+            batcher.embed(["a", "bb"]),
+            batcher.embed(["ccc"]),
+        )
+        await batcher.close()
+        return results, batcher.stats()
+
+    results, stats = asyncio.run(run())
+    assert api.requests == [["a", "bb", "ccc"]]
+    # Each caller gets its own vectors and its share of the usage
+    assert results == [(3, [[1.0], [2.0]]), (3, [[3.0]])]
+    assert stats == {"calls": 2, "requests": 1}
+
+
+def test_calls_in_different_windows_not_coalesced():
+    api = FakeEmbeddings()
+
+    async def run():
+        batcher = EmbeddingBatcher(api, window=0.01)
+        await batcher.embed(["a"])
+        await batcher.embed(["b"])
+        await batcher.close()
+
+    asyncio.run(run())
+    assert api.requests == [["a"], ["b"]]
+
+
+def test_batch_split_by_token_budget():
+    api = FakeEmbeddings()
+
+    async def run():
+        batcher = EmbeddingBatcher(api, window=0.01, max_batch_tokens=5)
+        results = await asyncio.gather(
+            batcher.embed(["aaa"]),
+            batcher.embed(["bbb"]),
+            batcher.embed(["cc"]),
+        )
+        await batcher.close()
+        return results
+
+    results = asyncio.run(run())
+    # Second call would push the batch over the budget, so the first one is
+    # sent alone and the budget is reached exactly by the next two
+    assert api.requests == [["aaa"], ["bbb", "cc"]]
+    assert [embeddings for (_, embeddings) in results] == [[[3.0]], [[3.0]], [[2.0]]]
+
+
+def test_batch_split_by_size():
+    api = FakeEmbeddings()
+
+    async def run():
+        batcher = EmbeddingBatcher(api, window=0.01, max_batch_size=2)
+        await asyncio.gather(*[batcher.embed([text]) for text in "abc"])
+        await batcher.close()
+
+    asyncio.run(run())
+    assert api.requests == [["a", "b"], ["c"]]
+
+
+def test_failure_reaches_every_caller():
+    async def failing(contents):
+        raise RuntimeError("rate limited")
+
+    async def run():
+        batcher = EmbeddingBatcher(failing, window=0.01)
+        results = await asyncio.gather(
+            batcher.embed(["a"]),
+            batcher.embed(["b"]),
+            return_exceptions=True,
+        )
+        await batcher.close()
+        return results
+
+    results = asyncio.run(run())
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+
+
+def test_short_response_rejected():
+    async def short(contents):
+        return 1, [[1.0]]
+
+    async def run():
+        batcher = EmbeddingBatcher(short, window=0.01)
+        with pytest.raises(ValueError):
+            await asyncio.gather(batcher.embed(["a"]), batcher.embed(["b"]))
+        await batcher.close()
+
+    asyncio.run(run())
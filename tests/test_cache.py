@@ -0,0 +1,168 @@
+import asyncio
+
+import pytest
+
+from db import cache
+from db.cache import EmbeddingCache, GptResponseCache, ParsedPageCache
+
+
+@pytest.fixture
+def frozen(monkeypatch, clock):
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+def test_embedding_key_ignores_whitespace():
+    assert EmbeddingCache.key(" python\n developer ", "ada") == EmbeddingCache.key("python developer", "ada")
+    assert EmbeddingCache.key("python developer", "ada") != EmbeddingCache.key("python developer", "local")
+
+
+def test_embeddings_roundtrip(tmp_path, frozen):
+    async def run():
+        embeddings = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+        await embeddings.open()
+        try:
+            await embeddings.put_many(["first", "second"], [[1.0, 2.0], [3.0, 4.0]], "ada", tokens_used=11)
+            return await embeddings.get_many(["second", "missing", "first", "first"], "ada"), embeddings.stats()
+        finally:
+            await embeddings.close()
+
+    found, stats = asyncio.run(run())
+    assert found == [[3.0, 4.0], None, [1.0, 2.0], [1.0, 2.0]]
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+    # Tokens are split by the text length, 6 for "second" and 5 per "first"
+    assert stats["tokens_saved"] == 16
+
+
+def test_embeddings_expire_after_ttl(tmp_path, frozen):
+    async def run():
+        embeddings = EmbeddingCache(str(tmp_path / "cache.sqlite"), ttl=60)
+        await embeddings.open()
+        try:
+            await embeddings.put_many(["text"], [[1.0]], "ada")
+            frozen.advance(59)
+            fresh = await embeddings.get_many(["text"], "ada")
+            frozen.advance(2)
+            expired = await embeddings.get_many(["text"], "ada")
+            return fresh, expired
+        finally:
+            await embeddings.close()
+
+    fresh, expired = asyncio.run(run())
+    assert fresh == [[1.0]]
+    assert expired == [None]
+
+
+def test_embeddings_least_recently_used_evicted(tmp_path, frozen):
+    async def run():
+        embeddings = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_size=2, evict_every=1)
+        await embeddings.open()
+        try:
+            await embeddings.put_many(["first"], [[1.0]], "ada")
+            frozen.advance(1)
+            await embeddings.put_many(["second"], [[2.0]], "ada")
+            frozen.advance(1)
+            # Reading the first one makes the second the least recently used
+            await embeddings.get_many(["first"], "ada")
+            frozen.advance(1)
+            await embeddings.put_many(["third"], [[3.0]], "ada")
+            return await embeddings.get_many(["first", "second", "third"], "ada")
+        finally:
+            await embeddings.close()
+
+    assert asyncio.run(run()) == [[1.0], None, [3.0]]
+
+
+def test_embeddings_looked_up_in_chunks(tmp_path, frozen):
+    texts = [f"text {n}" for n in range(5)]
+    queries = []
+
+    async def run():
+        embeddings = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+        embeddings.lookup_size = 2
+        await embeddings.open()
+        try:
+            await embeddings.put_many(texts[:4], [[float(n)] for n in range(4)], "ada")
+            await embeddings._db.set_trace_callback(queries.append)
+            found = await embeddings.get_many(texts, "ada")
+            await embeddings._db.set_trace_callback(None)
+            return found
+        finally:
+            await embeddings.close()
+
+    assert asyncio.run(run()) == [[0.0], [1.0], [2.0], [3.0], None]
+    # Five keys are looked up by two, four found ones are touched by two
+    assert len([query for query in queries if query.lstrip().startswith("SELECT")]) == 3
+    assert len([query for query in queries if query.lstrip().startswith("UPDATE")]) == 2
+
+
+def test_closed_cache_misses(tmp_path):
+    async def run():
+        embeddings = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+        await embeddings.put_many(["text"], [[1.0]], "ada")
+        return await embeddings.get_many(["text"], "ada")
+
+    assert asyncio.run(run()) == [None]
+
+
+def test_gpt_key_covers_kind_model_and_prompt_version():
+    key = GptResponseCache.key("filter", "gpt-3.5", "v1", "post", "request")
+    assert key == GptResponseCache.key("filter", "gpt-3.5", "v1", " post\n", "request")
+    assert key != GptResponseCache.key("decompose", "gpt-3.5", "v1", "post", "request")
+    assert key != GptResponseCache.key("filter", "gpt-4", "v1", "post", "request")
+    assert key != GptResponseCache.key("filter", "gpt-3.5", "v2", "post", "request")
+
+
+def test_gpt_responses_roundtrip_and_expire(tmp_path, frozen):
+    async def run():
+        responses = GptResponseCache(str(tmp_path / "cache.sqlite"), ttl=60)
+        await responses.open()
+        try:
+            await responses.put("verdict", kind="filter", model="gpt-3.5", tokens=100, score=95, reason="fits")
+            await responses.put("decomposition", kind="decompose", model="gpt-3.5", tokens=50,
+                                response={"jobs": ["Вакансия"]})
+            found = await responses.get("verdict"), await responses.get("decomposition"), await responses.get("missing")
+            frozen.advance(61)
+            return found, await responses.get("verdict"), responses.stats()
+        finally:
+            await responses.close()
+
+    (verdict, decomposition, missing), expired, stats = asyncio.run(run())
+    assert verdict == {"score": 95, "reason": "fits", "response": None, "tokens": 100}
+    assert decomposition == {"score": None, "reason": None, "response": {"jobs": ["Вакансия"]}, "tokens": 50}
+    assert missing is None
+    assert expired is None
+    assert stats == {"hits": 2, "misses": 2, "hit_rate": 0.5, "tokens_saved": 150}
+
+
+def test_negative_pages_expire_sooner(tmp_path, frozen):
+    async def run():
+        pages = ParsedPageCache(str(tmp_path / "cache.sqlite"), ttl=100, negative_ttl=10)
+        await pages.open()
+        try:
+            await pages.put("vacancy", "https://hh.ru/vacancy/1", ParsedPageCache.PARSED, parser="HeadHunter",
+                            final_url="https://hh.ru/vacancy/1", language="russian", text="Вакансия", entities="[]")
+            await pages.put("archived", "https://hh.ru/vacancy/2", "archived", parser="HeadHunter")
+            found = await pages.get("vacancy"), await pages.get("archived")
+
+            frozen.advance(11)
+            negative_expired = await pages.get("vacancy") is not None, await pages.get("archived")
+            frozen.advance(90)
+            return found, negative_expired, await pages.get("vacancy"), pages.stats()
+        finally:
+            await pages.close()
+
+    (vacancy, archived), (vacancy_kept, archived_expired), vacancy_expired, stats = asyncio.run(run())
+    assert vacancy == {"outcome": "parsed", "parser": "HeadHunter", "final_url": "https://hh.ru/vacancy/1",
+                       "language": "russian", "text": "Вакансия", "entities": "[]"}
+    assert (archived["outcome"], archived["text"]) == ("archived", None)
+    assert vacancy_kept
+    assert archived_expired is None
+    assert vacancy_expired is None
+    assert (stats["hits"], stats["misses"], stats["negative_hits"]) == (3, 2, 1)
+
+
+def test_page_key_covers_add_info_link():
+    assert ParsedPageCache.key("https://hh.ru/vacancy/1", True) == ParsedPageCache.key("https://hh.ru/vacancy/1", True)
+    assert ParsedPageCache.key("https://hh.ru/vacancy/1", True) != ParsedPageCache.key("https://hh.ru/vacancy/1", False)
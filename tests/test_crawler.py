@@ -0,0 +1,246 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import aiosqlite
+import pytest
+from pytz import utc
+from telethon.errors.rpcerrorlist import FloodWaitError
+
+from common.utils import str_utc_time
+from db.sqlite import GET_CHANNEL_SYNC, SET_CHANNEL_LAST_MESSAGE_ID, SET_CHANNEL_DEEP_SYNCED
+from preprocessing.crawler import ChannelProgress, ChannelCrawler
+from preprocessing.pipeline import Stage
+from preprocessing.post_sourser import Preprocessing
+
+NOW = datetime.now(utc)
+PEER = SimpleNamespace(channel_id=1)
+
+
+async def get_channel_sync(db, channel_id):
+    cursor = await db.execute(GET_CHANNEL_SYNC, [channel_id])
+    return await cursor.fetchone()
+
+
+def test_channel_mark_never_moves_back(db_path):
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            marks = []
+            for last_message_id in [10, 5, 12]:
+                await db.execute(SET_CHANNEL_LAST_MESSAGE_ID, [1, last_message_id])
+                marks.append((await get_channel_sync(db, 1))[0])
+            return marks
+
+    assert asyncio.run(run()) == [10, 10, 12]
+
+
+def test_deep_sync_keeps_channel_mark(db_path):
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await db.execute(SET_CHANNEL_DEEP_SYNCED, [1, "2023-08-01 10:00:00"])
+            before_mark = await get_channel_sync(db, 1)
+            await db.execute(SET_CHANNEL_LAST_MESSAGE_ID, [1, 10])
+            await db.execute(SET_CHANNEL_DEEP_SYNCED, [1, "2023-08-02 10:00:00"])
+            return before_mark, await get_channel_sync(db, 1), await get_channel_sync(db, 2)
+
+    assert asyncio.run(run()) == (
+        (None, "2023-08-01 10:00:00"),
+        (10, "2023-08-02 10:00:00"),
+        None,
+    )
+
+
+def test_deep_sync_due_once_a_period():
+    preprocessing = Preprocessing()
+    now = datetime.now(utc)
+
+    assert preprocessing.is_deep_sync_due(None)
+    assert not preprocessing.is_deep_sync_due(str_utc_time(now - timedelta(hours=1)))
+    assert preprocessing.is_deep_sync_due(str_utc_time(now - timedelta(days=1, minutes=1)))
+
+
+def test_mark_moved_over_continuous_prefix():
+    progress = ChannelProgress(PEER, "channel", deep=False, last_message_id=0)
+    for message_id in [1, 2, 3, 4]:
+        progress.fetched(message_id)
+
+    assert progress.processed(2) is None
+    assert progress.processed(1) == 2
+    assert progress.processed(4) is None
+    assert progress.processed(3) == 4
+    assert progress.max_message_id == 4
+
+
+def test_mark_kept_before_failed_message():
+    progress = ChannelProgress(PEER, "channel", deep=False, last_message_id=0)
+    for message_id in [1, 2, 3]:
+        progress.fetched(message_id)
+
+    assert progress.processed(1) == 1
+    assert progress.processed(2, success=False) is None
+    assert progress.processed(3) is None
+    assert (progress.failed, progress.num_failed) == (True, 1)
+
+
+def test_deep_walk_doesnt_move_mark():
+    progress = ChannelProgress(PEER, "channel", deep=True, last_message_id=None)
+    # Newest first
+    for message_id in [3, 2, 1]:
+        progress.fetched(message_id)
+
+    assert [progress.processed(message_id) for message_id in [3, 2, 1]] == [None, None, None]
+    assert progress.max_message_id == 3
+
+
+def test_waits_for_fetched_messages():
+    async def run():
+        progress = ChannelProgress(PEER, "channel", deep=False, last_message_id=0)
+        await asyncio.wait_for(progress.wait_processed(), 1)
+
+        progress.fetched(1)
+        waiter = asyncio.ensure_future(progress.wait_processed())
+        await asyncio.sleep(0)
+        idle_before = waiter.done()
+        progress.processed(1)
+        await asyncio.wait_for(waiter, 1)
+        return idle_before
+
+    assert asyncio.run(run()) is False
+
+
+def make_message(message_id):
+    return SimpleNamespace(
+        id=message_id,
+        date=NOW,
+        chat=SimpleNamespace(username=None),
+        fwd_from=None,
+        peer_id=PEER,
+    )
+
+
+class FakeChannel:
+    """
+    Stands in for iter_channel_messages, raises FloodWait once after `flood_after` messages
+    """
+
+    def __init__(self, message_ids, flood_after=None):
+        self.message_ids = message_ids
+        self.flood_after = flood_after
+        self.calls = []
+
+    async def __call__(self, client, channel, min_id=None, reverse=False, offset_id=None, cutoff_date=None):
+        self.calls.append(min_id if reverse else offset_id)
+        message_ids = sorted(self.message_ids, reverse=not reverse)
+        for n, message_id in enumerate(message_ids):
+            if reverse and message_id <= min_id:
+                continue
+            if not reverse and offset_id and message_id >= offset_id:
+                continue
+            if self.flood_after is not None and n == self.flood_after:
+                self.flood_after = None
+                raise FloodWaitError(request=None, capture=0)
+            yield make_message(message_id)
+
+
+class FakePreprocessing:
+    def __init__(self, failing=(), processed_sources=(), deep_sync_due=False):
+        self.client = SimpleNamespace(session=SimpleNamespace(get_input_entity=lambda peer: peer))
+        self.failing = set(failing)
+        self.processed_sources = set(processed_sources)
+        self.deep_sync_due = deep_sync_due
+        self.handled = []
+        self.released = []
+
+    def ingestion_stages(self):
+        return [Stage("handle", self.handle, num_workers=2, queue_size=2)]
+
+    async def handle(self, db, job):
+        message_id = job.post_candidate.id
+        self.handled.append(message_id)
+        if message_id in self.failing:
+            raise RuntimeError("parsing failed")
+        # Later messages finish first
+        await asyncio.sleep(0.001 * (10 - message_id % 10))
+        return True
+
+    def is_deep_sync_due(self, deep_synced_at):
+        return self.deep_sync_due
+
+    async def archive_messages(self, messages, chat=None):
+        pass
+
+    async def find_processed_sources(self, db, sources):
+        return {source for source in sources if source in self.processed_sources}
+
+    def release(self, job, success=True):
+        self.released.append((job.post_candidate.id, success))
+
+
+async def crawl(db_path, preprocessing, channel, last_message_id=0, deep=None):
+    async with aiosqlite.connect(db_path) as db:
+        if last_message_id is not None:
+            await db.execute(SET_CHANNEL_LAST_MESSAGE_ID, [PEER.channel_id, last_message_id])
+            await db.commit()
+
+        crawler = ChannelCrawler(preprocessing, channel, cutoff_date=NOW - timedelta(days=1), page_size=3)
+        await crawler.crawl(db, [(PEER, "channel", None)], deep=deep)
+        return await get_channel_sync(db, PEER.channel_id)
+
+
+def test_incremental_sync_moves_mark(db_path):
+    preprocessing = FakePreprocessing()
+    channel = FakeChannel(range(1, 11))
+
+    (last_message_id, deep_synced_at) = asyncio.run(crawl(db_path, preprocessing, channel, last_message_id=4))
+    assert last_message_id == 10
+    assert deep_synced_at is None
+    assert sorted(preprocessing.handled) == list(range(5, 11))
+    assert channel.calls == [4]
+
+
+def test_flood_wait_resumes_from_last_fed_page(db_path):
+    preprocessing = FakePreprocessing()
+    channel = FakeChannel(range(1, 11), flood_after=5)
+
+    (last_message_id, _) = asyncio.run(crawl(db_path, preprocessing, channel))
+    # The first page was fed before FloodWait, messages 4 and 5 weren't
+    assert channel.calls == [0, 3]
+    assert sorted(preprocessing.handled) == list(range(1, 11))
+    assert last_message_id == 10
+
+
+def test_failed_message_retried_on_next_sync(db_path):
+    preprocessing = FakePreprocessing(failing=[4])
+    channel = FakeChannel(range(1, 11))
+
+    (last_message_id, _) = asyncio.run(crawl(db_path, preprocessing, channel))
+    # Messages finished before the failure was seen may have moved the mark
+    assert 1 <= last_message_id <= 3
+    assert (4, False) in preprocessing.released
+
+    preprocessing = FakePreprocessing()
+    (mark, _) = asyncio.run(crawl(db_path, preprocessing, channel, last_message_id=None))
+    assert sorted(preprocessing.handled) == list(range(last_message_id + 1, 11))
+    assert mark == 10
+
+
+def test_processed_sources_skipped(db_path):
+    preprocessing = FakePreprocessing(processed_sources=["2:1", "3:1"])
+    channel = FakeChannel(range(1, 5))
+
+    (last_message_id, _) = asyncio.run(crawl(db_path, preprocessing, channel))
+    assert sorted(preprocessing.handled) == [1, 4]
+    assert last_message_id == 4
+
+
+@pytest.mark.parametrize("last_message_id, deep", [(None, None), (4, True)])
+def test_deep_sync_marks_newest_message(db_path, last_message_id, deep):
+    preprocessing = FakePreprocessing()
+    channel = FakeChannel(range(1, 11), flood_after=4)
+
+    (mark, deep_synced_at) = asyncio.run(crawl(db_path, preprocessing, channel, last_message_id, deep))
+    # Newest first, resumed below the last fed page
+    assert channel.calls == [0, 8]
+    assert sorted(preprocessing.handled) == list(range(1, 11))
+    assert mark == 10
+    assert deep_synced_at is not None
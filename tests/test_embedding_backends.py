@@ -0,0 +1,44 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from db.embedding_backends import HashingEmbeddingBackend, OpenAIEmbeddingBackend, get_embedding_backend
+
+
+def test_backend_by_name():
+    assert isinstance(get_embedding_backend("local"), HashingEmbeddingBackend)
+    assert isinstance(get_embedding_backend("openai"), OpenAIEmbeddingBackend)
+    with pytest.raises(NotImplementedError):
+        get_embedding_backend("unknown")
+
+
+def test_hashing_embedding_normalized_and_stable():
+    backend = HashingEmbeddingBackend(dimension=64)
+    vector = backend.embed_one("Senior Python developer")
+
+    assert vector.shape == (64,)
+    assert vector.dtype == np.float32
+    assert np.linalg.norm(vector) == pytest.approx(1.0, abs=1e-6)
+    assert np.array_equal(vector, HashingEmbeddingBackend(dimension=64).embed_one("Senior Python developer"))
+
+
+def test_hashing_embedding_of_empty_text():
+    vector = HashingEmbeddingBackend(dimension=64).embed_one("  !!! ")
+    assert not vector.any()
+
+
+def test_hashing_embedding_similar_texts_closer():
+    backend = HashingEmbeddingBackend()
+    tokens, (python, python_remote, cook) = asyncio.run(backend.embed([
+        "Python backend developer",
+        "Remote python backend developer",
+        "Cook in the italian restaurant",
+    ]))
+
+    assert tokens == 0
+    assert np.dot(python, python_remote) > np.dot(python, cook)
+
+
+def test_hashing_model_name_changes_with_settings():
+    assert HashingEmbeddingBackend(dimension=64).get_model() != HashingEmbeddingBackend(dimension=128).get_model()
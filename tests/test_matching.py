@@ -0,0 +1,530 @@
+import asyncio
+import copy
+import json
+import re
+from contextlib import asynccontextmanager
+
+import aiosqlite
+import numpy as np
+import openai
+import pytest
+
+from common import utils
+from common.exceptions import CorruptedAIResponse
+from db.cache import GptResponseCache
+from db.vector_store import NumpyCollection
+from matching import filtering
+from matching.filtering import JobDescriptionsCheck
+from matching.bench_grouping import make_rows as make_bench_rows
+from matching.utils import count_index_approved, cosine_distances, normalize_rows, group_user_data_for_index, \
+    group_user_data_for_index_pandas, group_user_data_for_gpt_check, group_user_data_for_gpt_check_pandas
+
+
+class Emitter:
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+
+def make_rows(post_ids, prompt_ids):
+    return {
+        (post_id, prompt_id): {
+            "prompt_id": prompt_id,
+            "context_from_gpt4": "python developer",
+            "original_user_request": "python",
+            "prompt_status": "finished",
+            "post_id": post_id,
+            "user_id": prompt_id,
+            "process_status": None,
+            "index_distance": None,
+        }
+        for prompt_id in prompt_ids
+        for post_id in post_ids
+    }
+
+
+@pytest.fixture
+def check(tmp_path):
+    rng = np.random.default_rng(0)
+    check = JobDescriptionsCheck(emitter=Emitter())
+    check.index_posts = NumpyCollection(str(tmp_path), "posts", dimension=8)
+    check.index_prompts = NumpyCollection(str(tmp_path), "prompts", dimension=8)
+
+    post_ids = list(range(1, 201))
+    check.index_posts.add(
+        ids=[str(post_id) for post_id in post_ids],
+        embeddings=rng.normal(size=(len(post_ids), 8)).tolist(),
+        metadatas=[{"post_id": str(post_id)} for post_id in post_ids],
+    )
+    check.index_prompts.add(ids=["1", "2"], embeddings=rng.normal(size=(2, 8)).tolist())
+
+    yield check
+    check.index_posts.close()
+    check.index_prompts.close()
+
+
+def test_cosine_distances_of_normalized_rows():
+    queries = normalize_rows(np.array([[2.0, 0.0], [0.0, 0.0]]))
+    candidates = normalize_rows(np.array([[1.0, 0.0], [0.0, 3.0], [-1.0, 0.0]]))
+
+    assert cosine_distances(queries, candidates) == pytest.approx(np.array([
+        [0.0, 1.0, 2.0],
+        # Zero vector doesn't turn into NaN
+        [1.0, 1.0, 1.0],
+    ]))
+
+
+@pytest.mark.parametrize("percentile_distance, expected", [
+    # Top 1% is approved regardless of the distance
+    (0.0, 1),
+    (0.015, 2),
+    # No more than top 3%
+    (1.0, 3),
+])
+def test_count_index_approved(percentile_distance, expected):
+    distances = np.linspace(0, 1, 100)
+    assert count_index_approved(distances, percentile_distance) == expected
+
+
+def test_batched_index_check_same_as_query_per_prompt(check, db_path):
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await db.executemany(
+                "INSERT INTO prompts(prompt_id, user_id, original, for_gpt3) VALUES(?, ?, 'python', 'python')",
+                [(1, 1), (2, 2)]
+            )
+
+            rows = make_rows(range(1, 201), [1, 2])
+            batched = copy.deepcopy(rows)
+            await check.apply_index_check_batched(db, batched)
+            await check.apply_index_check(db, rows)
+            return rows, batched
+
+    rows, batched = asyncio.run(run())
+
+    assert {key: row["process_status"] for key, row in batched.items()} == \
+           {key: row["process_status"] for key, row in rows.items()}
+    assert [row["index_distance"] for row in batched.values()] == \
+           pytest.approx([row["index_distance"] for row in rows.values()], abs=1e-5)
+    # Both prompts have top 1% approved at least and top 3% at most
+    for prompt_id in [1, 2]:
+        num_approved = sum(
+            row["process_status"] == "index_approved"
+            for (_, row_prompt_id), row in batched.items()
+            if row_prompt_id == prompt_id
+        )
+        assert 2 <= num_approved <= 6
+
+
+def test_batched_index_check_in_chunks(check, db_path):
+    async def run(max_scoring_cells):
+        check.max_scoring_cells = max_scoring_cells
+        async with aiosqlite.connect(db_path) as db:
+            await db.execute("DELETE FROM prompts")
+            await db.executemany(
+                "INSERT INTO prompts(prompt_id, user_id, original, for_gpt3) VALUES(?, ?, 'python', 'python')",
+                [(1, 1), (2, 2)]
+            )
+            rows = make_rows(range(1, 201), [1, 2])
+            await check.apply_index_check_batched(db, rows)
+            return {key: row["process_status"] for key, row in rows.items()}
+
+    # One prompt per chunk
+    assert asyncio.run(run(200)) == asyncio.run(run(10_000_000))
+
+
+def test_batched_index_check_leaves_group_without_post_embeddings(check, db_path):
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await db.executemany(
+                "INSERT INTO prompts(prompt_id, user_id, original, for_gpt3) VALUES(?, ?, 'python', 'python')",
+                [(1, 1), (2, 2)]
+            )
+            # Posts of the second prompt aren't in the index yet
+            rows = {**make_rows(range(1, 201), [1]), **make_rows(range(201, 211), [2])}
+            await check.apply_index_check_batched(db, rows)
+            return rows
+
+    rows = asyncio.run(run())
+    assert all(row["process_status"] is not None for (_, prompt_id), row in rows.items() if prompt_id == 1)
+    assert all(row["process_status"] is None for (_, prompt_id), row in rows.items() if prompt_id == 2)
+
+
+async def fill_db(db, post_ids=(), prompt_ids=()):
+    await db.executemany(
+        "INSERT INTO posts(post_id, description, date, status) VALUES(?, 'python', date('now'), 'accepted')",
+        [(post_id,) for post_id in post_ids]
+    )
+    await db.executemany(
+        "INSERT INTO prompts(prompt_id, user_id, original, for_gpt3, date, active, status) "
+        "VALUES(?, ?, 'python', 'python developer', date('now'), 1, 'finished')",
+        [(prompt_id, prompt_id) for prompt_id in prompt_ids]
+    )
+    await db.commit()
+
+
+async def count_pairs(db, where="1"):
+    cursor = await db.execute(f"SELECT prompt_id, COUNT(*) FROM users_posts WHERE {where} GROUP BY prompt_id")
+    return dict(await cursor.fetchall())
+
+
+@pytest.fixture
+def no_gpt(check):
+    async def do_gpt_checks(db, rows, posts, **kwargs):
+        return [False] * len(posts)
+
+    check.do_gpt_checks = do_gpt_checks
+    return check
+
+
+def test_incremental_pass_matches_only_new_posts(no_gpt, db_path):
+    check = no_gpt
+    scored = []
+    apply_index_check_batched = check.apply_index_check_batched
+
+    async def spy(db, rows, post_embeddings=None):
+        scored.append(sorted({post_id for (post_id, _) in rows}))
+        await apply_index_check_batched(db, rows, post_embeddings)
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await fill_db(db, range(1, 191), [1, 2])
+            await check.find_matching_posts(db, full_scan=True)
+            after_full_scan = await count_pairs(db)
+
+            await fill_db(db, range(191, 201))
+            check.apply_index_check_batched = spy
+            await check.find_matching_posts(db, full_scan=False)
+            return after_full_scan, await count_pairs(db), await count_pairs(db, "post_id > 190")
+
+    after_full_scan, after_incremental, new_posts = asyncio.run(run())
+    assert after_full_scan == {1: 190, 2: 190}
+    assert scored == [list(range(191, 201))]
+    assert after_incremental == {1: 200, 2: 200}
+    assert new_posts == {1: 10, 2: 10}
+    assert check.last_post_id == 200
+    assert set(check.prompt_fingerprints) == {1, 2}
+
+
+def test_incremental_pass_matches_new_prompt_against_all_posts(no_gpt, db_path):
+    check = no_gpt
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await fill_db(db, range(1, 201), [1])
+            await check.find_matching_posts(db, full_scan=True)
+            await fill_db(db, prompt_ids=[2])
+            await check.find_matching_posts(db, full_scan=False)
+            return await count_pairs(db)
+
+    assert asyncio.run(run()) == {1: 200, 2: 200}
+
+
+def test_nothing_new_skips_the_pass(no_gpt, db_path):
+    check = no_gpt
+    calls = []
+
+    async def apply_index_check_batched(db, rows, post_embeddings=None):
+        calls.append(len(rows))
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await fill_db(db, range(1, 201), [1, 2])
+            await check.find_matching_posts(db, full_scan=True)
+            check.apply_index_check_batched = apply_index_check_batched
+            await check.find_matching_posts(db, full_scan=False)
+
+    asyncio.run(run())
+    assert calls == []
+
+
+def test_unscored_pairs_retried_on_next_pass(no_gpt, db_path):
+    check = no_gpt
+    check.index_posts.delete(ids=["150"])
+    embedding = np.ones(8).tolist()
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await fill_db(db, range(1, 201), [1, 2])
+            await check.find_matching_posts(db, full_scan=True)
+            before = await count_pairs(db, "post_id = 150")
+
+            # Embedding is indexed after the pass, no new posts meanwhile
+            check.index_posts.add(ids=["150"], embeddings=[embedding], metadatas=[{"post_id": "150"}])
+            await check.find_matching_posts(db, full_scan=False)
+            return before, await count_pairs(db, "post_id = 150")
+
+    before, after = asyncio.run(run())
+    assert before == {}
+    assert after == {1: 1, 2: 1}
+
+
+def test_only_prompt_with_unscored_pairs_left_out_of_watermark(no_gpt, db_path):
+    check = no_gpt
+    check.index_posts.delete(ids=["150"])
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await fill_db(db, range(1, 201), [1, 2])
+            # The first prompt has its candidates indexed, the second one has
+            # only the post without embedding left, both are on the same page
+            await db.execute("INSERT INTO users_posts(user_id, prompt_id, post_id) VALUES(1, 1, 150)")
+            await db.executemany(
+                "INSERT INTO users_posts(user_id, prompt_id, post_id) VALUES(2, 2, ?)",
+                [(post_id,) for post_id in range(1, 201) if post_id != 150]
+            )
+            await db.commit()
+
+            await check.find_matching_posts(db, full_scan=True)
+            return await count_pairs(db)
+
+    assert asyncio.run(run()) == {1: 200, 2: 199}
+    assert check.last_post_id == 200
+    assert set(check.prompt_fingerprints) == {1}
+
+
+def test_prompts_scored_a_page_at_a_time(no_gpt, db_path):
+    check = no_gpt
+    check.prompts_page_size = 2
+    check.index_prompts.add(ids=["3"], embeddings=[np.ones(8).tolist()])
+    pages = []
+    apply_index_check_batched = check.apply_index_check_batched
+
+    async def spy(db, rows, post_embeddings=None):
+        pages.append(sorted({prompt_id for (_, prompt_id) in rows}))
+        await apply_index_check_batched(db, rows, post_embeddings)
+
+    check.apply_index_check_batched = spy
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await fill_db(db, range(1, 201), [1, 2, 3])
+            await check.find_matching_posts(db, full_scan=True)
+            return await count_pairs(db)
+
+    assert asyncio.run(run()) == {1: 200, 2: 200, 3: 200}
+    assert pages == [[1, 2], [3]]
+
+
+def rows_with_gaps():
+    rows = make_bench_rows(2000, posts_per_prompt=100)
+    # Duplicate post of the prompt, and rows dropped for the missing values
+    rows.append(dict(rows[0]))
+    rows[1]["post_id"] = None
+    rows[2]["index_distance"] = float("nan")
+    rows[3]["context_from_gpt4"] = None
+    return rows
+
+
+def test_grouping_for_index_same_as_pandas():
+    rows = rows_with_gaps()
+    assert list(group_user_data_for_index(rows)) == list(group_user_data_for_index_pandas(rows))
+
+
+def test_grouping_for_gpt_check_same_as_pandas():
+    rows = rows_with_gaps()
+    assert list(group_user_data_for_gpt_check(rows)) == list(group_user_data_for_gpt_check_pandas(rows))
+
+
+def test_grouping_of_no_rows():
+    assert list(group_user_data_for_index([])) == []
+    assert list(group_user_data_for_gpt_check([])) == []
+
+
+class Reservation:
+    def __init__(self):
+        self.tokens_used = None
+
+    def used(self, tokens):
+        self.tokens_used = tokens
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.reserved = []
+
+    @asynccontextmanager
+    async def slot(self, model, tokens):
+        self.reserved.append(tokens)
+        yield Reservation()
+
+
+class FakeChat:
+    """
+    Scores "good" postings 95 and the rest 10, `mangle` edits the items of the batch answer
+    """
+
+    def __init__(self, mangle=None, finish_reason="stop"):
+        self.mangle = mangle
+        self.finish_reason = finish_reason
+        self.requests = []
+
+    @staticmethod
+    def verdict(text):
+        return {"score": 95 if text == "good" else 10, "reason": text, "user_requirements": []}
+
+    async def __call__(self, model, temperature, messages):
+        content = messages[1]["content"]
+        postings = re.findall(r"\[(\d+)]\n(\w+)", content)
+        self.requests.append(len(postings) or 1)
+
+        if postings:
+            answer = [{"post": int(n), **self.verdict(text)} for n, text in postings]
+            if self.mangle:
+                answer = self.mangle(answer)
+        else:
+            answer = self.verdict(content.split("\n")[1])
+
+        return {
+            "usage": {"total_tokens": 100},
+            "choices": [{"finish_reason": self.finish_reason, "message": {"content": json.dumps(answer)}}],
+        }
+
+
+@pytest.fixture
+def gpt(monkeypatch, check):
+    # Real tokenizer loads its encoding over the network
+    monkeypatch.setattr(filtering, "estimate_tokens", len)
+    monkeypatch.setattr(utils, "count_tokens", len)
+    check.scheduler = FakeScheduler()
+    return check
+
+
+def test_gpt_batches_bounded_by_posts_and_tokens(gpt):
+    check = gpt
+    check.gpt_batch_max_posts = 3
+    posts = [(n, 0.1, "x" * 100) for n in range(7)]
+
+    batches = check.pack_gpt_batches(posts, "context", "request", "gpt-3.5-turbo-0613")
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+
+    # Two posts with the answers fit into what is left of the context after the prompt
+    prompt_tokens = utils.get_prompt_tokens("filter_batch.txt") + len("request" + "context")
+    check.gpt_context_tokens = {"gpt-3.5-turbo-0613": prompt_tokens + 2 * 300}
+    batches = check.pack_gpt_batches(posts, "context", "request", "gpt-3.5-turbo-0613")
+    assert [len(batch) for batch in batches] == [2, 2, 2, 1]
+    assert [post for batch in batches for post in batch] == posts
+
+
+def test_gpt_batch_verdicts_in_order_of_texts(gpt, monkeypatch):
+    chat = FakeChat(mangle=lambda answer: answer[::-1])
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", chat)
+
+    tokens_used, verdicts = asyncio.run(gpt.gpt_check_batch(["good", "bad", "good"], "context", "request"))
+    assert tokens_used == 100
+    assert verdicts == [(95, "good"), (10, "bad"), (95, "good")]
+
+
+@pytest.mark.parametrize("mangle", [
+    # Same post answered twice, another one not at all
+    lambda answer: [answer[0], answer[0]],
+    lambda answer: answer[:1],
+    lambda answer: [answer[0], {**answer[1], "post": 3}],
+])
+def test_gpt_batch_verdict_on_each_post_required(gpt, monkeypatch, mangle):
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", FakeChat(mangle=mangle))
+    with pytest.raises(CorruptedAIResponse):
+        asyncio.run(gpt.gpt_check_batch(["good", "bad"], "context", "request"))
+
+
+def test_gpt_batch_cut_by_token_limit(gpt, monkeypatch):
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", FakeChat(finish_reason="length"))
+    with pytest.raises(CorruptedAIResponse):
+        asyncio.run(gpt.gpt_check_batch(["good", "bad"], "context", "request"))
+
+
+def test_gpt_single_check_reserves_one_answer(gpt, monkeypatch):
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", FakeChat())
+
+    asyncio.run(gpt.gpt_check("good", "context", "request"))
+    asyncio.run(gpt.gpt_check_batch(["good", "bad"], "context", "request"))
+    single, batch = gpt.scheduler.reserved
+    assert single < batch
+    assert single == len(utils.get_prompt("filter.txt")) + len("Job description / posting:\ngood\n\n"
+                                                             "Original user search request:\nrequest\n\n"
+                                                             "Explanation of user search request:\n context") + 150
+
+
+async def check_posts(check, db_path, texts):
+    async with aiosqlite.connect(db_path) as db:
+        await db.executemany(
+            "INSERT INTO posts(post_id, description, date, status) VALUES(?, ?, date('now'), 'accepted')",
+            list(enumerate(texts, start=1))
+        )
+        post_ids = list(range(1, len(texts) + 1))
+        return await check.do_gpt_checks(
+            db=db,
+            rows=make_rows(post_ids, [1]),
+            posts=[(post_id, 0.1) for post_id in post_ids],
+            context_from_gpt4="context",
+            original_user_request="request",
+            prompt_id=1,
+            user_id=1,
+        )
+
+
+def test_gpt_checks_batched(gpt, monkeypatch, db_path):
+    chat = FakeChat()
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", chat)
+    gpt.gpt_batch_max_posts = 2
+
+    verdicts = asyncio.run(check_posts(gpt, db_path, ["good", "bad", "bad", "good", "good"]))
+    assert verdicts == [True, False, False, True, True]
+    assert sorted(chat.requests) == [1, 2, 2]
+    assert gpt.gpt_calls == 3
+    assert [kwargs["post_id"] for (event, kwargs) in gpt.emitter.events if event == "search_result"] == [1, 4, 5]
+
+
+def test_malformed_gpt_batch_checked_post_by_post(gpt, monkeypatch, db_path):
+    chat = FakeChat(mangle=lambda answer: [answer[0], answer[0], answer[2]])
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", chat)
+
+    verdicts = asyncio.run(check_posts(gpt, db_path, ["good", "bad", "good"]))
+    assert verdicts == [True, False, True]
+    assert chat.requests == [3, 1, 1, 1]
+    assert gpt.gpt_calls == 3
+
+
+def test_cached_gpt_verdicts_reused(gpt, monkeypatch, db_path, tmp_path):
+    chat = FakeChat()
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", chat)
+
+    async def run():
+        gpt.gpt_cache = GptResponseCache(str(tmp_path / "cache.sqlite"))
+        await gpt.gpt_cache.open()
+        try:
+            first = await check_posts(gpt, db_path, ["good", "bad", "good"])
+            requests = list(chat.requests)
+            async with aiosqlite.connect(db_path) as db:
+                await db.execute("DELETE FROM posts")
+                await db.execute("DELETE FROM users_posts")
+                await db.commit()
+            second = await check_posts(gpt, db_path, ["good", "bad", "good"])
+            return first, requests, second, gpt.gpt_cache.stats()
+        finally:
+            await gpt.gpt_cache.close()
+
+    first, requests, second, stats = asyncio.run(run())
+    assert first == second == [True, False, True]
+    assert requests == [3]
+    assert chat.requests == [3]
+    assert (gpt.gpt_calls, gpt.gpt_cached) == (1, 3)
+    # Every post is looked up once per pass
+    assert (stats["hits"], stats["misses"]) == (3, 3)
+
+
+def test_gpt_fallback_doesnt_look_up_cache_again(gpt, monkeypatch, db_path, tmp_path):
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", FakeChat(mangle=lambda answer: answer[:1]))
+
+    async def run():
+        gpt.gpt_cache = GptResponseCache(str(tmp_path / "cache.sqlite"))
+        await gpt.gpt_cache.open()
+        try:
+            await check_posts(gpt, db_path, ["good", "bad"])
+            return gpt.gpt_cache.stats()
+        finally:
+            await gpt.gpt_cache.close()
+
+    assert asyncio.run(run())["misses"] == 2
@@ -0,0 +1,24 @@
+import pytest
+
+from parsing.utils import canonical_url
+
+
+@pytest.mark.parametrize("url", [
+    "https://hh.ru/vacancy/1",
+    "http://www.hh.ru/vacancy/1/",
+    "https://HH.ru/vacancy/1#contacts",
+    " https://m.hh.ru/vacancy/1?utm_source=telegram&utm_medium=post ",
+    "https://hh.ru/vacancy/1?from=main&hhtmFrom=vacancy_search_list",
+])
+def test_same_page_same_url(url):
+    assert canonical_url(url) == "https://hh.ru/vacancy/1"
+
+
+def test_query_kept_sorted():
+    assert canonical_url("https://career.habr.com/vacancies?type=all&q=python&ref=tg") == \
+           "https://career.habr.com/vacancies?q=python&type=all"
+
+
+def test_path_case_kept():
+    assert canonical_url("https://t.me/JobsChannel/12") == "https://t.me/JobsChannel/12"
+    assert canonical_url("https://hh.ru") == "https://hh.ru/"
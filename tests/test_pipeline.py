@@ -0,0 +1,135 @@
+import asyncio
+
+import aiosqlite
+
+from db.sqlite import SQLLite3Service
+from preprocessing.pipeline import Pipeline, Stage
+
+
+class Job:
+    def __init__(self, n, skip=False):
+        self.n = n
+        self.skip = skip
+        self.stages = []
+
+
+def make_handler(name, drop=(), fail=()):
+    async def handler(db, job):
+        job.stages.append(name)
+        if job.n in fail:
+            raise RuntimeError(f"{name} failed")
+        return job.n not in drop
+
+    return handler
+
+
+def run_jobs(stages, jobs):
+    done = []
+
+    async def on_done(job, success):
+        done.append((job.n, success))
+
+    async def run():
+        async with Pipeline(stages, on_done=on_done) as pipeline:
+            for job in jobs:
+                await pipeline.put(job)
+            await pipeline.join()
+            return pipeline.stats()
+
+    return asyncio.run(run()), done
+
+
+def test_jobs_pass_stages_in_order():
+    jobs = [Job(n) for n in range(5)]
+    stats, done = run_jobs([
+        Stage("first", make_handler("first"), num_workers=2),
+        Stage("second", make_handler("second"), num_workers=3),
+    ], jobs)
+
+    assert sorted(done) == [(n, True) for n in range(5)]
+    assert all(job.stages == ["first", "second"] for job in jobs)
+    assert stats["first"]["processed"] == stats["second"]["processed"] == 5
+
+
+def test_dropped_and_failed_jobs_leave_pipeline():
+    jobs = [Job(n) for n in range(4)]
+    stats, done = run_jobs([
+        Stage("first", make_handler("first", drop=[1], fail=[2])),
+        Stage("second", make_handler("second")),
+    ], jobs)
+
+    assert sorted(done) == [(0, True), (1, True), (2, False), (3, True)]
+    assert [job.stages for job in jobs] == [["first", "second"], ["first"], ["first"], ["first", "second"]]
+    assert (stats["first"]["dropped"], stats["first"]["failed"]) == (1, 1)
+
+
+def test_skipped_jobs_pass_stage_as_is():
+    jobs = [Job(0), Job(1, skip=True)]
+    stats, done = run_jobs([
+        Stage("first", make_handler("first"), skip=lambda job: job.skip),
+        Stage("second", make_handler("second")),
+    ], jobs)
+
+    assert sorted(done) == [(0, True), (1, True)]
+    assert [job.stages for job in jobs] == [["first", "second"], ["second"]]
+    assert stats["first"]["skipped"] == 1
+
+
+def test_full_queue_blocks_producer():
+    async def run():
+        unblocked = asyncio.Event()
+
+        async def slow(db, job):
+            await unblocked.wait()
+            return True
+
+        async with Pipeline([Stage("slow", slow, num_workers=1, queue_size=2)]) as pipeline:
+            # One job is taken by the worker, two fill the queue
+            for n in range(3):
+                await asyncio.wait_for(pipeline.put(Job(n)), 1)
+
+            blocked = asyncio.ensure_future(pipeline.put(Job(3)))
+            await asyncio.sleep(0.01)
+            was_blocked = not blocked.done()
+
+            unblocked.set()
+            await asyncio.wait_for(blocked, 1)
+            await pipeline.join()
+            return was_blocked
+
+    assert asyncio.run(run())
+
+
+def test_db_stage_workers_have_own_connection(db_path, monkeypatch):
+    monkeypatch.setattr(SQLLite3Service, "db_path", db_path)
+    connections = set()
+
+    async def handler(db, job):
+        connections.add(id(db))
+        await db.execute("INSERT INTO posts(description) VALUES(?)", [str(job.n)])
+        await db.commit()
+        await asyncio.sleep(0.01)
+        return True
+
+    run_jobs([Stage("persist", handler, num_workers=2, db=True)], [Job(n) for n in range(4)])
+    assert len(connections) == 2
+
+
+def test_failed_job_rolled_back(db_path, monkeypatch):
+    monkeypatch.setattr(SQLLite3Service, "db_path", db_path)
+
+    async def handler(db, job):
+        await db.execute("INSERT INTO posts(description) VALUES(?)", [str(job.n)])
+        if job.n == 1:
+            raise RuntimeError("persist failed")
+        await db.commit()
+        return True
+
+    async def get_posts():
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("SELECT description FROM posts ORDER BY description")
+            return [description for (description,) in await cursor.fetchall()]
+
+    _, done = run_jobs([Stage("persist", handler, db=True)], [Job(n) for n in range(3)])
+    assert sorted(done) == [(0, True), (1, False), (2, True)]
+    assert asyncio.run(get_posts()) == ["0", "2"]
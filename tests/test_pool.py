@@ -0,0 +1,222 @@
+import asyncio
+
+import pytest
+from selenium.common.exceptions import WebDriverException
+
+from parsing.pool import DriverPool, PoolClosed
+
+
+class SwitchTo:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def window(self, handle):
+        self.driver.current_handle = handle
+
+
+class FakeDriver:
+    def __init__(self):
+        self.alive = True
+        self.window_handles = ["main"]
+        self.current_handle = "main"
+        self.switch_to = SwitchTo(self)
+        self.closed = []
+        self.quit_called = False
+        self.capabilities = {}
+
+    @property
+    def current_url(self):
+        if not self.alive:
+            raise WebDriverException("browser is gone")
+        return "about:blank"
+
+    def close(self):
+        self.closed.append(self.current_handle)
+        self.window_handles.remove(self.current_handle)
+
+    def quit(self):
+        self.quit_called = True
+
+
+class Drivers:
+    def __init__(self, fail=0):
+        self.created = []
+        self.fail = fail
+
+    def __call__(self):
+        if self.fail:
+            self.fail -= 1
+            raise WebDriverException("can't start firefox")
+        driver = FakeDriver()
+        self.created.append(driver)
+        return driver
+
+
+def make_pool(drivers, **kwargs):
+    pool = DriverPool(drivers, min_size=kwargs.pop("min_size", 0), max_size=kwargs.pop("max_size", 2))
+    pool.spawn_retry_delay = 0
+    for name, value in kwargs.items():
+        setattr(pool, name, value)
+    return pool
+
+
+def test_min_size_over_max_size():
+    with pytest.raises(ValueError):
+        DriverPool(Drivers(), min_size=3, max_size=2)
+
+
+def test_drivers_started_on_demand_up_to_max_size():
+    drivers = Drivers()
+
+    async def run():
+        pool = make_pool(drivers)
+        try:
+            first, second = await asyncio.gather(pool.acquire(), pool.acquire())
+            third = asyncio.ensure_future(pool.acquire())
+            await asyncio.sleep(0.05)
+            was_waiting = not third.done()
+
+            await pool.release(first)
+            # The released driver goes to the parse waiting for it
+            handed_over = (await third) is first
+            stats = pool.stats()
+
+            await pool.release(first)
+            await pool.release(second)
+            return was_waiting, handed_over, stats
+        finally:
+            await pool.close()
+
+    was_waiting, handed_over, stats = asyncio.run(run())
+    assert was_waiting
+    assert handed_over
+    assert len(drivers.created) == 2
+    assert (stats["spawned"], stats["acquired"], stats["busy"], stats["idle"]) == (2, 3, 2, 0)
+
+
+def test_driver_recycled_after_max_uses():
+    drivers = Drivers()
+
+    async def run():
+        pool = make_pool(drivers, max_uses=2)
+        try:
+            for _ in range(3):
+                async with pool.driver():
+                    pass
+            return pool.stats()
+        finally:
+            await pool.close()
+
+    stats = asyncio.run(run())
+    assert len(drivers.created) == 2
+    assert drivers.created[0].quit_called
+    assert stats["recycled"]["uses"] == 1
+
+
+def test_failed_parse_retires_driver():
+    drivers = Drivers()
+
+    async def run():
+        pool = make_pool(drivers)
+        try:
+            with pytest.raises(WebDriverException):
+                async with pool.driver():
+                    raise WebDriverException("tab crashed")
+            stats = pool.stats()
+            await asyncio.sleep(0.05)
+            return stats
+        finally:
+            await pool.close()
+
+    stats = asyncio.run(run())
+    assert drivers.created[0].quit_called
+    assert stats["recycled"] == {"unhealthy": 1}
+    assert stats["size"] == 0
+
+
+def test_popup_windows_closed_on_release():
+    drivers = Drivers()
+
+    async def run():
+        pool = make_pool(drivers)
+        try:
+            async with pool.driver() as driver:
+                driver.window_handles.extend(["popup", "ad"])
+                driver.switch_to.window("ad")
+            return driver
+        finally:
+            await pool.close()
+
+    driver = asyncio.run(run())
+    assert driver.closed == ["popup", "ad"]
+    assert (driver.window_handles, driver.current_handle) == (["main"], "main")
+
+
+def test_failed_setup_retried():
+    drivers = Drivers(fail=1)
+
+    async def run():
+        pool = make_pool(drivers)
+        try:
+            pooled = await asyncio.wait_for(pool.acquire(), 1)
+            await pool.release(pooled)
+            return pool.stats()
+        finally:
+            await pool.close()
+
+    stats = asyncio.run(run())
+    assert (stats["spawn_failed"], stats["spawned"]) == (1, 1)
+
+
+def test_idle_drivers_checked():
+    drivers = Drivers()
+
+    async def run():
+        pool = make_pool(drivers, min_size=1, max_size=3)
+        try:
+            pooled = await asyncio.gather(*[pool.acquire() for _ in range(3)])
+            for p in pooled:
+                await pool.release(p)
+
+            # The first is dead, the second idled out, the last one is kept
+            # as min_size
+            pooled[0].driver.alive = False
+            pooled[1].released_at -= pool.idle_timeout
+            pooled[2].released_at -= pool.idle_timeout
+            await pool.check_idle()
+            return pool.stats()
+        finally:
+            await pool.close()
+
+    stats = asyncio.run(run())
+    assert stats["size"] == 1
+    assert stats["recycled"] == {"unhealthy": 1, "idle": 1}
+
+
+def test_close_quits_drivers_and_fails_waiters():
+    drivers = Drivers()
+
+    async def run():
+        pool = make_pool(drivers, max_size=1, health_check_period=60)
+        await pool.open()
+        pooled = await pool.acquire()
+        waiter = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0)
+
+        closing = asyncio.ensure_future(pool.close(timeout=1))
+        await asyncio.sleep(0.05)
+        # Waits for the driver in use
+        was_closing = not closing.done()
+        await pool.release(pooled)
+        await closing
+
+        with pytest.raises(PoolClosed):
+            await waiter
+        with pytest.raises(PoolClosed):
+            await pool.acquire()
+        return was_closing, pool.stats()
+
+    was_closing, stats = asyncio.run(run())
+    assert was_closing
+    assert all(driver.quit_called for driver in drivers.created)
+    assert stats["recycled"] == {"closed": 1}
@@ -0,0 +1,170 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import aiosqlite
+import openai
+from pytz import utc
+
+from common.singleflight import SingleFlight
+
+from db.sqlite import GET_PROCESSED_SOURCES
+from preprocessing.jobs import RecentSources, PostJob, JobPosting
+from preprocessing.post_sourser import Preprocessing
+
+
+async def add_posts(db, sources):
+    await db.executemany("INSERT INTO posts(source, status) VALUES(?, 'accepted')", [(source,) for source in sources])
+    await db.commit()
+
+
+def test_recent_sources_forget_least_recently_added():
+    sources = RecentSources(maxsize=2)
+    for source in ["1:1", "2:1", "1:1", "3:1"]:
+        sources.add(source)
+
+    assert "1:1" in sources
+    assert "2:1" not in sources
+    assert "3:1" in sources
+    assert len(sources) == 2
+
+
+def test_processed_sources_found_in_memory_and_db(db_path):
+    preprocessing = Preprocessing()
+    preprocessing.recent_sources_size = 2
+    preprocessing.sources_lookup_size = 2
+    queries = []
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await add_posts(db, ["1:1", "2:1", "2:1", "3:1", "4:1"])
+            await preprocessing.load_recent_sources(db)
+            loaded = [source for source in ["1:1", "2:1", "3:1", "4:1"] if source in preprocessing.recent_sources]
+
+            await db.set_trace_callback(queries.append)
+            processed = await preprocessing.find_processed_sources(db, ["1:1", "2:1", "4:1", "5:1", "6:1", "1:1"])
+            await db.set_trace_callback(None)
+            return loaded, processed
+
+    loaded, processed = asyncio.run(run())
+    # The most recent posts are known from memory
+    assert loaded == ["3:1", "4:1"]
+    assert processed == {"1:1", "2:1", "4:1"}
+    # Four unknown sources are looked up by two at once
+    assert len([query for query in queries if "WHERE source IN" in query]) == 2
+    assert "1:1" in preprocessing.recent_sources
+
+
+def test_processed_sources_looked_up_by_index(db_path):
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("EXPLAIN QUERY PLAN " + GET_PROCESSED_SOURCES.format(placeholders="?,?"),
+                                      ["1:1", "2:1"])
+            return " ".join(str(row) for row in await cursor.fetchall())
+
+    assert "posts_source" in asyncio.run(run())
+
+
+class Concurrency:
+    def __init__(self):
+        self.current = 0
+        self.max = 0
+
+    async def run(self, delay):
+        self.current += 1
+        self.max = max(self.max, self.current)
+        await asyncio.sleep(delay)
+        self.current -= 1
+
+
+def test_job_infos_decomposed_concurrently_in_order():
+    preprocessing = Preprocessing()
+    preprocessing.subpost_concurrency = 3
+    concurrency = Concurrency()
+
+    async def decompose_job_info(job_info, log_info):
+        # Later job infos finish first
+        await concurrency.run(0.01 * (10 - job_info["n"]))
+        return None if job_info["n"] == 2 else job_info
+
+    preprocessing.decompose_job_info = decompose_job_info
+    job_infos = asyncio.run(preprocessing.decompose_job_infos([{"n": n} for n in range(6)]))
+
+    assert [job_info["n"] for job_info in job_infos] == [0, 1, 3, 4, 5]
+    assert concurrency.max == 3
+
+
+def make_posting(text, reject_reason=None):
+    return JobPosting(SimpleNamespace(plain=lambda: text), None, "english", reject_reason)
+
+
+def test_postings_embedded_concurrently():
+    preprocessing = Preprocessing()
+    preprocessing.subpost_concurrency = 2
+    concurrency = Concurrency()
+    embedded = []
+
+    async def create_embedding(contents):
+        await concurrency.run(0.01)
+        if contents == ["too long"]:
+            raise openai.error.InvalidRequestError("maximum context length", None)
+        embedded.extend(contents)
+        return 1, [[float(len(contents[0]))]]
+
+    preprocessing.create_embedding = create_embedding
+    job = PostJob(post_candidate=None, channel_name="channel")
+    job.postings = [
+        make_posting("first"),
+        make_posting("rejected", reject_reason="no_vacancy"),
+        make_posting("too long"),
+        make_posting("third"),
+        make_posting("fourth!"),
+    ]
+
+    assert asyncio.run(preprocessing.stage_embed(None, job))
+    assert sorted(embedded) == ["first", "fourth!", "third"]
+    assert [posting.embedding for posting in job.postings] == [[5.0], None, None, [5.0], [7.0]]
+    assert [posting.skipped for posting in job.postings] == [False, False, True, False, False]
+    assert concurrency.max == 2
+
+
+def make_message(message_id, channel_id=1):
+    return SimpleNamespace(
+        id=message_id,
+        raw_text="Python developer",
+        entities=[],
+        reply_markup=None,
+        reactions=None,
+        date=datetime.now(utc),
+        chat=SimpleNamespace(username=None),
+        fwd_from=None,
+        peer_id=SimpleNamespace(channel_id=channel_id),
+    )
+
+
+def test_same_message_waits_for_one_in_progress(db_path):
+    preprocessing = Preprocessing()
+    preprocessing.inflight = SingleFlight()
+    preprocessing.unindexed = {}
+    preprocessing.recent_sources = RecentSources()
+
+    async def run(success):
+        async with aiosqlite.connect(db_path) as db:
+            live = PostJob(make_message(1), "channel")
+            sync = PostJob(make_message(1), "channel")
+
+            live_passed = await preprocessing.stage_pre_dedupe(db, live)
+            waiting = asyncio.ensure_future(preprocessing.stage_pre_dedupe(db, sync))
+            await asyncio.sleep(0.01)
+            was_waiting = not waiting.done()
+
+            preprocessing.release(live, success)
+            sync_passed = await waiting
+            preprocessing.release(sync, sync_passed)
+            return live_passed, was_waiting, sync_passed
+
+    # Processed by the first caller, the second one drops the message
+    assert asyncio.run(run(success=True)) == (True, True, False)
+    # Failed there, so it is processed by the second one
+    assert asyncio.run(run(success=False)) == (True, True, True)
+    assert len(preprocessing.inflight) == 0
@@ -0,0 +1,115 @@
+import asyncio
+
+import aiosqlite
+import pytest
+
+from db.reconcile import PromptsReconciler
+from db.vector_store import NumpyCollection
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = NumpyCollection(str(tmp_path / "index"), "prompts", dimension=2)
+    yield index
+    index.close()
+
+
+class Embeddings:
+    def __init__(self, fail_on=None):
+        self.calls = []
+        self.fail_on = fail_on
+
+    async def __call__(self, contents):
+        self.calls.append(contents)
+        if self.fail_on in contents:
+            raise RuntimeError("openai is down")
+        return len(contents), [[1.0, float(len(content))] for content in contents]
+
+
+def make_reconciler(index, create_embedding, page_size=2):
+    reconciler = PromptsReconciler(index, create_embedding)
+    reconciler.page_size = page_size
+    reconciler.pause = 0
+    return reconciler
+
+
+async def add_prompts(db, prompts):
+    await db.executemany(
+        "INSERT INTO prompts(prompt_id, for_index, status) VALUES(?, ?, ?)",
+        [(prompt_id, f"prompt {prompt_id}", status) for (prompt_id, status) in prompts]
+    )
+    await db.commit()
+
+
+async def get_checkpoint(db):
+    cursor = await db.execute("SELECT phase, position, max_id FROM reconcile_checkpoints WHERE name = 'prompts'")
+    return await cursor.fetchone()
+
+
+def test_missing_added_and_zombies_removed(db_path, index):
+    index.add(ids=["2", "3"], embeddings=[[1.0, 0.0], [0.0, 1.0]])
+    embeddings = Embeddings()
+    reconciler = make_reconciler(index, embeddings)
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await add_prompts(db, [(1, "approved"), (2, "approved"), (3, "rejected"), (4, "approved"), (5, None)])
+            await reconciler.run(db)
+            return await get_checkpoint(db)
+
+    assert asyncio.run(run()) is None
+    assert sorted(index.get(include=[])["ids"]) == ["1", "2", "4"]
+    assert embeddings.calls == [["prompt 1"], ["prompt 4"]]
+    assert (reconciler.added, reconciler.removed) == (2, 1)
+
+
+def test_synced_index_left_alone(db_path, index):
+    index.add(ids=["1"], embeddings=[[1.0, 0.0]])
+    embeddings = Embeddings()
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await add_prompts(db, [(1, "approved"), (2, "rejected")])
+            await make_reconciler(index, embeddings).run(db)
+            return await get_checkpoint(db)
+
+    assert asyncio.run(run()) is None
+    assert embeddings.calls == []
+
+
+def test_interrupted_pass_resumed_from_checkpoint(db_path, index):
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await add_prompts(db, [(n, "approved") for n in range(1, 6)])
+
+            with pytest.raises(RuntimeError):
+                await make_reconciler(index, Embeddings(fail_on="prompt 3")).run(db)
+            interrupted = await get_checkpoint(db)
+
+            # Created after the pass has started, indexed by the ingestion
+            await add_prompts(db, [(6, "approved")])
+            embeddings = Embeddings()
+            await make_reconciler(index, embeddings).run(db)
+            return interrupted, embeddings.calls, await get_checkpoint(db)
+
+    interrupted, calls, checkpoint = asyncio.run(run())
+    assert interrupted == ("missing", 2, 5)
+    assert calls == [["prompt 3", "prompt 4"], ["prompt 5"]]
+    assert checkpoint is None
+    assert sorted(index.get(include=[])["ids"]) == ["1", "2", "3", "4", "5"]
+
+
+def test_zombies_phase_keeps_index_above_max_id(db_path, index):
+    index.add(ids=["1", "2", "7"], embeddings=[[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+
+    async def run():
+        async with aiosqlite.connect(db_path) as db:
+            await add_prompts(db, [(1, "approved"), (3, "rejected")])
+            await db.execute("INSERT INTO reconcile_checkpoints(name, phase, position, max_id) "
+                             "VALUES('prompts', 'zombies', 0, 3)")
+            await db.commit()
+            await make_reconciler(index, Embeddings()).run(db)
+
+    asyncio.run(run())
+    # Prompt 7 isn't committed yet, it may be being saved right now
+    assert sorted(index.get(include=[])["ids"]) == ["1", "7"]
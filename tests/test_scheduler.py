@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import pytest
+
+from gpt.scheduler import OpenAIScheduler, Priority, openai_priority, get_openai_priority
+
+
+def make_scheduler(rpm, tpm, window=0.1):
+    scheduler = OpenAIScheduler()
+    scheduler.limits = {"model": (rpm, tpm)}
+    scheduler.window = window
+    return scheduler
+
+
+def test_requests_per_minute_window():
+    async def run():
+        scheduler = make_scheduler(rpm=2, tpm=1000)
+        started_at = time.monotonic()
+        waited = []
+        for _ in range(3):
+            async with scheduler.slot("model", 10, Priority.LIVE):
+                waited.append(time.monotonic() - started_at)
+        await scheduler.stop()
+        return waited
+
+    waited = asyncio.run(run())
+    assert waited[1] < 0.05
+    # Third request waits for the first one to leave the window
+    assert waited[2] >= 0.09
+
+
+def test_tokens_per_minute_window():
+    async def run():
+        scheduler = make_scheduler(rpm=10, tpm=100)
+        async with scheduler.slot("model", 60, Priority.LIVE):
+            pass
+        second = asyncio.ensure_future(scheduler.acquire("model", 60, Priority.LIVE))
+        await asyncio.sleep(0.02)
+        blocked = not second.done()
+        await second
+        await scheduler.stop()
+        return blocked, scheduler.stats()
+
+    blocked, stats = asyncio.run(run())
+    assert blocked
+    assert stats["requests"]["LIVE"] == 2
+    assert stats["tokens"]["LIVE"] == 120
+
+
+def test_actual_usage_unblocks_waiting():
+    async def run():
+        scheduler = make_scheduler(rpm=10, tpm=100, window=10)
+        async with scheduler.slot("model", 60, Priority.LIVE) as reservation:
+            second = asyncio.ensure_future(scheduler.acquire("model", 60, Priority.LIVE))
+            await asyncio.sleep(0.01)
+            assert not second.done()
+            reservation.used(30)
+        await asyncio.wait_for(second, 1)
+        await scheduler.stop()
+        return scheduler.stats()
+
+    assert asyncio.run(run())["tokens"]["LIVE"] == 90
+
+
+def test_request_over_budget_let_through_on_empty_window():
+    async def run():
+        scheduler = make_scheduler(rpm=10, tpm=100)
+        await asyncio.wait_for(scheduler.acquire("model", 500, Priority.LIVE), 1)
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+
+def test_waiting_requests_served_by_priority():
+    async def run():
+        scheduler = make_scheduler(rpm=1, tpm=1000, window=0.05)
+        await scheduler.acquire("model", 10, Priority.SYNC)
+
+        served = []
+
+        async def request(name, priority):
+            async with scheduler.slot("model", 10, priority):
+                served.append(name)
+
+        tasks = []
+        for name, priority in [
+            ("sync", Priority.SYNC),
+            ("live", Priority.LIVE),
+            ("first_search", Priority.FIRST_SEARCH),
+            ("live_later", Priority.LIVE),
+        ]:
+            tasks.append(asyncio.ensure_future(request(name, priority)))
+            await asyncio.sleep(0)
+
+        await asyncio.sleep(0)
+        depth = scheduler.queue_depth()
+        await asyncio.gather(*tasks)
+        await scheduler.stop()
+        return depth, served
+
+    depth, served = asyncio.run(run())
+    assert depth == {"FIRST_SEARCH": 1, "LIVE": 2, "SYNC": 1}
+    assert served == ["first_search", "live", "live_later", "sync"]
+
+
+def test_cancelled_request_skipped():
+    async def run():
+        scheduler = make_scheduler(rpm=1, tpm=1000, window=0.05)
+        await scheduler.acquire("model", 10, Priority.LIVE)
+        cancelled = asyncio.ensure_future(scheduler.acquire("model", 10, Priority.FIRST_SEARCH))
+        waiting = asyncio.ensure_future(scheduler.acquire("model", 10, Priority.SYNC))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.wait_for(waiting, 1)
+        await scheduler.stop()
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert stats["requests"] == {"FIRST_SEARCH": 0, "LIVE": 1, "SYNC": 1}
+
+
+def test_limits_per_model():
+    scheduler = OpenAIScheduler()
+    assert scheduler.get_limits("gpt-4-0613") == (20, 10_000)
+    assert scheduler.get_limits("unknown") == scheduler.default_limits
+
+
+def test_priority_inherited_by_tasks():
+    async def run():
+        async def task_priority():
+            return get_openai_priority()
+
+        with openai_priority(Priority.FIRST_SEARCH):
+            inner = await asyncio.ensure_future(task_priority())
+        return inner, get_openai_priority()
+
+    assert asyncio.run(run()) == (Priority.FIRST_SEARCH, Priority.SYNC)
+
+
+@pytest.mark.parametrize("priority", list(Priority))
+def test_request_takes_priority_of_context(priority):
+    async def run():
+        scheduler = make_scheduler(rpm=10, tpm=1000)
+        with openai_priority(priority):
+            await scheduler.acquire("model", 10)
+        await scheduler.stop()
+        return scheduler.stats()["requests"][priority.name]
+
+    assert asyncio.run(run()) == 1
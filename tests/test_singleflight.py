@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from common.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one():
+    calls = []
+
+    async def load(url):
+        calls.append(url)
+        await asyncio.sleep(0.01)
+        return f"page {url}"
+
+    async def run():
+        inflight = SingleFlight()
+        results = await asyncio.gather(*[inflight.run(url, load, url) for url in ["a", "a", "b", "a"]])
+        return results, inflight
+
+    results, inflight = asyncio.run(run())
+    assert results == ["page a", "page a", "page b", "page a"]
+    assert sorted(calls) == ["a", "b"]
+    assert (inflight.started, inflight.shared) == (2, 2)
+    # Finished calls are forgotten, the next one is made again
+    assert len(inflight) == 0
+
+
+def test_failure_shared_and_forgotten():
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("not found")
+
+    async def run():
+        inflight = SingleFlight()
+        results = await asyncio.gather(inflight.run("a", load), inflight.run("a", load), return_exceptions=True)
+        with pytest.raises(RuntimeError):
+            await inflight.run("a", load)
+        return results
+
+    results = asyncio.run(run())
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+    assert len(calls) == 2
+
+
+def test_cancelled_waiter_doesnt_cancel_call():
+    async def load():
+        await asyncio.sleep(0.02)
+        return "page"
+
+    async def run():
+        inflight = SingleFlight()
+        owner = asyncio.ensure_future(inflight.run("a", load))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(inflight.run("a", load))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        return await owner, waiter.cancelled()
+
+    assert asyncio.run(run()) == ("page", True)
+
+
+def test_begin_end_by_caller():
+    async def run():
+        inflight = SingleFlight()
+        inflight.begin("1:1")
+        waiter = asyncio.ensure_future(inflight.wait("1:1"))
+        await asyncio.sleep(0)
+
+        registered = inflight.get("1:1") is not None
+        inflight.end("1:1", True)
+        # Ending twice is harmless
+        inflight.end("1:1", False)
+        return registered, await waiter, inflight.get("1:1")
+
+    assert asyncio.run(run()) == (True, True, None)
@@ -0,0 +1,49 @@
+import logging
+
+import pytest
+
+from common import startup as startup_module
+from common.startup import StartupReport
+
+
+class Service:
+    pass
+
+
+class Bot:
+    pass
+
+
+@pytest.fixture
+def frozen(monkeypatch, clock):
+    monkeypatch.setattr(startup_module, "time", clock)
+    return clock
+
+
+def test_phases_counted_from_previous_mark(frozen):
+    report = StartupReport()
+    frozen.advance(1.5)
+    report.mark("imports")
+    frozen.advance(0.25)
+    report.mark("services")
+
+    assert report.report() == {"elapsed": 1.75, "phases": {"imports": 1.5, "services": 0.25}, "services": {}}
+
+
+def test_report_logged_once_tracked_services_ready(frozen, caplog):
+    report = StartupReport()
+    report.track(Service(), Bot())
+
+    with caplog.at_level(logging.INFO, logger=startup_module.__name__):
+        frozen.advance(1)
+        report.ready(Service())
+        logged_early = "Startup" in caplog.text
+
+        frozen.advance(2)
+        report.ready(Bot())
+        # Ready again after a restart of the service
+        report.ready(Bot())
+
+    assert not logged_early
+    assert report.report()["services"] == {"Service": 1, "Bot": 3}
+    assert len([record for record in caplog.records if "Startup" in record.getMessage()]) == 1
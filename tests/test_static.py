@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+
+from parsing.static import StaticPage, HttpFetcher, FetchFailed, xpath_to_css
+
+HTML = """
+<!DOCTYPE html>
+<html>
+<head><title>Vacancy</title><script>var a = 1;</script></head>
+<body>
+  <!-- header -->
+  <h1 data-qa="vacancy-title">Python   developer</h1>
+  <div class="vacancy-description">
+    <p>Remote,<br>full time</p>
+    <ul><li>Django</li><li>asyncio <b>and</b> aiohttp</li></ul>
+    <style>.a {}</style>
+  </div>
+  <a id="apply" class="button primary" href="/apply" disabled>Apply</a>
+  <span class="hidden-contact" style="display: none">@hr</span>
+</body>
+</html>
+"""
+
+
+@pytest.mark.parametrize("xpath, css", [
+    ("//*[@data-qa='vacancy-title']", '[data-qa="vacancy-title"]'),
+    ('//div[@class="description"]', 'div[class="description"]'),
+])
+def test_xpath_to_css(xpath, css):
+    assert xpath_to_css(xpath) == css
+
+
+@pytest.mark.parametrize("xpath", ["//div/span", "//*[contains(@class, 'a')]", "/html"])
+def test_unsupported_xpath(xpath):
+    with pytest.raises(NotImplementedError):
+        xpath_to_css(xpath)
+
+
+@pytest.fixture
+def page():
+    page = StaticPage(lambda url: (url + "?redirected", HTML))
+    page.get("https://hh.ru/vacancy/1")
+    return page
+
+
+def test_page_found_by_parser_locators(page):
+    assert page.current_url == "https://hh.ru/vacancy/1?redirected"
+    assert page.find_element(By.XPATH, "//*[@data-qa='vacancy-title']").text == "Python developer"
+    assert page.find_element(By.CLASS_NAME, "vacancy-description").find_element(By.TAG_NAME, "li").text == "Django"
+    assert [element.text for element in page.find_elements(By.CSS_SELECTOR, "li")] == ["Django", "asyncio and aiohttp"]
+
+    with pytest.raises(NoSuchElementException):
+        page.find_element(By.ID, "missing")
+    assert page.find_elements(By.ID, "missing") == []
+
+
+def test_text_rendered_like_browser(page):
+    # Blocks and breaks go on their own lines, scripts, styles and comments
+    # aren't shown
+    assert page.find_element(By.CLASS_NAME, "vacancy-description").text == \
+           "Remote,\nfull time\nDjango\nasyncio and aiohttp"
+    assert "var a" not in page.find_element(By.TAG_NAME, "html").text
+
+
+def test_element_attributes(page):
+    apply = page.find_element(By.ID, "apply")
+
+    assert apply.get_attribute("class") == "button primary"
+    assert apply.get_attribute("href") == "/apply"
+    assert apply.get_attribute("outerHTML").startswith("<a ")
+    assert apply.get_attribute("innerHTML") == "Apply"
+    assert apply.get_attribute("missing") is None
+    assert (apply.is_displayed(), apply.is_enabled()) == (True, False)
+    assert not page.find_element(By.CLASS_NAME, "hidden-contact").is_displayed()
+
+
+def test_fetch_errors_raised_as_driver_ones():
+    def fetch(url):
+        if url == "slow":
+            raise asyncio.TimeoutError()
+        raise FetchFailed("blocked")
+
+    page = StaticPage(fetch)
+    with pytest.raises(TimeoutException):
+        page.get("slow")
+    with pytest.raises(WebDriverException):
+        page.get("blocked")
+
+
+async def handle(request):
+    name = request.match_info["name"]
+    if name == "redirect":
+        raise web.HTTPFound("/page")
+    if name == "page":
+        return web.Response(text="<p>Вакансия</p>", content_type="text/html", charset="utf-8")
+    if name == "missing":
+        return web.Response(text="<p>Not found</p>", content_type="text/html", status=404)
+    if name == "blocked":
+        return web.Response(text="", content_type="text/html", status=429)
+    if name == "big":
+        return web.Response(text="<p>" + "a" * 200 + "</p>", content_type="text/html")
+    return web.json_response({})
+
+
+def test_http_fetcher():
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{name}", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        (host, port) = runner.addresses[0][:2]
+        url = f"http://{host}:{port}"
+
+        fetcher = HttpFetcher()
+        fetcher.max_page_size = 100
+        await fetcher.open()
+        try:
+            results = [await fetcher.fetch(f"{url}/redirect"), await fetcher.fetch(f"{url}/missing")]
+            # Blocked, not html and too big pages
+            for name in ["blocked", "json", "big"]:
+                with pytest.raises(FetchFailed):
+                    await fetcher.fetch(f"{url}/{name}")
+            return url, results, fetcher.stats()
+        finally:
+            await fetcher.close()
+            await runner.cleanup()
+
+    url, results, stats = asyncio.run(run())
+    assert results == [(f"{url}/page", "<p>Вакансия</p>"), (f"{url}/missing", "<p>Not found</p>")]
+    assert stats == {"fetched": 2, "failed": 3}
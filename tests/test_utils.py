@@ -0,0 +1,35 @@
+from common import utils
+
+
+def test_prompt_read_once(monkeypatch):
+    monkeypatch.setattr(utils, "_prompts", {})
+    prompt = utils.load_prompt("filter.txt")
+
+    assert utils.load_prompt("filter.txt") is prompt
+    assert utils.get_prompt("filter.txt") == prompt.text
+    assert prompt.text.strip()
+
+
+def test_prompt_tokens_counted_once(monkeypatch):
+    monkeypatch.setattr(utils, "_prompts", {})
+    counted = []
+
+    def count_tokens(text):
+        counted.append(text)
+        return len(text)
+
+    # Real tokenizer loads its encoding over the network
+    monkeypatch.setattr(utils, "count_tokens", count_tokens)
+
+    prompt = utils.load_prompt("filter.txt")
+    assert counted == []
+    assert utils.get_prompt_tokens("filter.txt") == utils.get_prompt_tokens("filter.txt") == len(prompt.text)
+    assert counted == [prompt.text]
+
+
+def test_prompt_version_depends_on_prompts():
+    version = utils.get_prompt_version("filter.txt", "filter_batch.txt")
+
+    assert version == utils.get_prompt_version("filter.txt", "filter_batch.txt")
+    assert version != utils.get_prompt_version("filter.txt")
+    assert len(version) == 16
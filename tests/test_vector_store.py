@@ -0,0 +1,156 @@
+import pytest
+
+from db.vector_store import NumpyClient, NumpyCollection, IDAlreadyExists, match_where, query_by_ids
+
+VECTORS = {
+    "1": [1.0, 0.0],
+    "2": [0.0, 1.0],
+    "3": [1.0, 1.0],
+    "4": [-1.0, 0.0],
+}
+
+
+def fill(collection, ids=("1", "2", "3", "4")):
+    collection.add(
+        ids=list(ids),
+        embeddings=[VECTORS[_id] for _id in ids],
+        metadatas=[{"post_id": _id, "n": int(_id)} for _id in ids],
+    )
+
+
+@pytest.fixture
+def collection(tmp_path):
+    collection = NumpyCollection(str(tmp_path), "posts", dimension=2)
+    yield collection
+    collection.close()
+
+
+def test_query_orders_by_cosine_distance(collection):
+    fill(collection)
+    results = collection.query(query_embeddings=[[1.0, 0.1]], n_results=3)
+
+    assert results["ids"] == [["1", "3", "2"]]
+    assert results["distances"][0] == sorted(results["distances"][0])
+    assert results["metadatas"][0][0] == {"post_id": "1", "n": 1}
+
+
+def test_query_restricted_to_ids(collection):
+    fill(collection)
+    results = collection.query(query_embeddings=[[1.0, 0.0], [0.0, 1.0]], n_results=10, ids=["2", "4", "missing"])
+
+    assert results["ids"] == [["2", "4"], ["2", "4"]]
+    assert results["distances"][0] == pytest.approx([1.0, 2.0])
+
+
+def test_query_with_no_candidates(collection):
+    fill(collection)
+    results = collection.query(query_embeddings=[[1.0, 0.0]], ids=["missing"])
+    assert results["ids"] == [[]]
+    assert results["distances"] == [[]]
+
+
+def test_query_by_ids(collection):
+    fill(collection)
+    results = query_by_ids(collection, [[0.0, 1.0]], [2, 3])
+    assert results["ids"] == [["2", "3"]]
+
+
+def test_get_with_where(collection):
+    fill(collection)
+    assert collection.get(where={"n": {"$gte": 3}})["ids"] == ["3", "4"]
+    assert collection.get(where={"$or": [{"post_id": "1"}, {"n": {"$in": [4]}}]})["ids"] == ["1", "4"]
+
+
+def test_match_where_unknown_operator():
+    with pytest.raises(NotImplementedError):
+        match_where({"n": 1}, {"n": {"$like": 1}})
+
+
+def test_duplicate_ids_rejected(collection):
+    fill(collection, ids=("1",))
+    with pytest.raises(IDAlreadyExists):
+        fill(collection, ids=("1",))
+    with pytest.raises(IDAlreadyExists):
+        fill(collection, ids=("2", "2"))
+    assert collection.count() == 1
+
+
+def test_delete_swaps_last_row_in(collection):
+    fill(collection)
+    collection.delete(ids=["2"])
+
+    assert collection.count() == 3
+    # The last row took the place of the deleted one
+    assert collection.get(include=("embeddings",)) == {
+        "ids": ["1", "4", "3"],
+        "embeddings": [[1.0, 0.0], [-1.0, 0.0], [1.0, 1.0]],
+        "metadatas": None,
+        "documents": None,
+    }
+    assert collection.query(query_embeddings=[[-1.0, 0.0]], n_results=1)["ids"] == [["4"]]
+
+
+def test_delete_several_rows(collection):
+    fill(collection)
+    collection.delete(where={"n": {"$in": [1, 3]}})
+
+    assert sorted(collection.get()["ids"]) == ["2", "4"]
+    assert collection.query(query_embeddings=[[0.0, 1.0]], n_results=1)["ids"] == [["2"]]
+
+
+def test_journal_replayed_on_load(tmp_path):
+    collection = NumpyCollection(str(tmp_path), "posts", dimension=2)
+    fill(collection)
+    collection.delete(ids=["1"])
+    collection.delete(ids=["3"])
+    collection.close()
+
+    reloaded = NumpyCollection(str(tmp_path), "posts")
+    try:
+        assert reloaded.count() == 2
+        assert reloaded.get(include=("embeddings", "metadatas")) == {
+            "ids": ["4", "2"],
+            "embeddings": [[-1.0, 0.0], [0.0, 1.0]],
+            "metadatas": [{"post_id": "4", "n": 4}, {"post_id": "2", "n": 2}],
+            "documents": None,
+        }
+        assert reloaded.query(query_embeddings=[[0.0, 1.0]], n_results=1)["ids"] == [["2"]]
+    finally:
+        reloaded.close()
+
+
+def test_torn_journal_entry_skipped(tmp_path):
+    collection = NumpyCollection(str(tmp_path), "posts", dimension=2)
+    fill(collection, ids=("1", "2"))
+    collection.close()
+
+    with open(tmp_path / "posts.journal", "a") as f:
+        f.write('{"op": "add", "row"')
+
+    reloaded = NumpyCollection(str(tmp_path), "posts")
+    try:
+        assert reloaded.get()["ids"] == ["1", "2"]
+    finally:
+        reloaded.close()
+
+
+def test_grows_over_initial_capacity(tmp_path):
+    collection = NumpyCollection(str(tmp_path), "posts", dimension=2, initial_capacity=2)
+    try:
+        fill(collection)
+        assert collection.count() == 4
+        assert collection.get(ids=["4"], include=("embeddings",))["embeddings"] == [[-1.0, 0.0]]
+    finally:
+        collection.close()
+
+
+def test_client_deletes_collection(tmp_path):
+    client = NumpyClient(str(tmp_path))
+    fill(client.get_or_create_collection("posts", dimension=2))
+    client.delete_collection("posts")
+
+    assert client.get_or_create_collection("posts", dimension=2).count() == 0
+    client.stop()
+
+    with pytest.raises(ValueError):
+        NumpyClient(str(tmp_path)).delete_collection("unknown")